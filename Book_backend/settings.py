@@ -21,6 +21,8 @@ ALLOWED_HOSTS = [
     "127.0.0.1",
     "localhost",
     "127.0.0.1",
+    # Внутреннее имя контейнера, по нему Prometheus собирает /metrics
+    "web",
 ]
 
 # Большие буквы
@@ -74,6 +76,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     'api',
     'rest_framework_simplejwt',
     'rest_framework',
@@ -83,11 +86,31 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'api.authentication.CachedJWTAuthentication',
     ),
+    'DEFAULT_THROTTLE_CLASSES': (
+        'api.throttling.TokenBucketThrottle',
+    ),
+    # Перед приложением только nginx: IP клиента - последний адрес X-Forwarded-For,
+    # адреса, присланные самим клиентом, не учитываются
+    'NUM_PROXIES': 1,
+}
+# Token bucket по throttle_scope представления: емкость (токенов) и пополнение (токенов в секунду).
+# Представления без корзины здесь не ограничиваются
+THROTTLE_BUCKETS = {
+    'search': {'capacity': 60, 'rate': 1},
+    'reading-progress': {'capacity': 30, 'rate': 0.5},
 }
+THROTTLE_CACHE_ALIAS = 'redis'
+# При недоступном Redis запросы пропускаются без ограничения (в лог api.throttling), а не получают 500
+THROTTLE_FAIL_OPEN = True
+# Пользователь для JWT: LRU процесса (короткое время жизни) и общий кэш, сбрасывается при сохранении
+AUTH_USER_LOCAL_SIZE = 1024
+AUTH_USER_LOCAL_TIMEOUT = 10
+AUTH_USER_CACHE_TIMEOUT = 60 * 5
 
 MIDDLEWARE = [
+    "api.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -99,6 +122,28 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = "Book_backend.urls"
 
+# Метрики /metrics (api.metrics): запросы дольше SLOW_REQUEST_TIME секунд пишутся в лог api.metrics
+SLOW_REQUEST_TIME = env.float('SLOW_REQUEST_TIME', default=1.0)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'api.metrics': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+        'api.throttling': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+        },
+    },
+}
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -153,16 +198,50 @@ AUTH_PASSWORD_VALIDATORS = [
         "NAME": "django.contrib.auth.password_validation.NumericPasswordValidator",
     },
 ]
+##############
+# CACHE
+############
+# Для локальных тестов можно указать CACHE_URL=locmemcache://
+CACHES = {
+    'default': env.cache('CACHE_URL', default='redis://redis:6379/1'),
+    # Данные, которым нужен Redis (ограничение запросов, буфер прогресса, очередь писем), не зависят от CACHE_URL.
+    # Буфер и очередь теряются при вытеснении ключей, поэтому по умолчанию это Redis брокера Celery,
+    # которому тоже нужен maxmemory-policy noeviction
+    'redis': env.cache('REDIS_URL', default=env('CELERY_BROKER_URL', default='redis://redis:6379/0')),
+}
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+
 ##############
 # CELERY
 ############
 
-CELERY_BROKER_URL = 'redis://redis:6379/0'
-CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
+CELERY_BROKER_URL = env('CELERY_BROKER_URL', default='redis://redis:6379/0')
+CELERY_RESULT_BACKEND = env('CELERY_RESULT_BACKEND', default='redis://redis:6379/0')
 CELERY_TIMEZONE = 'UTC'
 CELERY_ENABLE_UTC = True
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
+CELERY_BEAT_SCHEDULE = {
+    'flush-reading-progress': {
+        'task': 'api.tasks.flush_reading_progress',
+        'schedule': 5.0,
+    },
+    # Письма, не отправленные после всех повторов send_queued_emails
+    'send-queued-emails': {
+        'task': 'api.tasks.send_queued_emails',
+        'schedule': 60.0,
+    },
+}
+
+##############
+# READING PROGRESS
+############
+# Отложенная запись прогресса чтения: PATCH пишет в Redis, Celery beat переносит в базу
+READING_PROGRESS_BUFFER = env.bool('READING_PROGRESS_BUFFER', default=False)
+# Подключение к Redis из CACHES
+READING_PROGRESS_CACHE_ALIAS = 'redis'
+# Сколько прогресс хранится в Redis после переноса в базу. Пока есть неперенесенные книги, ключ не истекает
+READING_PROGRESS_BUFFER_TTL = 60 * 60
 
 LANGUAGE_CODE = "en-us"
 
@@ -175,6 +254,18 @@ STATIC_URL = '/staticfiles/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = "/media/"
+# Файлы книг отдает nginx из internal location после проверки доступа (X-Accel-Redirect),
+# без nginx (локальная разработка) файл отдает Django
+PROTECTED_MEDIA_URL = '/protected-media/'
+USE_X_ACCEL_REDIRECT = env.bool('USE_X_ACCEL_REDIRECT', default=True)
+# Оптимизация EPUB: максимальная сторона картинок и качество JPEG
+EPUB_IMAGE_MAX_SIZE = env.int('EPUB_IMAGE_MAX_SIZE', default=1600)
+EPUB_JPEG_QUALITY = env.int('EPUB_JPEG_QUALITY', default=80)
+# Размеры миниатюр (WebP и JPEG): имя -> (ширина, высота)
+THUMBNAIL_SIZES = {
+    'author': {'small': (96, 96), 'medium': (320, 320)},
+    'cover': {'small': (120, 180), 'medium': (320, 480)},
+}
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 LOGIN_FIELD = 'email'
@@ -206,6 +297,13 @@ DJOSER = {
 ###########
 # Email Send
 ###########
+# Письма уходят из Celery пачками (api.email_backend), доставка - EMAIL_DELIVERY_BACKEND
+EMAIL_BACKEND = 'api.email_backend.CeleryEmailBackend'
+EMAIL_DELIVERY_BACKEND = env('EMAIL_DELIVERY_BACKEND', default='django.core.mail.backends.smtp.EmailBackend')
+EMAIL_BATCH_SIZE = 50
+# Подключение к Redis из CACHES для очереди писем
+EMAIL_QUEUE_CACHE_ALIAS = 'redis'
+EMAIL_TIMEOUT = 30
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_HOST_USER = env('SEND_EMAIL')
 EMAIL_HOST_PASSWORD = env('SEND_PASSWORD')
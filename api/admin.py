@@ -1,9 +1,40 @@
 from django.contrib import admin
+from django.db import transaction
+
+from api.models import (Artworks, Author, CustomUser, EpubOptimization,
+                        Feedback, Genre, ImportJob)
+from api.tasks import make_author_thumbnails, make_cover, optimize_epub
+
+
+@admin.register(Artworks)
+class ArtworksAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        """
+        Новый файл книги оптимизируется в Celery, до этого читается исходный файл.
+        Обложка извлекается из нового файла
+        """
+        super().save_model(request, obj, form, change)
+        if 'file' in form.changed_data and obj.file:
+            for optimization in EpubOptimization.objects.filter(book=obj):
+                optimization.file.delete(save=False)
+                optimization.delete()
+            transaction.on_commit(lambda: optimize_epub.delay(obj.id))
+            transaction.on_commit(lambda: make_cover.delay(obj.id))
+
+
+@admin.register(Author)
+class AuthorAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        """
+        Миниатюры новой фотографии создаются в Celery
+        """
+        super().save_model(request, obj, form, change)
+        if 'photo' in form.changed_data:
+            transaction.on_commit(lambda: make_author_thumbnails.delay(obj.id))
 
-from api.models import Artworks, Author, CustomUser, Feedback, Genre
 
-admin.site.register(Artworks)
-admin.site.register(Author)
 admin.site.register(Genre)
 admin.site.register(Feedback)
 admin.site.register(CustomUser)
+admin.site.register(ImportJob)
+admin.site.register(EpubOptimization)
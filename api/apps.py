@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_migrate
 
 
 class ApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "api"
+
+    def ready(self):
+        from api import metrics, signals
+
+        metrics.instrument_serializers()
+        pre_migrate.connect(signals.create_extensions, sender=self)
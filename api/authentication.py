@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from api.models import CustomUser
+
+# Поля пользователя в кэше. Пароль не кэшируется: он остается отложенным полем
+# и не перезаписывается при save() пользователя из кэша
+USER_FIELDS = tuple(
+    field.attname for field in CustomUser._meta.concrete_fields if field.attname != 'password'
+)
+
+
+class LocalUserCache:
+    """
+    LRU пользователей в памяти процесса с коротким временем жизни
+    """
+
+    def __init__(self, size: int, timeout: float):
+        self.size = size
+        self.timeout = timeout
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.timeout, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+local_cache = LocalUserCache(size=settings.AUTH_USER_LOCAL_SIZE, timeout=settings.AUTH_USER_LOCAL_TIMEOUT)
+
+
+def get_user_key(user_id) -> str:
+    return f'auth:user:{user_id}'
+
+
+def invalidate_user(user_id):
+    """
+    Сброс пользователя в общем кэше и в памяти текущего процесса,
+    в остальных процессах запись истекает через AUTH_USER_LOCAL_TIMEOUT
+    """
+    key = get_user_key(user_id)
+    local_cache.delete(key)
+    cache.delete(key)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT без запроса к таблице пользователей: пользователь берется из LRU процесса,
+    затем из общего кэша, и только потом из базы
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        # Быстрая проверка по данным access-токена, выданного при входе (в refresh их нет).
+        # Сброс кэша при сохранении пользователя проверяет актуальные
+        if validated_token.get('is_active') is False:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        if validated_token.get('is_suspended') is True:
+            raise AuthenticationFailed('Пользователь заблокирован', code='user_suspended')
+
+        key = get_user_key(user_id)
+        values = local_cache.get(key)
+        if values is None:
+            values = cache.get(key)
+            if values is None:
+                values = CustomUser.objects.filter(
+                    **{api_settings.USER_ID_FIELD: user_id},
+                ).values_list(*USER_FIELDS).first()
+                if values is None:
+                    raise AuthenticationFailed('User not found', code='user_not_found')
+                cache.set(key, values, timeout=settings.AUTH_USER_CACHE_TIMEOUT)
+            local_cache.set(key, values)
+
+        user = CustomUser.from_db(DEFAULT_DB_ALIAS, USER_FIELDS, values)
+        if not user.is_active:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        if user.is_suspended:
+            raise AuthenticationFailed('Пользователь заблокирован', code='user_suspended')
+        return user
+
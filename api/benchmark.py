@@ -0,0 +1,279 @@
+import json
+import math
+import statistics
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from urllib.parse import urlencode
+
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.urls import URLPattern
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api import urls
+from api.cache import bump_catalog_version
+from api.metrics import RequestRecorder
+from api.models import (Artworks, Author, AuthorStats, BookState, CustomUser,
+                        EpubIndex, ImportJob)
+
+
+@dataclass
+class Case:
+    """
+    Сценарий замера адреса. Строки в kwargs, params и data, совпадающие с атрибутом BenchmarkContext,
+    заменяются его значением
+    """
+    method: str = 'get'
+    kwargs: dict = field(default_factory=dict)
+    params: dict = field(default_factory=dict)
+    data: dict | None = None
+    # Причина, по которой адрес не замеряется
+    skip: str = ''
+
+
+# Шаблон адреса из api/urls.py -> сценарии. Адреса без сценария или без данных для него (например, без книги
+# с файлом EPUB в хранилище) попадают в отчет как пропущенные
+ROUTES = {
+    'auth/jwt/create/': [Case('post', data={'email': 'email', 'password': 'password'})],
+    'api/settings/': [Case()],
+    'docs/swagger/': [Case(params={'format': 'openapi'})],
+    'docs/redoc/': [Case()],
+    'api/search/': [
+        Case(),
+        Case(params={'value': 'title_word'}),
+        Case(params={'value': 'author_word', 'author': 'true'}),
+        Case(params={'value': 'title_word', 'artworks': 'true', 'page': 2}),
+    ],
+    'api/first-letter-author/': [Case()],
+    'api/filter-author-first/': [Case(params={'value': 'letter'})],
+    'api/filter-artworks-first/': [Case(params={'value': 'title_letter'})],
+    'api/filter-year-artworks/': [Case(params={'year': 'year'})],
+    'api/filter-genre-artworks/': [Case(params={'genre': 'genre_name'})],
+    'api/artworks-year/': [Case()],
+    'api/genre-names/': [Case()],
+    'api/detail-author/<int:pk>/': [Case(kwargs={'pk': 'author'})],
+    'api/author-bundle/<int:pk>/': [Case(kwargs={'pk': 'author'})],
+    'api/books-genre-author/': [Case(params={'author': 'author', 'genre': 'genre'})],
+    'api/book/<int:pk>/': [Case(kwargs={'pk': 'reading_book'})],
+    'api/book/<int:pk>/download/': [Case(kwargs={'pk': 'epub_book'})],
+    'api/book/<int:pk>/toc/': [Case(kwargs={'pk': 'indexed_book'})],
+    'api/book/<int:pk>/chapter/': [Case(kwargs={'pk': 'indexed_book'}, params={'index': 1})],
+    'api/feedback/': [Case('post', data={'text': 'Замер обратной связи'})],
+    'api/book-state/': [Case('post', data={'book': 'new_book', 'epubcfi': 'epubcfi(/6/2)', 'percent': 0})],
+    'api/books/': [Case(), Case(params={'limit': 50})],
+    'api/continue-reading/': [Case()],
+    'api/update-state-book/<int:pk>/': [
+        Case('patch', kwargs={'pk': 'reading_book'}, data={'epubcfi': 'epubcfi(/6/4)', 'percent': 42}),
+    ],
+    'api/create-book/': [Case('post', skip='загрузка Excel и задача Celery')],
+    'api/import-job/<int:pk>/': [Case(kwargs={'pk': 'import_job'})],
+    'api/import-job/<int:pk>/resume/': [Case('post', skip='запускает задачу Celery')],
+    'metrics': [Case()],
+}
+
+
+class BenchmarkContext:
+    """
+    Данные для подстановки в сценарии: самый активный читатель, самый плодовитый автор и т.д.
+    """
+
+    def __init__(self, email: str | None = None, password: str = 'password'):
+        if email is None:
+            top = BookState.objects.values('user').annotate(count=Count('id')).order_by('-count').first()
+            user = CustomUser.objects.get(id=top['user']) if top else CustomUser.objects.order_by('id').first()
+        else:
+            user = CustomUser.objects.get(email=email)
+        if user is None:
+            raise ValueError('Нет пользователей, сначала manage.py generate_catalog')
+        self.user = user
+        self.email = user.email
+        self.password = password
+
+        stats = AuthorStats.objects.order_by('-total').first()
+        author = stats.author if stats else Author.objects.order_by('id').first()
+        book = Artworks.objects.filter(author=author).prefetch_related('genres').first()
+        if author is None or book is None:
+            raise ValueError('Каталог пуст, сначала manage.py generate_catalog')
+        genre = book.genres.first()
+
+        self.author = author.id
+        self.author_word = author.name.split()[0]
+        self.letter = author.name[0]
+        self.book = book.id
+        self.title_word = book.name.split()[0]
+        self.title_letter = book.name[0]
+        self.year = book.date
+        self.genre = genre.id if genre else None
+        self.genre_name = genre.name if genre else ''
+        # Файлы сгенерированного каталога не существуют, адреса файлов без книги с файлом пропускаются
+        self.epub_book = self.find_epub_book()
+        index = next(
+            (index for index in EpubIndex.objects.order_by('book_id')[:100] if default_storage.exists(index.file)),
+            None,
+        )
+        self.indexed_book = index.book_id if index else self.epub_book
+        self.reading_book = BookState.objects.filter(user=user).values_list('book_id', flat=True).first()
+        self.new_book = Artworks.objects.exclude(bookstate__user=user).values_list('id', flat=True).first()
+        job = ImportJob.objects.order_by('-id').first()
+        self.import_job = job.id if job else None
+
+    @staticmethod
+    def find_epub_book(limit: int = 100) -> int | None:
+        """
+        Книга, файл которой есть в хранилище
+        :param limit: Сколько книг проверить
+        """
+        books = Artworks.objects.exclude(file='').select_related('epub_optimization').only(
+            'id', 'file', 'epub_optimization',
+        ).order_by('id')[:limit]
+        for book in books:
+            if default_storage.exists(book.get_read_file_name()):
+                return book.id
+        return None
+
+    def resolve(self, values: dict | None) -> dict | None:
+        if values is None:
+            return None
+        return {
+            key: getattr(self, value, value) if isinstance(value, str) else value
+            for key, value in values.items()
+        }
+
+
+def get_routes() -> list:
+    """
+    Шаблоны всех адресов api/urls.py, вложенные include() пропускаются
+    """
+    return [str(pattern.pattern) for pattern in urls.urlpatterns if isinstance(pattern, URLPattern)]
+
+
+def percentile(values: list, p: float) -> float:
+    """
+    Перцентиль методом ближайшего ранга
+    """
+    values = sorted(values)
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+
+@contextmanager
+def rollback():
+    """
+    Изменения запроса не сохраняются, чтобы повторы замера и следующие замеры шли на тех же данных
+    """
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+def send(client: Client, url: str, case: Case, data: dict | None):
+    method = getattr(client, case.method)
+    if data is None:
+        return method(url)
+    return method(url, data=data, content_type='application/json')
+
+
+def run_case(client: Client, url: str, case: Case, data: dict | None, repeat: int, warmup: int, cold: bool) -> dict:
+    """
+    Замер одного сценария. Изменяющие запросы выполняются в транзакции с откатом
+    """
+    timings, queries, db_times, statuses = [], [], [], set()
+    for i in range(warmup + repeat):
+        if cold:
+            bump_catalog_version()
+        recorder = RequestRecorder()
+        with nullcontext() if case.method == 'get' else rollback():
+            with connection.execute_wrapper(recorder):
+                start = time.perf_counter()
+                response = send(client=client, url=url, case=case, data=data)
+                duration = time.perf_counter() - start
+        if i < warmup:
+            continue
+        timings.append(duration * 1000)
+        queries.append(recorder.queries)
+        db_times.append(recorder.db_time * 1000)
+        statuses.add(response.status_code)
+    return {
+        'method': case.method.upper(),
+        'status': sorted(statuses),
+        'p50_ms': round(percentile(timings, 0.5), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'max_ms': round(max(timings), 3),
+        'queries': int(statistics.median(queries)),
+        'db_p50_ms': round(percentile(db_times, 0.5), 3),
+    }
+
+
+def run_benchmark(context: BenchmarkContext, repeat: int = 20, warmup: int = 2, cold: bool = False) -> dict:
+    """
+    Замер всех адресов api/urls.py
+    :param context: Данные для сценариев
+    :param repeat: Кол-во замеряемых запросов на сценарий
+    :param warmup: Кол-во запросов перед замером (кэш каталога, соединение с базой)
+    :param cold: Сбрасывать кэш каталога перед каждым запросом
+    :return: {'results': {'METHOD шаблон?параметры сценария': замеры}, 'skipped': {шаблон: [причины]}}
+    """
+    token = AccessToken.for_user(context.user)
+    client = Client(HTTP_HOST='localhost', HTTP_AUTHORIZATION=f'{api_settings.AUTH_HEADER_TYPES[0]} {token}')
+    results, skipped = {}, {}
+    for route in get_routes():
+        cases = ROUTES.get(route)
+        if cases is None:
+            skipped[route] = ['нет сценария в api.benchmark.ROUTES']
+            continue
+        for case in cases:
+            kwargs = context.resolve(case.kwargs)
+            params = context.resolve(case.params)
+            values = kwargs | params
+            missing = [value for key, value in (case.kwargs | case.params).items() if values[key] is None]
+            if case.skip or missing:
+                reason = case.skip or f'нет данных: {", ".join(missing)}'
+                skipped.setdefault(route, []).append(f'{case.method.upper()} {reason}')
+                continue
+            url = '/' + route
+            for name, value in kwargs.items():
+                url = url.replace(f'<int:{name}>', str(value))
+            if params:
+                url = f'{url}?{urlencode(params)}'
+            # Ключ не зависит от id в базе, поэтому замеры на разных наборах данных сравнимы
+            key = f'{case.method.upper()} {route}'
+            if case.params:
+                key = f'{key}?{urlencode(case.params)}'
+            results[key] = {'url': url} | run_case(
+                client=client, url=url, case=case, data=context.resolve(case.data),
+                repeat=repeat, warmup=warmup, cold=cold,
+            )
+    return {'results': results, 'skipped': skipped}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Сравнение с прошлым замером по шаблону адреса и параметрам сценария
+    :param threshold: Допустимый рост p95, доля (0.2 - 20%)
+    :return: [(сценарий, baseline, текущий, регрессия)]
+    """
+    rows = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        regression = (
+            current['p95_ms'] > previous['p95_ms'] * (1 + threshold)
+            or current['queries'] > previous['queries']
+        )
+        rows.append((key, previous, current, regression))
+    return rows
+
+
+def save(path: str, report: dict):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+def load(path: str) -> dict:
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
@@ -0,0 +1,83 @@
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+from api.models import BookState
+from api.progress import get_buffer_version
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+def get_catalog_version() -> int:
+    """
+    Текущая версия каталога, входит в ключи кэша.
+    Начальное значение - время, чтобы после вытеснения ключа версия не повторилась
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    """
+    Сброс кэша каталога: записи со старой версией больше не читаются и истекают сами
+    """
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.add(CATALOG_VERSION_KEY, time.time_ns(), timeout=None)
+
+
+def get_catalog_key(request, name: str) -> str:
+    """
+    Ключ кэша: версия каталога, имя endpoint и адрес запроса с отсортированными параметрами
+    """
+    params = urlencode(sorted(request.GET.lists()), doseq=True)
+    url = f'{request.build_absolute_uri(request.path)}?{params}'
+    digest = hashlib.md5(url.encode()).hexdigest()
+    return f'catalog:{get_catalog_version()}:{name}:{digest}'
+
+
+def get_catalog_data(request, name: str, builder):
+    """
+    Данные каталога из кэша, при отсутствии строятся и сохраняются.
+    Данные общие для всех пользователей, персональные поля (read, last) дополняются после чтения
+    :param request: Запрос
+    :param name: Имя endpoint
+    :param builder: Функция без аргументов, возвращающая данные для ответа
+    """
+    key = get_catalog_key(request=request, name=name)
+    data = cache.get(key)
+    if data is None:
+        data = builder()
+        cache.set(key, data, timeout=settings.CATALOG_CACHE_TIMEOUT)
+    return data
+
+
+def catalog_etag(request, *args, **kwargs) -> str:
+    """
+    ETag для справочников каталога, меняется вместе с версией каталога
+    """
+    return f'catalog-{get_catalog_version()}'
+
+
+def reading_list_etag(request, *args, **kwargs) -> str:
+    """
+    ETag списка для чтения: последнее обновление и кол-во книг пользователя, версия каталога
+    """
+    state = BookState.objects.filter(user=request.user.id, show=True).aggregate(
+        last=Max('date_update'),
+        count=Count('id'),
+    )
+    last = state['last'].timestamp() if state['last'] else 0
+    params = urlencode(sorted(request.GET.lists()), doseq=True)
+    return (
+        f'books-{request.user.id}-{last}-{state["count"]}-{get_catalog_version()}'
+        f'-{get_buffer_version(request.user.id)}-{hashlib.md5(params.encode()).hexdigest()}'
+    )
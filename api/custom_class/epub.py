@@ -0,0 +1,361 @@
+import io
+import posixpath
+import re
+import struct
+import zipfile
+import zlib
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+from PIL import Image
+
+NAMESPACES = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+    'ncx': 'http://www.daisy.org/z3986/2005/ncx/',
+    'xhtml': 'http://www.w3.org/1999/xhtml',
+    'epub': 'http://www.idpf.org/2007/ops',
+}
+CONTAINER = 'META-INF/container.xml'
+# Локальный заголовок файла в zip: сигнатура, ..., длина имени, длина extra
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+# epubcfi(/6/14[chap01ref]!/4/2) -> шаг по spine (14) и idref (chap01ref)
+CFI_SPINE = re.compile(r'^epubcfi\(/\d+/(\d+)(?:\[([^\]]*)\])?')
+# Ссылки на ресурсы в XHTML/SVG/SMIL (href, src, poster, data у object, в том числе с префиксом - xlink:href)
+# и CSS (url(), @import)
+REFERENCES = re.compile(
+    rb'''(?:(?<![\w.-])(?:[\w-]+:)?(?:href|src|poster|data)\s*=\s*["']([^"']+)["'])'''
+    rb'''|(?:url\(\s*["']?([^"')]+?)["']?\s*\))'''
+    rb'''|(?:@import\s+["']([^"']+)["'])'''
+)
+# srcset (img, source): список "адрес ширина/плотность" через запятую
+SRCSET = re.compile(rb'''(?<![\w.-])srcset\s*=\s*["']([^"']+)["']''')
+TEXT_TYPES = (
+    'application/xhtml+xml', 'text/html', 'text/css', 'image/svg+xml', 'application/x-dtbncx+xml',
+    'application/smil+xml',
+)
+# cover в начале слова id или пути картинки: cover.jpg, book-cover, covers/1.png, но не discover.png
+COVER_NAME = re.compile(r'(?<![a-z])cover', re.IGNORECASE)
+# Уже сжатые форматы хранятся без повторного сжатия
+STORED_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp')
+
+
+class EpubError(Exception):
+    pass
+
+
+class Epub:
+    """
+    Индекс EPUB: элементы manifest со смещениями внутри zip, spine и оглавление.
+    Ресурс читается по смещению без разбора всего архива
+    """
+
+    def __init__(self, file):
+        """
+        :param file: Путь или открытый бинарный файл
+        """
+        self.file = file
+
+    def build_index(self) -> dict:
+        """
+        Разбор container.xml, OPF и оглавления (EPUB 3 nav или EPUB 2 NCX)
+        :return: Словарь opf, items (href -> смещение и размеры), spine, toc
+        """
+        try:
+            with zipfile.ZipFile(self.file) as archive:
+                opf = self.get_opf_path(archive)
+                package = self.parse_xml(archive, opf)
+                infos = {info.filename: info for info in archive.infolist()}
+                items, ids = {}, {}
+                for item in package.iterfind('opf:manifest/opf:item', NAMESPACES):
+                    href = self.resolve(opf, item.get('href', ''))
+                    info = infos.get(href)
+                    if info is None:
+                        continue
+                    ids[item.get('id')] = href
+                    items[href] = {
+                        'media_type': item.get('media-type', ''),
+                        'properties': item.get('properties', ''),
+                        'offset': self.get_data_offset(archive, info),
+                        'compress_size': info.compress_size,
+                        'size': info.file_size,
+                        'compress_type': info.compress_type,
+                    }
+                spine_node = package.find('opf:spine', NAMESPACES)
+                spine = [
+                    {'idref': itemref.get('idref'), 'href': ids[itemref.get('idref')]}
+                    for itemref in (spine_node.iterfind('opf:itemref', NAMESPACES) if spine_node is not None else ())
+                    if itemref.get('idref') in ids
+                ]
+                toc = self.parse_toc(archive, items=items, ids=ids, spine_node=spine_node)
+        except (zipfile.BadZipFile, ElementTree.ParseError, KeyError) as e:
+            raise EpubError(str(e))
+        return {'opf': opf, 'items': items, 'spine': spine, 'toc': toc}
+
+    def optimize(self, target, max_image_size: int = 1600, jpeg_quality: int = 80) -> dict:
+        """
+        Оптимизированная копия EPUB: максимальное сжатие записей, уменьшение и пересжатие картинок,
+        удаление ресурсов manifest, на которые ничего не ссылается
+        :param target: Путь или бинарный файл для записи копии
+        :param max_image_size: Максимальная сторона картинки, px
+        :param jpeg_quality: Качество JPEG
+        :return: Словарь: removed - удаленные ресурсы, images - пересжатые картинки
+        """
+        stats = {'removed': [], 'images': 0}
+        try:
+            with zipfile.ZipFile(self.file) as archive:
+                opf = self.get_opf_path(archive)
+                package = self.parse_xml(archive, opf)
+                names = set(archive.namelist())
+                manifest = {
+                    self.resolve(opf, item.get('href', '')): item
+                    for item in package.iterfind('opf:manifest/opf:item', NAMESPACES)
+                }
+                referenced = self.get_referenced(archive, opf, package, manifest, names)
+                removed = {href for href in manifest if href in names and href not in referenced}
+                opf_data = archive.read(opf)
+                for href in removed:
+                    opf_data = self.remove_manifest_item(opf_data, manifest[href].get('id'))
+                with zipfile.ZipFile(target, 'w') as result:
+                    # mimetype первым и без сжатия (требование OCF)
+                    if 'mimetype' in names:
+                        result.writestr('mimetype', archive.read('mimetype'), compress_type=zipfile.ZIP_STORED)
+                    for info in archive.infolist():
+                        if info.filename == 'mimetype' or info.is_dir() or info.filename in removed:
+                            continue
+                        data = opf_data if info.filename == opf else archive.read(info)
+                        media_type = manifest[info.filename].get('media-type', '') if info.filename in manifest else ''
+                        if media_type in ('image/jpeg', 'image/png'):
+                            image = self.optimize_image(data, media_type, max_image_size, jpeg_quality)
+                            if len(image) < len(data):
+                                data = image
+                                stats['images'] += 1
+                        compress_type = zipfile.ZIP_STORED if media_type in STORED_TYPES else zipfile.ZIP_DEFLATED
+                        result.writestr(
+                            zipfile.ZipInfo(info.filename, date_time=info.date_time),
+                            data,
+                            compress_type=compress_type,
+                            compresslevel=9,
+                        )
+        except (zipfile.BadZipFile, ElementTree.ParseError, KeyError) as e:
+            raise EpubError(str(e))
+        stats['removed'] = sorted(removed)
+        return stats
+
+    def get_cover(self) -> tuple | None:
+        """
+        Обложка из метаданных: EPUB 3 properties="cover-image", EPUB 2 meta name="cover",
+        иначе картинка manifest со словом cover в id или пути (COVER_NAME)
+        :return: (данные, media-type) или None
+        """
+        try:
+            with zipfile.ZipFile(self.file) as archive:
+                opf = self.get_opf_path(archive)
+                package = self.parse_xml(archive, opf)
+                images = [
+                    item for item in package.iterfind('opf:manifest/opf:item', NAMESPACES)
+                    if item.get('media-type', '').startswith('image/') and item.get('media-type') != 'image/svg+xml'
+                ]
+                cover_id = next(
+                    (
+                        meta.get('content') for meta in package.iterfind('opf:metadata/opf:meta', NAMESPACES)
+                        if meta.get('name') == 'cover'
+                    ),
+                    None,
+                )
+                candidates = (
+                    [item for item in images if 'cover-image' in item.get('properties', '').split()]
+                    + [item for item in images if item.get('id') == cover_id]
+                    + [
+                        item for item in images
+                        if COVER_NAME.search(item.get('id', '')) or COVER_NAME.search(item.get('href', ''))
+                    ]
+                )
+                names = set(archive.namelist())
+                for item in candidates:
+                    href = self.resolve(opf, item.get('href', ''))
+                    if href in names:
+                        return archive.read(href), item.get('media-type')
+        except (zipfile.BadZipFile, ElementTree.ParseError, KeyError) as e:
+            raise EpubError(str(e))
+        return None
+
+    def get_referenced(self, archive: zipfile.ZipFile, opf: str, package, manifest: dict, names: set) -> set:
+        """
+        Ресурсы, достижимые из spine, оглавления, обложки и служебных элементов manifest по ссылкам
+        """
+        ids = {item.get('id'): href for href, item in manifest.items()}
+        spine_node = package.find('opf:spine', NAMESPACES)
+        queue = [ids.get(itemref.get('idref')) for itemref in package.iterfind('opf:spine/opf:itemref', NAMESPACES)]
+        if spine_node is not None:
+            queue.append(ids.get(spine_node.get('toc')))
+        for meta in package.iterfind('opf:metadata/opf:meta', NAMESPACES):
+            if meta.get('name') == 'cover':
+                queue.append(ids.get(meta.get('content')))
+        for reference in package.iterfind('opf:guide/opf:reference', NAMESPACES):
+            queue.append(self.resolve(opf, reference.get('href', '')))
+        queue += [
+            href for href, item in manifest.items()
+            if item.get('properties') or item.get('fallback') or item.get('media-overlay')
+        ]
+        queue += [ids.get(item.get('fallback')) for item in manifest.values() if item.get('fallback')]
+        referenced = set()
+        while queue:
+            href = queue.pop()
+            if href is None or href in referenced or href not in names:
+                continue
+            referenced.add(href)
+            if manifest.get(href) is not None and manifest[href].get('media-type') not in TEXT_TYPES:
+                continue
+            for link in self.get_links(archive.read(href)):
+                if ':' not in link.split('/', 1)[0]:
+                    queue.append(self.resolve(href, link))
+        return referenced
+
+    @staticmethod
+    def get_links(data: bytes) -> list:
+        """
+        Все адреса ресурсов в документе (REFERENCES и каждый вариант srcset)
+        """
+        links = [next(group for group in groups if group) for groups in REFERENCES.findall(data)]
+        for srcset in SRCSET.findall(data):
+            links += [candidate.split()[0] for candidate in srcset.split(b',') if candidate.strip()]
+        return [link.decode('utf-8', 'ignore') for link in links]
+
+    @staticmethod
+    def remove_manifest_item(opf_data: bytes, item_id: str) -> bytes:
+        """
+        Удаление item из manifest без пересборки XML, форматирование OPF сохраняется
+        """
+        pattern = rb'''<(?:\w+:)?item\b[^>]*\bid\s*=\s*["']''' + re.escape(item_id.encode()) + rb'''["'][^>]*?/>\s*'''
+        return re.sub(pattern, b'', opf_data, count=1)
+
+    @staticmethod
+    def optimize_image(data: bytes, media_type: str, max_size: int, jpeg_quality: int) -> bytes:
+        """
+        Уменьшение картинки до max_size по большей стороне и пересжатие в том же формате,
+        чтобы ссылки на нее не менялись. Нечитаемая картинка возвращается как есть
+        """
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except (OSError, Image.DecompressionBombError):
+            return data
+        image.thumbnail((max_size, max_size))
+        output = io.BytesIO()
+        if media_type == 'image/jpeg':
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(output, 'JPEG', quality=jpeg_quality, optimize=True, progressive=True)
+        else:
+            image.save(output, 'PNG', optimize=True)
+        return output.getvalue()
+
+    @staticmethod
+    def get_opf_path(archive: zipfile.ZipFile) -> str:
+        container = ElementTree.fromstring(archive.read(CONTAINER))
+        rootfile = container.find('container:rootfiles/container:rootfile', NAMESPACES)
+        if rootfile is None or not rootfile.get('full-path'):
+            raise EpubError('В container.xml нет rootfile')
+        return rootfile.get('full-path')
+
+    @staticmethod
+    def parse_xml(archive: zipfile.ZipFile, name: str):
+        return ElementTree.fromstring(archive.read(name))
+
+    @staticmethod
+    def resolve(base: str, href: str) -> str:
+        """
+        Путь ресурса внутри zip относительно документа base, без фрагмента
+        """
+        href = unquote(href.split('#', 1)[0])
+        return posixpath.normpath(posixpath.join(posixpath.dirname(base), href)) if href else base
+
+    @staticmethod
+    def get_data_offset(archive: zipfile.ZipFile, info: zipfile.ZipInfo) -> int:
+        """
+        Смещение сжатых данных: после локального заголовка, имени и extra (extra может отличаться от центрального)
+        """
+        archive.fp.seek(info.header_offset)
+        header = LOCAL_HEADER.unpack(archive.fp.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise EpubError(f'Поврежден заголовок {info.filename}')
+        return info.header_offset + LOCAL_HEADER.size + header[-2] + header[-1]
+
+    def parse_toc(self, archive: zipfile.ZipFile, items: dict, ids: dict, spine_node) -> list:
+        """
+        Оглавление: [{'title', 'href', 'level'}], href без фрагмента, как в items
+        """
+        nav = next((href for href, item in items.items() if 'nav' in item['properties'].split()), None)
+        if nav is not None:
+            document = self.parse_xml(archive, nav)
+            for node in document.iter(f'{{{NAMESPACES["xhtml"]}}}nav'):
+                if node.get(f'{{{NAMESPACES["epub"]}}}type') == 'toc':
+                    return self.parse_nav(nav, node.find('xhtml:ol', NAMESPACES), level=1)
+        ncx = ids.get(spine_node.get('toc')) if spine_node is not None else None
+        if ncx is not None:
+            document = self.parse_xml(archive, ncx)
+            return self.parse_ncx(ncx, document.find('ncx:navMap', NAMESPACES), level=1)
+        return []
+
+    def parse_nav(self, base: str, node, level: int) -> list:
+        toc = []
+        if node is None:
+            return toc
+        for li in node.iterfind('xhtml:li', NAMESPACES):
+            link = li.find('xhtml:a', NAMESPACES)
+            if link is not None and link.get('href'):
+                toc.append({
+                    'title': ''.join(link.itertext()).strip(),
+                    'href': self.resolve(base, link.get('href')),
+                    'level': level,
+                })
+            toc += self.parse_nav(base, li.find('xhtml:ol', NAMESPACES), level=level + 1)
+        return toc
+
+    def parse_ncx(self, base: str, node, level: int) -> list:
+        toc = []
+        if node is None:
+            return toc
+        for point in node.iterfind('ncx:navPoint', NAMESPACES):
+            content = point.find('ncx:content', NAMESPACES)
+            if content is not None and content.get('src'):
+                toc.append({
+                    'title': (point.findtext('ncx:navLabel/ncx:text', '', NAMESPACES) or '').strip(),
+                    'href': self.resolve(base, content.get('src')),
+                    'level': level,
+                })
+            toc += self.parse_ncx(base, point, level=level + 1)
+        return toc
+
+    @staticmethod
+    def read_item(file, item: dict) -> bytes:
+        """
+        Чтение ресурса по смещению из индекса без разбора центрального каталога
+        :param file: Открытый бинарный файл EPUB
+        :param item: Элемент items из индекса
+        """
+        file.seek(item['offset'])
+        data = file.read(item['compress_size'])
+        if item['compress_type'] == zipfile.ZIP_STORED:
+            return data
+        if item['compress_type'] == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+        raise EpubError(f'Неподдерживаемое сжатие {item["compress_type"]}')
+
+    @staticmethod
+    def get_spine_index(epubcfi: str, spine: list) -> int | None:
+        """
+        Номер элемента spine по epubcfi: idref в скобках, если есть, иначе четный шаг /N -> N / 2 - 1
+        """
+        match = CFI_SPINE.match(epubcfi or '')
+        if match is None:
+            return None
+        step, idref = match.groups()
+        if idref:
+            for index, itemref in enumerate(spine):
+                if itemref['idref'] == idref:
+                    return index
+        index = int(step) // 2 - 1
+        return index if 0 <= index < len(spine) else None
@@ -1,94 +1,173 @@
-import pandas as pd
+from zipfile import BadZipFile
+
+import openpyxl
+from django.db import connection
+from openpyxl.utils.exceptions import InvalidFileException
 
 from api.models import Author, Artworks, Genre
 
 
+class ImportFileError(Exception):
+    pass
+
+
 class ParseXML:
     """
     Класс для парсинга книг
     """
 
+    # Ключ строки -> заголовок столбца в Excel
+    COLUMNS = {
+        'fio': 'ФИО Автора',
+        'name': 'Наименование произведения',
+        'file': 'Название файла',
+        'year': 'Год',
+        'genre': 'Жанр',
+    }
+    SHEET_NAME = 'Sheet1'
+
     def __init__(self, file_path: str):
         self.file_path = file_path
 
     @staticmethod
-    def create_author(fio):
+    def open_workbook(file):
         """
-        Создает автора и возвращает объект Author
+        :param file: Путь или файловый объект
+        :raise ImportFileError: Файл не xlsx
         """
-        author, _ = Author.objects.get_or_create(name=fio)
-        return author
+        try:
+            return openpyxl.load_workbook(file, read_only=True, data_only=True)
+        except (InvalidFileException, BadZipFile) as e:
+            raise ImportFileError(f'Файл не является книгой Excel (xlsx): {e}')
 
-    @staticmethod
-    def create_genres(genre):
+    @classmethod
+    def get_rows(cls, workbook):
         """
-        Создает жанры и возвращает список их идентификаторов
+        Строки листа SHEET_NAME и номера столбцов COLUMNS по заголовку
+        :return: (итератор строк после заголовка, ключ из COLUMNS -> номер столбца)
+        :raise ImportFileError: Нет листа или столбца
         """
-        genre_objs = []
-        if isinstance(genre, str):
-            genre = genre.split(',')
-            for genre in genre:
-                obj, _ = Genre.objects.get_or_create(name=genre)
-                genre_objs.append(obj.id)
-        return genre_objs
+        if cls.SHEET_NAME not in workbook.sheetnames:
+            raise ImportFileError(f'В файле нет листа {cls.SHEET_NAME}')
+        rows = workbook[cls.SHEET_NAME].iter_rows(values_only=True)
+        header = [str(title).strip() if title is not None else '' for title in next(rows, ())]
+        missing = [title for title in cls.COLUMNS.values() if title not in header]
+        if missing:
+            raise ImportFileError(f'На листе {cls.SHEET_NAME} нет столбцов: {", ".join(missing)}')
+        return rows, {key: header.index(title) for key, title in cls.COLUMNS.items()}
+
+    @classmethod
+    def check_file(cls, file):
+        """
+        Проверка листа и заголовка до постановки загрузки в очередь
+        :param file: Путь или файловый объект
+        :raise ImportFileError: Файл не xlsx, нет листа или столбца
+        """
+        workbook = cls.open_workbook(file)
+        try:
+            cls.get_rows(workbook)
+        finally:
+            workbook.close()
+
+    def iter_rows(self):
+        """
+        Построчное чтение листа без загрузки всей книги в память
+        :return: Генератор словарей с ключами из COLUMNS
+        :raise ImportFileError: Файл не xlsx, нет листа или столбца
+        """
+        workbook = self.open_workbook(self.file_path)
+        try:
+            rows, indexes = self.get_rows(workbook)
+            for row in rows:
+                yield {key: row[index] if index < len(row) else None for key, index in indexes.items()}
+        finally:
+            workbook.close()
 
     @staticmethod
-    def create_artwork(name, year, file):
+    def clean_row(row: dict) -> dict:
+        """
+        Приведение значений ячеек к строкам, жанры разбиваются по запятой
+        """
+        year = row['year']
+        if isinstance(year, float) and year.is_integer():
+            year = int(year)
+        genre = row['genre']
+        return {
+            'fio': str(row['fio']).strip() if row['fio'] else '',
+            'name': str(row['name']).strip() if row['name'] else '',
+            'file': str(row['file']).strip() if row['file'] else '',
+            'year': str(year)[:4] if year is not None else '',
+            'genres': [el.strip() for el in genre.split(',') if el.strip()] if isinstance(genre, str) else [],
+        }
+
+    @classmethod
+    def import_rows(cls, rows: list) -> list:
         """
-        Создает произведение и возвращает объект Artworks
+        Импорт пачки очищенных строк независимо от других пачек, вызывается внутри транзакции.
+        Рекомендательные блокировки по названиям не дают параллельным пачкам создать дубли.
+        Ключ 64-битный (hashtextextended), поэтому разные названия почти не блокируют друг друга
+        :param rows: Строки после clean_row
+        :return: id созданных произведений
         """
-        artwork, _ = Artworks.objects.get_or_create(
-            name=name,
-            defaults={
-                'date': year,
-                'file': f'/media/book/{file}.epub',
-            }
+        names = {row['name'] for row in rows if row['name']}
+        fios = {row['fio'] for row in rows if row['fio']}
+        genre_names = {name for row in rows for name in row['genres']}
+        keys = [f'artwork:{name}' for name in names] + [f'author:{fio}' for fio in fios]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_xact_lock(key) FROM '
+                '(SELECT hashtextextended(name, 0) AS key FROM unnest(%s::text[]) AS name ORDER BY 1) AS keys',
+                [keys],
+            )
+        return cls.import_chunk(
+            rows=rows,
+            authors=dict(Author.objects.filter(name__in=fios).values_list('name', 'id')),
+            genres=dict(Genre.objects.filter(name__in=genre_names).values_list('name', 'id')),
+            artworks=set(Artworks.objects.filter(name__in=names).values_list('name', flat=True)),
         )
-        return artwork
 
-    def parse_excel_file(self):
+    @staticmethod
+    def import_chunk(rows: list, authors: dict, genres: dict, artworks: set) -> list:
         """
-        Функция lzk парсинга книг
-        :return:
+        Импорт пачки строк, словари уже загруженных записей дополняются созданными
+        :param rows: Очищенные строки
+        :param authors: ФИО -> id автора
+        :param genres: Название -> id жанра
+        :param artworks: Названия существующих произведений
+        :return: id созданных произведений
         """
-        # Укажите путь к файлу Excel
-        excel_file = 'Library.xlsx'
-
-        # Укажите имя листа в файле Excel, на котором находятся данные
-        sheet_name = 'Sheet1'
-
-        # Чтение данных из Excel в объект DataFrame
-        df = pd.read_excel(excel_file, sheet_name=sheet_name)
-
-        # Выбор необходимых столбцов
-        required_columns = [
-            'ФИО Автора',
-            'Наименование произведения',
-            'Название файла',
-            'Год',
-            'Форма (Библиография)',
-            'Жанр',
-            'Теги',
-        ]
-        selected_data = df[required_columns]
-
-        # Преобразование в массив словарей
-        data_dict = selected_data.to_dict('records')
-
-        # Вывод данных
-        for item in data_dict:
-            fio = item['ФИО Автора']
-            name = item['Наименование произведения']
-            file = item['Название файла']
-            year = item['Год']
-            # form = item['Форма (Библиография)']
-            # tag = item['Теги']
-            genre = item['Жанр']
-            if Artworks.objects.filter(name=name).exists():
-                continue
-            author = self.create_author(fio=fio)
-            genres = self.create_genres(genre=genre)
-            artworks = self.create_artwork(name=name, year=year, file=file)
-            artworks.author.add(author)
-            artworks.genres.set(genres)
+        new_rows = []
+        for row in rows:
+            if row['name'] and row['name'] not in artworks:
+                artworks.add(row['name'])
+                new_rows.append(row)
+        if not new_rows:
+            return []
+
+        new_authors = Author.objects.bulk_create([
+            Author(name=name)
+            for name in {row['fio'] for row in new_rows if row['fio'] and row['fio'] not in authors}
+        ])
+        authors.update((author.name, author.id) for author in new_authors)
+
+        new_genres = {name for row in new_rows for name in row['genres'] if name not in genres}
+        Genre.objects.bulk_create([Genre(name=name) for name in new_genres], ignore_conflicts=True)
+        genres.update(Genre.objects.filter(name__in=new_genres).values_list('name', 'id'))
 
+        objs = Artworks.objects.bulk_create([
+            Artworks(name=row['name'], date=row['year'], file=f'/media/book/{row["file"]}.epub')
+            for row in new_rows
+        ])
+        Artworks.author.through.objects.bulk_create([
+            Artworks.author.through(artworks_id=obj.id, author_id=authors[row['fio']])
+            for obj, row in zip(objs, new_rows)
+            if row['fio']
+        ])
+        Artworks.genres.through.objects.bulk_create([
+            Artworks.genres.through(artworks_id=obj.id, genre_id=genres[name])
+            for obj, row in zip(objs, new_rows)
+            for name in set(row['genres'])
+        ])
+        Artworks.objects.filter(id__in=[obj.id for obj in objs]).update_search_vector()
+        Author.objects.filter(id__in=[author.id for author in new_authors]).update_search_vector()
+        return [obj.id for obj in objs]
@@ -0,0 +1,65 @@
+import hashlib
+import io
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# Формат -> (формат Pillow, параметры сохранения)
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 6}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def make_thumbnails(data: bytes, prefix: str, sizes: dict) -> dict:
+    """
+    Миниатюры картинки во всех форматах FORMATS, с сохранением пропорций в пределах размера.
+    В имя входит хэш исходника, поэтому новая картинка получает новые адреса
+    :param data: Исходная картинка
+    :param prefix: Начало имени в хранилище, например thumbs/author/1
+    :param sizes: Имя размера -> (ширина, высота)
+    :return: Имя размера -> {формат: имя файла в хранилище}
+    """
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'L'):
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+        image = background
+    digest = hashlib.md5(data).hexdigest()[:8]
+    thumbnails = {}
+    for size_name, size in sizes.items():
+        thumbnail = image.copy()
+        thumbnail.thumbnail(size, Image.LANCZOS)
+        thumbnails[size_name] = {}
+        for extension, (image_format, options) in FORMATS.items():
+            output = io.BytesIO()
+            thumbnail.save(output, image_format, **options)
+            name = f'{prefix}-{digest}-{size_name}.{extension}'
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            thumbnails[size_name][extension] = default_storage.save(name, ContentFile(output.getvalue()))
+    return thumbnails
+
+
+def delete_thumbnails(thumbnails: dict, keep: dict | None = None):
+    """
+    Удаление файлов миниатюр, кроме тех, что есть в keep
+    """
+    keep = {name for variants in (keep or {}).values() for name in variants.values()}
+    for variants in thumbnails.values():
+        for name in variants.values():
+            if name not in keep:
+                default_storage.delete(name)
+
+
+def get_thumbnail_urls(thumbnails: dict) -> dict:
+    """
+    Имя размера -> {формат: адрес}
+    """
+    return {
+        size_name: {extension: default_storage.url(name) for extension, name in variants.items()}
+        for size_name, variants in thumbnails.items()
+    }
@@ -0,0 +1,22 @@
+from django.core.mail.backends.base import BaseEmailBackend
+
+from api.mail import queue_messages
+from api.tasks import send_queued_emails
+
+
+class CeleryEmailBackend(BaseEmailBackend):
+    """
+    Письма не отправляются в запросе: они ставятся в очередь Redis и уходят пачками из Celery
+    через EMAIL_DELIVERY_BACKEND (SMTP с переиспользуемым соединением)
+    """
+
+    def send_messages(self, email_messages):
+        try:
+            count = queue_messages(email_messages)
+        except Exception:
+            if not self.fail_silently:
+                raise
+            return 0
+        if count:
+            send_queued_emails.delay()
+        return count
@@ -0,0 +1,116 @@
+import base64
+import json
+from email import message_from_bytes
+from email.message import Message
+from smtplib import SMTPException, SMTPRecipientsRefused
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.message import MIMEMixin
+from django_redis import get_redis_connection
+
+QUEUE_KEY = 'mail:queue'
+
+# Соединение воркера Celery, переиспользуется между пачками
+_connection = None
+
+
+class RawMessage(MIMEMixin, Message):
+    pass
+
+
+class RawEmailMessage(EmailMessage):
+    """
+    Уже собранное письмо из очереди: заголовки, тело и вложения не пересобираются
+    """
+
+    def __init__(self, from_email: str, recipients: list, message: str):
+        super().__init__(from_email=from_email)
+        self.raw_recipients = recipients
+        self.raw_message = message
+
+    def message(self):
+        return message_from_bytes(base64.b64decode(self.raw_message), _class=RawMessage)
+
+    def recipients(self):
+        return self.raw_recipients
+
+
+def serialize_message(message: EmailMessage) -> str:
+    return json.dumps({
+        'from_email': message.from_email,
+        'recipients': message.recipients(),
+        'message': base64.b64encode(message.message().as_bytes()).decode(),
+    })
+
+
+def queue_messages(messages: list) -> int:
+    """
+    Письма в очередь Redis, отправляет их send_queued
+    :param messages: Список EmailMessage
+    :return: Кол-во писем в очереди
+    """
+    values = [serialize_message(message) for message in messages if message.recipients()]
+    if not values:
+        return 0
+    get_redis_connection(settings.EMAIL_QUEUE_CACHE_ALIAS).rpush(QUEUE_KEY, *values)
+    return len(values)
+
+
+def get_connection_for_batch():
+    """
+    Открытое соединение EMAIL_DELIVERY_BACKEND, закрытое сервером SMTP открывается заново
+    """
+    global _connection
+    if _connection is None:
+        _connection = get_connection(settings.EMAIL_DELIVERY_BACKEND, fail_silently=False)
+    smtp = getattr(_connection, 'connection', None)
+    if smtp is not None:
+        try:
+            smtp.noop()
+        except (SMTPException, OSError):
+            close_connection()
+            return get_connection_for_batch()
+    _connection.open()
+    return _connection
+
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        except (SMTPException, OSError):
+            pass
+    _connection = None
+
+
+def send_queued(batch_size: int) -> tuple:
+    """
+    Отправка пачки писем из очереди одним соединением.
+    Письмо с отклоненными адресатами удаляется, при ошибке соединения неотправленные письма возвращаются в начало
+    :param batch_size: Размер пачки
+    :return: (кол-во отправленных, осталось в очереди)
+    """
+    redis = get_redis_connection(settings.EMAIL_QUEUE_CACHE_ALIAS)
+    pipe = redis.pipeline(transaction=True)
+    pipe.lrange(QUEUE_KEY, 0, batch_size - 1)
+    pipe.ltrim(QUEUE_KEY, batch_size, -1)
+    batch, _ = pipe.execute()
+    if not batch:
+        return 0, 0
+
+    processed = sent = 0
+    try:
+        connection = get_connection_for_batch()
+        for value in batch:
+            try:
+                sent += connection.send_messages([RawEmailMessage(**json.loads(value))])
+            except SMTPRecipientsRefused:
+                pass
+            processed += 1
+    except (SMTPException, OSError):
+        close_connection()
+        redis.lpush(QUEUE_KEY, *reversed(batch[processed:]))
+        raise
+    return sent, redis.llen(QUEUE_KEY)
@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from api.benchmark import BenchmarkContext, compare, load, run_benchmark, save
+from api.models import Artworks, Author, BookState, CustomUser
+
+
+class Command(BaseCommand):
+    help = (
+        'Замер p50/p95 и кол-ва SQL запросов по всем адресам api/urls.py на текущей базе '
+        '(большой каталог - manage.py generate_catalog). С --baseline завершается ошибкой при регрессии'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Замеряемых запросов на сценарий')
+        parser.add_argument('--warmup', type=int, default=2, help='Запросов до замера')
+        parser.add_argument('--cold', action='store_true', help='Сбрасывать кэш каталога перед каждым запросом')
+        parser.add_argument('--user', help='Email читателя, по умолчанию читатель с самым большим списком')
+        parser.add_argument('--password', default='password', help='Пароль читателя для auth/jwt/create/')
+        parser.add_argument('--output', default='benchmark.json', help='Файл результатов')
+        parser.add_argument('--baseline', help='Прошлый файл результатов для сравнения')
+        parser.add_argument('--threshold', type=float, default=0.2, help='Допустимый рост p95, доля')
+
+    def handle(self, *args, **options):
+        try:
+            context = BenchmarkContext(email=options['user'], password=options['password'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        # Ограничение запросов (api.throttling) остановило бы повторы
+        with override_settings(THROTTLE_BUCKETS={}):
+            report = run_benchmark(
+                context=context, repeat=options['repeat'], warmup=options['warmup'], cold=options['cold'],
+            )
+        report = {
+            'date': timezone.now().isoformat(),
+            'repeat': options['repeat'],
+            'cold': options['cold'],
+            'dataset': {
+                'authors': Author.objects.count(),
+                'artworks': Artworks.objects.count(),
+                'users': CustomUser.objects.count(),
+                'book_states': BookState.objects.count(),
+            },
+        } | report
+        save(options['output'], report)
+
+        self.stdout.write(f'{"Сценарий":<70} {"Статус":>8} {"p50, мс":>9} {"p95, мс":>9} {"SQL":>5}')
+        for key, result in report['results'].items():
+            status = ','.join(str(code) for code in result['status'])
+            self.stdout.write(
+                f'{key:<70} {status:>8} {result["p50_ms"]:>9.1f} {result["p95_ms"]:>9.1f} {result["queries"]:>5}'
+            )
+        for route, reasons in report['skipped'].items():
+            for reason in reasons:
+                self.stdout.write(self.style.WARNING(f'Пропущен {route}: {reason}'))
+        self.stdout.write(self.style.SUCCESS(f'Результаты: {options["output"]}'))
+
+        if options['baseline']:
+            self.compare(report['results'], load(options['baseline'])['results'], options['threshold'])
+
+    def compare(self, results: dict, baseline: dict, threshold: float):
+        regressions = 0
+        self.stdout.write(f'\n{"Сценарий":<70} {"p95 было":>9} {"p95 стало":>9} {"SQL было/стало":>15}')
+        for key, previous, current, regression in compare(results, baseline, threshold):
+            line = (
+                f'{key:<70} {previous["p95_ms"]:>9.1f} {current["p95_ms"]:>9.1f} '
+                f'{previous["queries"]:>7}/{current["queries"]:<7}'
+            )
+            if regression:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(line))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError(f'Регрессий: {regressions}')
+        self.stdout.write(self.style.SUCCESS('Регрессий нет'))
@@ -0,0 +1,193 @@
+import random
+from itertools import accumulate
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.expressions import RawSQL
+
+from api.cache import bump_catalog_version
+from api.models import (Artworks, Author, AuthorStats, BookState, CustomUser,
+                        FacetCounter, Genre, LastBookByAuthor, Settings)
+
+SURNAMES = (
+    'Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов', 'Новиков',
+    'Федоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов', 'Егоров', 'Павлов', 'Козлов',
+    'Степанов', 'Николаев', 'Орлов', 'Андреев', 'Макаров', 'Никитин', 'Захаров', 'Зайцев', 'Соловьев',
+    'Борисов', 'Яковлев', 'Григорьев', 'Романов', 'Воробьев', 'Сергеев', 'Кузьмин', 'Фролов', 'Александров',
+    'Дмитриев', 'Королев', 'Гусев', 'Киселев', 'Ильин', 'Максимов', 'Поляков', 'Сорокин', 'Виноградов',
+)
+FIRST_NAMES = (
+    'Александр', 'Алексей', 'Андрей', 'Борис', 'Василий', 'Виктор', 'Владимир', 'Георгий', 'Дмитрий',
+    'Евгений', 'Иван', 'Игорь', 'Константин', 'Лев', 'Михаил', 'Николай', 'Олег', 'Павел', 'Петр',
+    'Сергей', 'Степан', 'Федор', 'Юрий', 'Антон', 'Аркадий', 'Валентин', 'Григорий', 'Илья', 'Кирилл',
+)
+PATRONYMICS = (
+    'Александрович', 'Алексеевич', 'Андреевич', 'Борисович', 'Васильевич', 'Викторович', 'Владимирович',
+    'Дмитриевич', 'Иванович', 'Михайлович', 'Николаевич', 'Петрович', 'Сергеевич', 'Федорович', 'Юрьевич',
+)
+ADJECTIVES = (
+    'Тихий', 'Белый', 'Черный', 'Последний', 'Первый', 'Дальний', 'Старый', 'Новый', 'Золотой', 'Темный',
+    'Светлый', 'Холодный', 'Горячий', 'Железный', 'Серебряный', 'Долгий', 'Тайный', 'Забытый', 'Вечный',
+    'Северный', 'Южный', 'Лунный', 'Солнечный', 'Ночной', 'Морской', 'Лесной', 'Степной', 'Зимний',
+)
+NOUNS = (
+    'Дон', 'город', 'сад', 'путь', 'берег', 'дом', 'лес', 'ветер', 'огонь', 'год', 'день', 'вечер',
+    'остров', 'корабль', 'мост', 'камень', 'голос', 'след', 'сон', 'мир', 'край', 'караван', 'перевал',
+    'маяк', 'колокол', 'театр', 'рассвет', 'закат', 'полк', 'век', 'бал', 'фрегат', 'острог',
+)
+GENRES = (
+    'Роман', 'Повесть', 'Рассказ', 'Поэзия', 'Драма', 'Комедия', 'Трагедия', 'Детектив', 'Фантастика',
+    'Фэнтези', 'Приключения', 'Исторический роман', 'Биография', 'Мемуары', 'Сказка', 'Басня', 'Очерк',
+    'Эссе', 'Публицистика', 'Философия', 'Юмор', 'Сатира', 'Триллер', 'Мистика', 'Детская литература',
+    'Научно-популярная литература', 'Военная проза', 'Любовный роман', 'Поэма', 'Пьеса',
+)
+PASSWORD = 'password'
+
+
+def get_cum_weights(count: int, skew: float) -> list:
+    """
+    Накопленные веса для random.choices: первые записи популярнее последних (распределение Ципфа)
+    """
+    return list(accumulate(1 / (rank + 1) ** skew for rank in range(count)))
+
+
+class Command(BaseCommand):
+    help = 'Генерация большого каталога и читателей для нагрузочных замеров (manage.py benchmark)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--authors', type=int, default=20_000)
+        parser.add_argument('--artworks', type=int, default=200_000)
+        parser.add_argument('--users', type=int, default=50_000)
+        parser.add_argument('--states', type=int, default=1_000_000, help='Примерное кол-во BookState')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        genres = self.create_genres()
+        authors = self.create_authors(options['authors'])
+        artworks = self.create_artworks(options['artworks'], authors=authors, genres=genres)
+        users = self.create_users(options['users'])
+        states = self.create_book_states(options['states'], users=users, artworks=artworks)
+
+        # bulk_create не отправляет сигналы: поиск, счетчики и последние книги пересчитываются целиком
+        self.stdout.write('Пересчет поисковых векторов и счетчиков...')
+        Author.objects.update_search_vector()
+        Artworks.objects.update_search_vector()
+        FacetCounter.objects.rebuild()
+        AuthorStats.objects.refresh()
+        LastBookByAuthor.objects.refresh()
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f'Авторов: {len(authors)}, произведений: {len(artworks)}, пользователей: {len(users)}, '
+            f'книг в списках чтения: {states}'
+        ))
+
+    def get_batches(self, count: int):
+        for start in range(0, count, self.batch_size):
+            yield range(start, min(start + self.batch_size, count))
+
+    def create_genres(self) -> list:
+        Genre.objects.bulk_create([Genre(name=name) for name in GENRES], ignore_conflicts=True)
+        return list(Genre.objects.filter(name__in=GENRES).values_list('id', flat=True))
+
+    def create_authors(self, count: int) -> list:
+        rng = self.rng
+        ids = []
+        for batch in self.get_batches(count):
+            ids += [author.id for author in Author.objects.bulk_create([
+                Author(
+                    name=f'{rng.choice(SURNAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(PATRONYMICS)}',
+                    info=f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}' if rng.random() < 0.3 else '',
+                )
+                for _ in batch
+            ])]
+        self.stdout.write(f'Авторов: {len(ids)}')
+        return ids
+
+    def create_artworks(self, count: int, authors: list, genres: list) -> list:
+        rng = self.rng
+        author_weights = get_cum_weights(len(authors), skew=0.8)
+        genre_weights = get_cum_weights(len(genres), skew=1.0)
+        ids = []
+        for batch in self.get_batches(count):
+            with transaction.atomic():
+                objs = Artworks.objects.bulk_create([
+                    Artworks(
+                        name=self.get_title(),
+                        date=str(rng.randint(1800, 2023)),
+                        file=f'book/generated-{i}.epub',
+                    )
+                    for i in batch
+                ])
+                Artworks.author.through.objects.bulk_create([
+                    Artworks.author.through(artworks_id=obj.id, author_id=author_id)
+                    for obj in objs
+                    for author_id in set(rng.choices(authors, cum_weights=author_weights, k=rng.choice((1, 1, 1, 2))))
+                ])
+                Artworks.genres.through.objects.bulk_create([
+                    Artworks.genres.through(artworks_id=obj.id, genre_id=genre_id)
+                    for obj in objs
+                    for genre_id in set(rng.choices(genres, cum_weights=genre_weights, k=rng.randint(1, 3)))
+                ])
+            ids += [obj.id for obj in objs]
+        self.stdout.write(f'Произведений: {len(ids)}')
+        return ids
+
+    def get_title(self) -> str:
+        rng = self.rng
+        title = f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}'
+        if rng.random() < 0.5:
+            title = f'{title} и {rng.choice(NOUNS)}'
+        if rng.random() < 0.2:
+            title = f'{title}. Книга {rng.randint(1, 5)}'
+        return title
+
+    def create_users(self, count: int) -> list:
+        password = make_password(PASSWORD)
+        offset = CustomUser.objects.count()
+        ids = []
+        for batch in self.get_batches(count):
+            with transaction.atomic():
+                users = CustomUser.objects.bulk_create([
+                    CustomUser(email=f'reader{offset + i}@example.com', password=password)
+                    for i in batch
+                ])
+                Settings.objects.bulk_create([Settings(user=user) for user in users])
+            ids += [user.id for user in users]
+        self.stdout.write(f'Пользователей: {len(ids)} (пароль {PASSWORD})')
+        return ids
+
+    def create_book_states(self, count: int, users: list, artworks: list) -> int:
+        """
+        Списки чтения: кол-во книг у пользователя и популярность книг неравномерны
+        """
+        rng = self.rng
+        book_weights = get_cum_weights(len(artworks), skew=0.7)
+        average = count / len(users) if users else 0
+        created = 0
+        for batch in self.get_batches(len(users)):
+            objs = []
+            for user_id in (users[i] for i in batch):
+                size = min(len(artworks), int(rng.expovariate(1 / average)) + 1) if average else 0
+                for book_id in set(rng.choices(artworks, cum_weights=book_weights, k=size)):
+                    percent = rng.choice((0, rng.randint(1, 99), rng.randint(1, 99), 100))
+                    objs.append(BookState(
+                        user_id=user_id,
+                        book_id=book_id,
+                        epubcfi=f'epubcfi(/6/{rng.randint(1, 40) * 2}!/4/2)',
+                        percent=percent,
+                        show=percent != 100,
+                    ))
+            with transaction.atomic():
+                BookState.objects.bulk_create(objs, batch_size=self.batch_size)
+            created += len(objs)
+        # auto_now выставляет одно время всем записям, даты разносятся на год назад
+        BookState.objects.filter(user_id__gte=min(users, default=0)).update(
+            date_update=RawSQL("now() - random() * interval '365 days'", []),
+        )
+        self.stdout.write(f'Книг в списках чтения: {created}')
+        return created
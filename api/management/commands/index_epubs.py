@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Artworks
+from api.tasks import index_epubs
+
+
+class Command(BaseCommand):
+    help = 'Построение индексов EPUB (spine, оглавление, смещения в zip) для книг без индекса'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Перестроить индексы всех книг')
+
+    def handle(self, *args, **options):
+        book_ids = list(Artworks.objects.values_list('id', flat=True)) if options['all'] else None
+        count = index_epubs(book_ids=book_ids)
+        self.stdout.write(self.style.SUCCESS(f'Построено индексов: {count}'))
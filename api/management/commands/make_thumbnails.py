@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Artworks, Author
+from api.tasks import make_author_thumbnails, make_covers
+
+
+class Command(BaseCommand):
+    help = 'Миниатюры фотографий авторов и обложки книг для записей без миниатюр'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Пересоздать миниатюры всех авторов и книг')
+
+    def handle(self, *args, **options):
+        authors = Author.objects.exclude(photo='')
+        if not options['all']:
+            authors = authors.filter(thumbnails={})
+        author_ids = list(authors.values_list('id', flat=True))
+        for author_id in author_ids:
+            make_author_thumbnails(author_id)
+        book_ids = list(Artworks.objects.values_list('id', flat=True)) if options['all'] else None
+        count = make_covers(book_ids=book_ids)
+        self.stdout.write(self.style.SUCCESS(f'Авторов: {len(author_ids)}, обложек: {count}'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Artworks
+from api.tasks import optimize_epubs
+
+
+class Command(BaseCommand):
+    help = 'Оптимизация EPUB (сжатие, уменьшение картинок, удаление лишних ресурсов) для книг без копии'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Пересоздать копии всех книг')
+
+    def handle(self, *args, **options):
+        book_ids = list(Artworks.objects.values_list('id', flat=True)) if options['all'] else None
+        count = optimize_epubs(book_ids=book_ids)
+        self.stdout.write(self.style.SUCCESS(f'Оптимизировано книг: {count}'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.models import AuthorStats
+
+
+class Command(BaseCommand):
+    help = 'Полный пересчет статистики авторов (всего произведений и кол-во по жанрам)'
+
+    def handle(self, *args, **options):
+        count = AuthorStats.objects.refresh()
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано авторов: {count}'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from api.cache import bump_catalog_version
+from api.models import FacetCounter
+
+
+class Command(BaseCommand):
+    help = 'Полный пересчет счетчиков фасетов (буквы авторов, года, жанры)'
+
+    def handle(self, *args, **options):
+        count = FacetCounter.objects.rebuild()
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано счетчиков: {count}'))
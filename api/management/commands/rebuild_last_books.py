@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.models import LastBookByAuthor
+
+
+class Command(BaseCommand):
+    help = 'Полный пересчет последних книг пользователей по авторам'
+
+    def handle(self, *args, **options):
+        LastBookByAuthor.objects.refresh()
+        self.stdout.write(self.style.SUCCESS(f'Записей: {LastBookByAuthor.objects.count()}'))
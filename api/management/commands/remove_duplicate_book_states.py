@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.models import BookState
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаление повторных состояний книг (user, book), остается последнее обновленное. '
+        'Запускается до migrate: запрос не зависит от новых полей модели'
+    )
+
+    def handle(self, *args, **options):
+        table = BookState._meta.db_table
+        if table not in connection.introspection.table_names():
+            self.stdout.write('Таблицы состояний книг еще нет')
+            return
+        table = connection.ops.quote_name(table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {table} state USING {table} newer '
+                f'WHERE newer.user_id = state.user_id AND newer.book_id = state.book_id '
+                f'AND (newer.date_update > state.date_update '
+                f'OR (newer.date_update = state.date_update AND newer.id > state.id))'
+            )
+            deleted = cursor.rowcount
+        self.stdout.write(self.style.SUCCESS(f'Удалено состояний: {deleted}'))
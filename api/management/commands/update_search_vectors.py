@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from api.cache import bump_catalog_version
+from api.models import Artworks, Author
+
+
+class Command(BaseCommand):
+    help = 'Пересчет поисковых векторов у авторов и произведений'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--missing', action='store_true',
+            help='Только записи без вектора (созданные до появления поиска)',
+        )
+
+    def handle(self, *args, **options):
+        authors, artworks = Author.objects.all(), Artworks.objects.all()
+        if options['missing']:
+            authors = authors.filter(search_vector__isnull=True)
+            artworks = artworks.filter(search_vector__isnull=True)
+        authors = authors.update_search_vector()
+        artworks = artworks.update_search_vector()
+        if authors or artworks:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'Обновлено авторов: {authors}, произведений: {artworks}'))
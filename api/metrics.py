@@ -0,0 +1,144 @@
+import logging
+import os
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry,
+                               Histogram, generate_latest, multiprocess)
+from rest_framework.serializers import BaseSerializer
+
+logger = logging.getLogger(__name__)
+
+LABELS = ('view', 'method')
+
+REQUEST_TIME = Histogram(
+    'http_request_duration_seconds', 'Время обработки запроса', LABELS + ('status',),
+)
+DB_QUERIES = Histogram(
+    'http_request_db_queries', 'Кол-во SQL запросов за запрос', LABELS,
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, float('inf')),
+)
+DB_TIME = Histogram(
+    'http_request_db_duration_seconds', 'Время SQL запросов за запрос', LABELS,
+)
+SERIALIZER_TIME = Histogram(
+    'http_request_serializer_duration_seconds', 'Время сериализации DRF за запрос', LABELS,
+)
+
+# Замеры текущего запроса, нужны сериализаторам, которые не видят middleware
+current_recorder = ContextVar('current_recorder', default=None)
+
+
+class RequestRecorder:
+    """
+    Замеры одного запроса: SQL (как execute_wrapper) и время сериализации
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            self.statements[sql] += 1
+
+    def get_top_statement(self) -> tuple:
+        """
+        Самый частый SQL запрос (без параметров) и кол-во его повторов, повторы указывают на N+1
+        """
+        if not self.statements:
+            return None, 0
+        return self.statements.most_common(1)[0]
+
+
+def instrument_serializers():
+    """
+    Замер BaseSerializer.data: в нем выполняется to_representation всех сериализаторов DRF.
+    Вложенные сериализаторы учитываются в самом внешнем
+    """
+    data = BaseSerializer.data
+
+    def timed_data(serializer):
+        recorder = current_recorder.get()
+        if recorder is None:
+            return data.fget(serializer)
+        recorder.serializer_depth += 1
+        start = time.perf_counter()
+        try:
+            return data.fget(serializer)
+        finally:
+            recorder.serializer_depth -= 1
+            if not recorder.serializer_depth:
+                recorder.serializer_time += time.perf_counter() - start
+
+    BaseSerializer.data = property(timed_data)
+
+
+def get_view_name(request) -> str:
+    """
+    Имя url, а без него - шаблон пути, чтобы не плодить метки по id
+    """
+    match = request.resolver_match
+    if match is None:
+        return 'unresolved'
+    return match.url_name or match.route
+
+
+class MetricsMiddleware:
+    """
+    Метрики запроса по имени url: время, кол-во и время SQL, время сериализации.
+    Запросы дольше SLOW_REQUEST_TIME пишутся в лог с самым частым SQL запросом
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = RequestRecorder()
+        token = current_recorder.set(recorder)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(recorder):
+                response = self.get_response(request)
+        finally:
+            current_recorder.reset(token)
+        duration = time.perf_counter() - start
+
+        view = get_view_name(request)
+        REQUEST_TIME.labels(view, request.method, response.status_code).observe(duration)
+        DB_QUERIES.labels(view, request.method).observe(recorder.queries)
+        DB_TIME.labels(view, request.method).observe(recorder.db_time)
+        SERIALIZER_TIME.labels(view, request.method).observe(recorder.serializer_time)
+
+        if duration >= settings.SLOW_REQUEST_TIME:
+            statement, repeats = recorder.get_top_statement()
+            logger.warning(
+                'Slow request %s %s (%s): %.3fs, %d queries, db %.3fs, serializer %.3fs, top SQL x%d: %s',
+                request.method, request.path, view, duration, recorder.queries, recorder.db_time,
+                recorder.serializer_time, repeats, statement,
+            )
+        return response
+
+
+def metrics_view(request):
+    """
+    Метрики в формате Prometheus. С PROMETHEUS_MULTIPROC_DIR собираются со всех воркеров gunicorn
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -1,8 +1,19 @@
+import re
+
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import AbstractUser, Group, PermissionsMixin
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector, SearchVectorField,
+                                            TrigramSimilarity)
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.files.storage import default_storage
+from django.db import connection, models, transaction
+from django.db.models.functions import Greatest, Substr
 from django.utils import timezone
 
+from api.custom_class.epub import Epub
 from api.validate import validate_percent
 
 
@@ -113,10 +124,62 @@ class Genre(models.Model):
     name = models.CharField('Название', max_length=150, unique=True)
 
 
+class SearchQuerySet(models.QuerySet):
+    """
+    Полнотекстовый поиск по name, name_en и info (русская и английская конфигурации)
+    с допуском опечаток через pg_trgm
+    """
+    SEARCH_FIELDS = ('name', 'name_en', 'info')
+
+    def update_search_vector(self):
+        """
+        Пересчет поискового вектора у всех записей queryset
+        """
+        return self.update(
+            search_vector=(
+                SearchVector('name', config='russian', weight='A')
+                + SearchVector('name', config='english', weight='A')
+                + SearchVector('name_en', config='english', weight='A')
+                + SearchVector('info', config='russian', weight='C')
+            )
+        )
+
+    def search(self, value: str):
+        """
+        Поиск с ранжированием, результат аннотирован полем rank
+        :param value: Строка поиска, если пустая - возвращаются все записи
+        """
+        if not value:
+            return self.annotate(rank=models.Value(0.0, output_field=models.FloatField()))
+        query = (
+            SearchQuery(value, config='russian', search_type='websearch')
+            | SearchQuery(value, config='english', search_type='websearch')
+        )
+        return self.annotate(
+            rank=SearchRank(models.F('search_vector'), query) + Greatest(
+                TrigramSimilarity('name', value),
+                TrigramSimilarity('name_en', value),
+            ),
+        ).filter(
+            models.Q(search_vector=query)
+            # ~* (iregex) поддерживается индексом gin_trgm_ops, в отличие от UPPER(name) LIKE у icontains
+            | models.Q(name__iregex=re.escape(value))
+            | models.Q(name__trigram_similar=value)
+            | models.Q(name_en__trigram_similar=value)
+        )
+
+
 class Author(models.Model):
     class Meta:
         verbose_name = 'Авторы'
         verbose_name_plural = 'Автор'
+        indexes = (
+            GinIndex(fields=('search_vector',), name='author_search_vector_idx'),
+            GinIndex(fields=('name',), name='author_name_trgm_idx', opclasses=('gin_trgm_ops',)),
+            GinIndex(fields=('name_en',), name='author_name_en_trgm_idx', opclasses=('gin_trgm_ops',)),
+            # name__startswith (FilterAuthor)
+            models.Index(fields=('name',), name='author_name_prefix_idx', opclasses=('varchar_pattern_ops',)),
+        )
 
     def __str__(self):
         return f'{self.name}'
@@ -128,18 +191,63 @@ class Author(models.Model):
     date_death = models.DateField('Дата смерти', null=True, blank=True)
 
     photo = models.ImageField('Фотография', upload_to='photo_author', blank=True)
+    # Размер -> {формат: имя файла}, создаются в Celery (api.tasks.make_author_thumbnails)
+    thumbnails = models.JSONField('Миниатюры', default=dict, blank=True, editable=False)
 
     info = models.TextField('Информация', blank=True)
 
+    search_vector = SearchVectorField('Поисковый вектор', null=True, editable=False)
+
+    objects = SearchQuerySet.as_manager()
+
+
+class ArtworksQuerySet(SearchQuerySet):
+    def with_authors_genres(self):
+        """
+        Подгрузка авторов и жанров (только id и name) отдельными запросами на весь queryset
+        """
+        return self.prefetch_related(
+            models.Prefetch('author', queryset=Author.objects.only('id', 'name')),
+            models.Prefetch('genres', queryset=Genre.objects.only('id', 'name')),
+        )
+
 
 class Artworks(models.Model):
     class Meta:
         verbose_name = 'Произведения'
         verbose_name_plural = 'Произведение'
+        indexes = (
+            GinIndex(fields=('search_vector',), name='artworks_search_vector_idx'),
+            GinIndex(fields=('name',), name='artworks_name_trgm_idx', opclasses=('gin_trgm_ops',)),
+            GinIndex(fields=('name_en',), name='artworks_name_en_trgm_idx', opclasses=('gin_trgm_ops',)),
+            # name__startswith (FilterArtworks)
+            models.Index(fields=('name',), name='artworks_name_prefix_idx', opclasses=('varchar_pattern_ops',)),
+            # date=year (FilterYearArtworks)
+            models.Index(fields=('date',), name='artworks_date_idx'),
+        )
 
     def __str__(self):
         return f'{self.name}'
 
+    def get_file_name(self) -> str:
+        """
+        Имя файла книги в хранилище. Загрузка каталога сохраняет путь вместе с MEDIA_URL (/media/book/...)
+        """
+        name = self.file.name or ''
+        if name.startswith(settings.MEDIA_URL):
+            name = name[len(settings.MEDIA_URL):]
+        return name
+
+    def get_read_file_name(self) -> str:
+        """
+        Файл для чтения: оптимизированная копия, если она есть, иначе исходный файл
+        """
+        try:
+            optimization = self.epub_optimization
+        except ObjectDoesNotExist:
+            return self.get_file_name()
+        return optimization.file.name or self.get_file_name()
+
     author = models.ManyToManyField(Author)
 
     name = models.CharField('Название', max_length=400)
@@ -151,11 +259,18 @@ class Artworks(models.Model):
     field_2 = models.CharField('Поле 2', max_length=150, blank=True)
 
     file = models.FileField('Файл книги', upload_to='book/', max_length=400)
+    # Обложка из EPUB и ее миниатюры, создаются в Celery (api.tasks.make_cover)
+    cover = models.ImageField('Обложка', upload_to='cover/', max_length=400, blank=True, editable=False)
+    thumbnails = models.JSONField('Миниатюры обложки', default=dict, blank=True, editable=False)
 
     info = models.TextField('Информация о книге', blank=True)
 
     genres = models.ManyToManyField(Genre, blank=True)
 
+    search_vector = SearchVectorField('Поисковый вектор', null=True, editable=False)
+
+    objects = ArtworksQuerySet.as_manager()
+
 
 class Status(models.TextChoices):
     NEW = 'NEW', 'Новая'
@@ -183,10 +298,76 @@ class Feedback(models.Model):
     )
 
 
+class BookStateManager(models.Manager):
+    def reading_list(self, user: int):
+        """
+        Список для чтения пользователя: книга одним JOIN, авторы одним запросом на страницу.
+        Сортировка (-date_update, -id) совпадает с курсором и индексом book_state_user_show_date_idx
+        :param user: id пользователя
+        """
+        return self.filter(user=user, show=True).select_related('book').prefetch_related(
+            models.Prefetch('book__author', queryset=Author.objects.only('id', 'name')),
+        ).order_by('-date_update', '-id')
+
+    def upsert(self, user: int, book: int, epubcfi: str, percent: int, show: bool = True):
+        """
+        Создание или обновление состояния книги одним запросом (INSERT ... ON CONFLICT DO UPDATE)
+        :param user: id пользователя
+        :param book: id книги
+        :param epubcfi: Место остановки
+        :param percent: Процент прочтения
+        :param show: Показывать в списке для чтения
+        :return: BookState или None, если книги нет
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        artworks = connection.ops.quote_name(Artworks._meta.db_table)
+        last_book = connection.ops.quote_name(LastBookByAuthor._meta.db_table)
+        artworks_author = connection.ops.quote_name(Artworks.author.through._meta.db_table)
+        date_update = timezone.now()
+        with connection.cursor() as cursor:
+            # Последняя книга по каждому автору книги обновляется в том же запросе
+            cursor.execute(
+                f'WITH state AS ('
+                f'INSERT INTO {table} (user_id, book_id, epubcfi, percent, show, date_update) '
+                f'SELECT %s, id, %s, %s, %s, %s FROM {artworks} WHERE id = %s '
+                f'ON CONFLICT (user_id, book_id) DO UPDATE SET '
+                f'epubcfi = EXCLUDED.epubcfi, percent = EXCLUDED.percent, '
+                f'show = EXCLUDED.show, date_update = EXCLUDED.date_update '
+                f'RETURNING id, user_id, book_id, percent, date_update'
+                f'), last_book AS ('
+                f'INSERT INTO {last_book} (user_id, author_id, book_id, percent, date_update) '
+                f'SELECT state.user_id, link.author_id, state.book_id, state.percent, state.date_update '
+                f'FROM state JOIN {artworks_author} link ON link.artworks_id = state.book_id '
+                f'ON CONFLICT (user_id, author_id) DO UPDATE SET '
+                f'book_id = EXCLUDED.book_id, percent = EXCLUDED.percent, date_update = EXCLUDED.date_update'
+                f') SELECT id FROM state',
+                [user, epubcfi, percent, show, date_update, book],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return self.model(
+            id=row[0],
+            user_id=user,
+            book_id=book,
+            epubcfi=epubcfi,
+            percent=percent,
+            show=show,
+            date_update=date_update,
+        )
+
+
 class BookState(models.Model):
     class Meta:
         verbose_name = 'Состояния книг'
         verbose_name_plural = 'Состояние книги'
+        constraints = (
+            models.UniqueConstraint(fields=('user', 'book'), name='book_state_user_book_uniq'),
+        )
+        indexes = (
+            # Список для чтения: user + show, курсор по (-date_update, -id) (ListBookState)
+            models.Index(fields=('user', 'show', '-date_update', '-id'), name='book_state_user_show_date_idx'),
+        )
 
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     book = models.ForeignKey(Artworks, on_delete=models.CASCADE)
@@ -196,3 +377,350 @@ class BookState(models.Model):
     show = models.BooleanField('Показывать', default=True)
 
     date_update = models.DateTimeField('Дата обновления', auto_now=True)
+
+    objects = BookStateManager()
+
+
+class ImportStatus(models.TextChoices):
+    NEW = 'NEW', 'Новая'
+    PROCESSING = 'PROCESSING', 'В обработке'
+    DONE = 'DONE', 'Завершена'
+    FAILED = 'FAILED', 'Ошибка'
+
+
+class ImportJob(models.Model):
+    """
+    Загрузка каталога из Excel, строки обрабатываются пачками (ImportChunk) в Celery
+    """
+    class Meta:
+        verbose_name = 'Загрузки каталога'
+        verbose_name_plural = 'Загрузка каталога'
+
+    def __str__(self):
+        return f'{self.file.name}: {self.status}'
+
+    file = models.FileField('Файл', upload_to='imports/', max_length=400)
+    status = models.CharField(
+        'Статус',
+        max_length=10,
+        choices=ImportStatus.choices,
+        default=ImportStatus.NEW,
+    )
+    chunk_size = models.IntegerField('Строк в пачке', default=1000)
+    total_rows = models.IntegerField('Всего строк', default=0)
+    created_rows = models.IntegerField('Создано произведений', default=0)
+    skipped_rows = models.IntegerField('Пропущено строк', default=0)
+    error = models.TextField('Ошибка', blank=True)
+
+    date_create = models.DateTimeField('Дата создания', auto_now_add=True)
+    date_update = models.DateTimeField('Дата обновления', auto_now=True)
+
+
+class ImportChunk(models.Model):
+    """
+    Пачка строк загрузки, хранит очищенные строки до обработки
+    """
+    class Meta:
+        verbose_name = 'Пачки загрузки'
+        verbose_name_plural = 'Пачка загрузки'
+        constraints = (
+            models.UniqueConstraint(fields=('job', 'index'), name='import_chunk_job_index_uniq'),
+        )
+
+    def __str__(self):
+        return f'{self.job_id}-{self.index}: {self.status}'
+
+    job = models.ForeignKey(ImportJob, on_delete=models.CASCADE, related_name='chunks')
+    index = models.IntegerField('Номер пачки')
+    rows = models.JSONField('Строки', default=list, blank=True)
+    row_count = models.IntegerField('Кол-во строк', default=0)
+    status = models.CharField(
+        'Статус',
+        max_length=10,
+        choices=ImportStatus.choices,
+        default=ImportStatus.NEW,
+    )
+    created_rows = models.IntegerField('Создано произведений', default=0)
+    created_books = models.JSONField('id созданных произведений', default=list, blank=True)
+    skipped_rows = models.IntegerField('Пропущено строк', default=0)
+    error = models.TextField('Ошибка', blank=True)
+
+    date_update = models.DateTimeField('Дата обновления', auto_now=True)
+
+
+class Facet(models.TextChoices):
+    AUTHOR_LETTER = 'AUTHOR_LETTER', 'Первая буква автора'
+    YEAR = 'YEAR', 'Год написания'
+    GENRE = 'GENRE', 'Жанр'
+
+
+class FacetCounterManager(models.Manager):
+    def increment(self, facet: str, value: str, delta: int = 1):
+        """
+        Атомарное изменение счетчика, строка создается при отсутствии
+        :param facet: Фасет из Facet
+        :param value: Значение фасета (буква, год, название жанра)
+        :param delta: На сколько изменить счетчик
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (facet, value, count) VALUES (%s, %s, %s) '
+                f'ON CONFLICT (facet, value) DO UPDATE SET count = {table}.count + EXCLUDED.count',
+                [facet, value, delta],
+            )
+
+    def rebuild(self) -> int:
+        """
+        Полный пересчет всех счетчиков
+        :return: Кол-во созданных строк
+        """
+        letters = Author.objects.annotate(
+            letter=Substr('name', 1, 1),
+        ).values_list('letter').annotate(count=models.Count('id')).order_by()
+        years = Artworks.objects.values_list('date').annotate(count=models.Count('id')).order_by()
+        genres = Genre.objects.annotate(count=models.Count('artworks')).values_list('name', 'count')
+
+        with transaction.atomic():
+            # Пересчет при старте запускают несколько контейнеров сразу, второй ждет первого.
+            # Блокировка до подсчета, чтобы сигналы не изменили каталог между подсчетом и записью
+            with connection.cursor() as cursor:
+                cursor.execute(f'LOCK TABLE {connection.ops.quote_name(self.model._meta.db_table)} IN EXCLUSIVE MODE')
+            counters = [
+                self.model(facet=facet, value=value, count=count)
+                for facet, rows in ((Facet.AUTHOR_LETTER, letters), (Facet.YEAR, years), (Facet.GENRE, genres))
+                for value, count in rows
+                if value
+            ]
+            self.all().delete()
+            self.bulk_create(counters)
+        return len(counters)
+
+
+class FacetCounter(models.Model):
+    """
+    Счетчики для фильтров: первые буквы авторов, года и жанры произведений.
+    Поддерживаются сигналами, полный пересчет - manage.py rebuild_facets
+    """
+    class Meta:
+        verbose_name = 'Счетчики фасетов'
+        verbose_name_plural = 'Счетчик фасета'
+        constraints = (
+            models.UniqueConstraint(fields=('facet', 'value'), name='facet_counter_facet_value_uniq'),
+        )
+
+    def __str__(self):
+        return f'{self.facet}: {self.value}'
+
+    facet = models.CharField('Фасет', max_length=20, choices=Facet.choices)
+    value = models.CharField('Значение', max_length=150)
+    count = models.IntegerField('Количество', default=0)
+
+    objects = FacetCounterManager()
+
+
+class AuthorStatsManager(models.Manager):
+    def refresh(self, authors=None) -> int:
+        """
+        Пересчет статистики авторов: всего произведений и кол-во по жанрам
+        :param authors: id авторов, None - все авторы
+        :return: Кол-во пересчитанных строк
+        """
+        queryset = Author.objects.all()
+        if authors is not None:
+            queryset = queryset.filter(id__in=set(authors))
+        stats = {
+            author: self.model(author_id=author, total=0, genres=[], date_update=timezone.now())
+            for author in queryset.values_list('id', flat=True)
+        }
+        if not stats:
+            return 0
+        totals = Artworks.author.through.objects.filter(author__in=stats).values_list('author').annotate(
+            count=models.Count('artworks'),
+        ).order_by()
+        for author, count in totals:
+            stats[author].total = count
+        # Произведения без жанра группируются с id = None, как и раньше в AuthorDetailSerializer
+        genres = Artworks.objects.filter(author__in=stats).values_list(
+            'author', 'genres__id', 'genres__name',
+        ).annotate(count=models.Count('id')).order_by('author', 'genres__name')
+        for author, genre_id, genre_name, count in genres:
+            stats[author].genres.append({'id': genre_id, 'name': genre_name, 'count': count})
+        self.bulk_create(
+            stats.values(),
+            update_conflicts=True,
+            unique_fields=('author',),
+            update_fields=('total', 'genres', 'date_update'),
+        )
+        return len(stats)
+
+
+class AuthorStats(models.Model):
+    """
+    Статистика автора для страницы автора (GetAuthor).
+    Поддерживается сигналами, полный пересчет - manage.py rebuild_author_stats
+    """
+    class Meta:
+        verbose_name = 'Статистика авторов'
+        verbose_name_plural = 'Статистика автора'
+
+    def __str__(self):
+        return f'{self.author_id}: {self.total}'
+
+    author = models.OneToOneField(Author, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    total = models.IntegerField('Всего произведений', default=0)
+    genres = models.JSONField('Кол-во по жанрам', default=list)
+
+    date_update = models.DateTimeField('Дата обновления', auto_now=True)
+
+    objects = AuthorStatsManager()
+
+
+class LastBookByAuthorManager(models.Manager):
+    def refresh(self, users=None, authors=None):
+        """
+        Пересчет последней книги по автору из BookState (после массовой записи или изменения каталога)
+        :param users: id пользователей, None - все пользователи
+        :param authors: id авторов, None - все авторы
+        """
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        book_state = connection.ops.quote_name(BookState._meta.db_table)
+        artworks_author = connection.ops.quote_name(Artworks.author.through._meta.db_table)
+        where, params = ['TRUE'], []
+        if users is not None:
+            where.append('user_id = ANY(%s)')
+            params.append(list(users))
+        if authors is not None:
+            where.append('author_id = ANY(%s)')
+            params.append(list(authors))
+        where = ' AND '.join(where)
+        with transaction.atomic(), connection.cursor() as cursor:
+            if users is None and authors is None:
+                # Полный пересчет при старте запускают несколько контейнеров сразу, второй ждет первого
+                cursor.execute(f'LOCK TABLE {table} IN EXCLUSIVE MODE')
+            cursor.execute(f'DELETE FROM {table} WHERE {where}', params)
+            cursor.execute(
+                f'INSERT INTO {table} (user_id, author_id, book_id, percent, date_update) '
+                f'SELECT DISTINCT ON (user_id, author_id) user_id, author_id, book_id, percent, date_update '
+                f'FROM {book_state} state JOIN {artworks_author} link ON link.artworks_id = state.book_id '
+                f'WHERE {where} '
+                f'ORDER BY user_id, author_id, date_update DESC, state.id DESC',
+                params,
+            )
+
+    def continue_reading(self, user: int):
+        """
+        Продолжить чтение по авторам: автор и книга одним запросом, сортировка (-date_update, -id)
+        :param user: id пользователя
+        """
+        return self.filter(user=user).select_related('author', 'book').only(
+            'percent', 'date_update', 'author__name', 'book__name',
+        ).order_by('-date_update', '-id')
+
+
+class LastBookByAuthor(models.Model):
+    """
+    Последняя читаемая книга пользователя по каждому автору.
+    Обновляется вместе с BookState, полный пересчет - manage.py rebuild_last_books
+    """
+    class Meta:
+        verbose_name = 'Последние книги по авторам'
+        verbose_name_plural = 'Последняя книга по автору'
+        constraints = (
+            models.UniqueConstraint(fields=('user', 'author'), name='last_book_user_author_uniq'),
+        )
+        indexes = (
+            models.Index(fields=('user', '-date_update', '-id'), name='last_book_user_date_idx'),
+        )
+
+    def __str__(self):
+        return f'{self.user_id}: {self.author_id} - {self.book_id}'
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    author = models.ForeignKey(Author, on_delete=models.CASCADE)
+    book = models.ForeignKey(Artworks, on_delete=models.CASCADE)
+    percent = models.IntegerField('Статус чтения', validators=(validate_percent,))
+
+    date_update = models.DateTimeField('Дата обновления')
+
+    objects = LastBookByAuthorManager()
+
+
+class EpubIndexManager(models.Manager):
+    def build(self, book: Artworks):
+        """
+        Разбор EPUB книги и сохранение индекса
+        :param book: Произведение
+        :return: EpubIndex
+        """
+        name = book.get_read_file_name()
+        with default_storage.open(name, 'rb') as file:
+            index = Epub(file).build_index()
+        obj, _ = self.update_or_create(
+            book=book,
+            defaults={'file': name, 'file_size': default_storage.size(name), **index},
+        )
+        return obj
+
+    def get_actual(self, book: Artworks):
+        """
+        Индекс книги, перестраивается, если файл заменен (другое имя или размер)
+        :param book: Произведение, лучше с select_related('epub_index', 'epub_optimization')
+        :return: EpubIndex
+        """
+        try:
+            index = book.epub_index
+        except self.model.DoesNotExist:
+            return self.build(book)
+        name = book.get_read_file_name()
+        if index.file != name or index.file_size != default_storage.size(name):
+            return self.build(book)
+        return index
+
+
+class EpubIndex(models.Model):
+    """
+    Структура EPUB: ресурсы со смещениями внутри zip, spine и оглавление.
+    Строится один раз (Celery после загрузки каталога или при первом запросе главы)
+    """
+    class Meta:
+        verbose_name = 'Индексы EPUB'
+        verbose_name_plural = 'Индекс EPUB'
+
+    def __str__(self):
+        return f'{self.file}'
+
+    book = models.OneToOneField(Artworks, on_delete=models.CASCADE, primary_key=True, related_name='epub_index')
+    file = models.CharField('Файл', max_length=400)
+    file_size = models.BigIntegerField('Размер файла')
+    opf = models.CharField('Путь к OPF', max_length=400)
+    items = models.JSONField('Ресурсы', default=dict)
+    spine = models.JSONField('Порядок чтения', default=list)
+    toc = models.JSONField('Оглавление', default=list)
+
+    date_update = models.DateTimeField('Дата обновления', auto_now=True)
+
+    objects = EpubIndexManager()
+
+
+class EpubOptimization(models.Model):
+    """
+    Оптимизированная копия EPUB (Celery, api.tasks.optimize_epub).
+    Если копия не меньше исходного файла или EPUB не разобран (error), file пустой и читается исходный файл
+    """
+    class Meta:
+        verbose_name = 'Оптимизации EPUB'
+        verbose_name_plural = 'Оптимизация EPUB'
+
+    def __str__(self):
+        return f'{self.book_id}: {self.original_size} -> {self.optimized_size}'
+
+    book = models.OneToOneField(Artworks, on_delete=models.CASCADE, primary_key=True, related_name='epub_optimization')
+    file = models.FileField('Оптимизированный файл', upload_to='book/optimized/', max_length=400, blank=True)
+    original_size = models.BigIntegerField('Исходный размер')
+    optimized_size = models.BigIntegerField('Размер после оптимизации')
+    removed_items = models.JSONField('Удаленные ресурсы', default=list)
+    images = models.IntegerField('Пересжато картинок', default=0)
+    error = models.TextField('Ошибка разбора EPUB', blank=True)
+
+    date_update = models.DateTimeField('Дата обновления', auto_now=True)
@@ -0,0 +1,148 @@
+import json
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from api.models import Artworks, BookState, LastBookByAuthor
+
+DIRTY_KEY = 'progress:dirty'
+VERSION_FIELD = 'version'
+
+# Срок хранения ключа пользователя, только если ни одна его книга не ждет переноса в базу
+EXPIRE_SCRIPT = """
+for _, book in ipairs(redis.call('HKEYS', KEYS[1])) do
+    if book ~= ARGV[1] and redis.call('SISMEMBER', KEYS[2], ARGV[2] .. ':' .. book) == 1 then
+        return 0
+    end
+end
+return redis.call('EXPIRE', KEYS[1], ARGV[3])
+"""
+
+
+def get_redis():
+    return get_redis_connection(settings.READING_PROGRESS_CACHE_ALIAS)
+
+
+def is_buffered() -> bool:
+    """
+    Включен ли режим отложенной записи прогресса чтения (READING_PROGRESS_BUFFER)
+    """
+    return settings.READING_PROGRESS_BUFFER
+
+
+def get_user_key(user: int) -> str:
+    return f'progress:user:{user}'
+
+
+def buffer_progress(user: int, book: int, epubcfi: str, percent: int) -> float:
+    """
+    Сохранение прогресса в Redis, в базу он попадет при flush_progress.
+    Хэш пользователя хранит последние значения по книгам и используется при чтении,
+    до переноса в базу он не истекает
+    :return: Время записи в буфер (timestamp)
+    """
+    key = get_user_key(user)
+    updated = time.time()
+    value = json.dumps({'epubcfi': epubcfi, 'percent': percent, 'time': updated})
+    pipe = get_redis().pipeline(transaction=True)
+    pipe.hset(key, str(book), value)
+    pipe.hincrby(key, VERSION_FIELD, 1)
+    pipe.persist(key)
+    pipe.sadd(DIRTY_KEY, f'{user}:{book}')
+    pipe.execute()
+    return updated
+
+
+def get_buffered_progress(user: int | None) -> dict:
+    """
+    Прогресс пользователя из буфера
+    :return: Словарь id книги -> {'epubcfi', 'percent', 'time'}
+    """
+    if user is None or not is_buffered():
+        return {}
+    values = get_redis().hgetall(get_user_key(user))
+    return {
+        int(book): json.loads(value)
+        for book, value in values.items()
+        if book != VERSION_FIELD.encode()
+    }
+
+
+def get_buffer_version(user: int | None) -> int:
+    """
+    Счетчик записей пользователя в буфер, нужен для ETag списка для чтения
+    """
+    if user is None or not is_buffered():
+        return 0
+    return int(get_redis().hget(get_user_key(user), VERSION_FIELD) or 0)
+
+
+def flush_progress(batch_size: int = 1000) -> int:
+    """
+    Перенос измененного прогресса из буфера в базу пачками.
+    При ошибке записи ключи возвращаются в множество измененных, после записи ключам пользователей ставится срок
+    :return: Кол-во записанных состояний
+    """
+    redis = get_redis()
+    expire = redis.register_script(EXPIRE_SCRIPT)
+    flushed = 0
+    while members := redis.spop(DIRTY_KEY, batch_size):
+        pairs = [tuple(int(el) for el in member.decode().split(':')) for member in members]
+        pipe = redis.pipeline(transaction=False)
+        for user, book in pairs:
+            pipe.hget(get_user_key(user), str(book))
+        progress = {
+            pair: json.loads(value)
+            for pair, value in zip(pairs, pipe.execute())
+            if value is not None
+        }
+        try:
+            flushed += save_progress(progress=progress)
+        except Exception:
+            redis.sadd(DIRTY_KEY, *members)
+            raise
+        pipe = redis.pipeline(transaction=False)
+        for user in {user for user, _ in pairs}:
+            expire(
+                keys=[get_user_key(user), DIRTY_KEY],
+                args=[VERSION_FIELD, user, settings.READING_PROGRESS_BUFFER_TTL],
+                client=pipe,
+            )
+        pipe.execute()
+    return flushed
+
+
+def save_progress(progress: dict) -> int:
+    """
+    Запись прогресса в BookState одним INSERT ... ON CONFLICT DO UPDATE и пересчет последних книг по авторам
+    :param progress: (user, book) -> {'epubcfi', 'percent'}
+    :return: Кол-во записанных состояний
+    """
+    books = set(Artworks.objects.filter(id__in={book for _, book in progress}).values_list('id', flat=True))
+    progress = {(user, book): value for (user, book), value in progress.items() if book in books}
+    if not progress:
+        return 0
+
+    BookState.objects.bulk_create(
+        [
+            BookState(
+                user_id=user,
+                book_id=book,
+                epubcfi=value['epubcfi'],
+                percent=value['percent'],
+                show=value['percent'] != 100,
+            )
+            for (user, book), value in progress.items()
+        ],
+        update_conflicts=True,
+        unique_fields=('user', 'book'),
+        update_fields=('epubcfi', 'percent', 'show', 'date_update'),
+    )
+    LastBookByAuthor.objects.refresh(
+        users={user for user, _ in progress},
+        authors=Artworks.author.through.objects.filter(
+            artworks__in={book for _, book in progress},
+        ).values_list('author', flat=True).distinct(),
+    )
+    return len(progress)
@@ -1,21 +1,58 @@
+from django.contrib.auth.models import update_last_login
 from django.contrib.auth.password_validation import validate_password
 from django.core import exceptions as django_exceptions
 from django.db import IntegrityError, transaction
-from django.db.models import Count
-from django.shortcuts import get_object_or_404
+from django.db.models import Count, Q, Sum
+from django.urls import reverse
 from djoser.conf import settings
 from drf_yasg import openapi
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
 
-from api.models import Artworks, Author, BookState, Feedback, Genre, Settings
+from api.custom_class.parce import ImportFileError, ParseXML
+from api.custom_class.thumbnails import get_thumbnail_urls
+from api.models import (Artworks, Author, AuthorStats, BookState, Feedback,
+                        Genre, ImportJob, ImportStatus, LastBookByAuthor,
+                        Settings)
 
 from .models import CustomUser as User
 
 
+class ThumbnailsField(serializers.Field):
+    """
+    Адреса миниатюр: {размер: {webp, jpeg}}
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return get_thumbnail_urls(value or {})
+
+
+class DownloadUrlField(serializers.Field):
+    """
+    Адрес скачивания книги (api/book/<pk>/download/) вместо файла: /media/book/ nginx напрямую не отдает.
+    Адрес относительный, данные каталога кэшируются без запроса
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        kwargs['source'] = 'id'
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return reverse('book-download', kwargs={'pk': value})
+
+
 class AuthorSerializer(serializers.ModelSerializer):
+    thumbnails = ThumbnailsField()
+
     class Meta:
         model = Author
-        fields = '__all__'
+        exclude = ('search_vector',)
 
 
 class GenreSerializer(serializers.ModelSerializer):
@@ -24,55 +61,64 @@ class GenreSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class AuthorForCategorySerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=150)
+    id = serializers.IntegerField(read_only=True)
+
+
+class GenreForCategorySerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=150)
+    id = serializers.IntegerField(read_only=True)
+
+
 class ArtworksSerializer(serializers.ModelSerializer):
+    """
+    Произведение с авторами и жанрами [{'name', 'id'}].
+    Queryset должен быть подготовлен через Artworks.objects.with_authors_genres()
+    """
+    author = AuthorForCategorySerializer(many=True, read_only=True)
+    genres = GenreForCategorySerializer(many=True, read_only=True)
+    file = DownloadUrlField()
+    thumbnails = ThumbnailsField()
+
     class Meta:
         model = Artworks
-        fields = '__all__'
-
-    def to_representation(self, instance):
-        """
-        Дополнение жанрами
-        :param instance:
-        :return:
-        """
-        data = super().to_representation(instance)
-        list_genres = [{'name': get_object_or_404(Genre, id=el).name, 'id': el} for el in data['genres']]
-        data['genres'] = list_genres
-        list_author = [{'name': get_object_or_404(Author, id=pk).name, 'id': pk} for pk in data['author']]
-        data['author'] = list_author
-        return data
+        fields = (
+            'id', 'name', 'name_en', 'date', 'field_1', 'field_2', 'file', 'info', 'author', 'genres', 'cover',
+            'thumbnails',
+        )
 
 
 class ArtworksWithoutAuthorSerializer(serializers.ModelSerializer):
+    file = DownloadUrlField()
+
     class Meta:
         model = Artworks
         fields = ('id', 'name', 'date', 'file', 'info',)
 
 
 class AuthorDetailSerializer(serializers.ModelSerializer):
+    """
+    Автор со статистикой из AuthorStats.
+    Queryset должен быть подготовлен через select_related('stats')
+    """
+    thumbnails = ThumbnailsField()
+
     class Meta:
         model = Author
-        fields = '__all__'
+        exclude = ('search_vector',)
 
     def get_genres(self, instance):
-        artworks = Artworks.objects.filter(author=instance).select_related('genres')
-        genre_counts = artworks.values('genres__id', 'genres__name').annotate(count=Count('id'))
-        result = {
-            'all': artworks.count(),
-            'genres': []
+        try:
+            stats = instance.stats
+        except AuthorStats.DoesNotExist:
+            # Автор создан до появления статистики
+            AuthorStats.objects.refresh(authors=[instance.pk])
+            stats = AuthorStats.objects.get(author=instance)
+        return {
+            'all': stats.total,
+            'genres': stats.genres,
         }
-        for genre_count in genre_counts:
-            genre_id = genre_count['genres__id']
-            genre_name = genre_count['genres__name']
-            count = genre_count['count']
-            result['genres'].append(
-                {
-                    'id': genre_id,
-                    'name': genre_name,
-                    'count': count
-                }
-            )
-        return result
 
     def to_representation(self, instance):
         """
@@ -158,6 +204,26 @@ class UserCreateSerializer(serializers.ModelSerializer):
         return user
 
 
+class UserStateTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Access-токен с состоянием пользователя (is_active, is_suspended).
+    В refresh-токен состояние не пишется: access-токены, выданные по нему позже, не наследуют
+    устаревшее состояние и проверяются по актуальным данным пользователя
+    """
+
+    def validate(self, attrs):
+        data = super(TokenObtainPairSerializer, self).validate(attrs)
+        refresh = self.get_token(self.user)
+        access = refresh.access_token
+        access['is_active'] = self.user.is_active
+        access['is_suspended'] = self.user.is_suspended
+        data['refresh'] = str(refresh)
+        data['access'] = str(access)
+        if jwt_settings.UPDATE_LAST_LOGIN:
+            update_last_login(None, self.user)
+        return data
+
+
 class FeedbackSerializer(serializers.ModelSerializer):
     class Meta:
         model = Feedback
@@ -168,12 +234,8 @@ class BookStateSerializer(serializers.ModelSerializer):
     class Meta:
         model = BookState
         fields = ('user', 'epubcfi', 'percent', 'book')
-
-    def validate(self, data):
-        if BookState.objects.filter(user=data.get('user')).exists() and BookState.objects.filter(
-                book=data.get('book')).exists():
-            raise serializers.ValidationError("Книга уже в списке для чтения")
-        return data
+        # Пользователь берется из запроса, а не из тела
+        read_only_fields = ('user',)
 
 
 class UpdateBookStateSerializer(serializers.ModelSerializer):
@@ -189,6 +251,23 @@ class UpdateBookStateSerializer(serializers.ModelSerializer):
         return super().update(instance, validated_data)
 
 
+class BookForCategorySerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=400)
+    id = serializers.IntegerField(read_only=True)
+
+
+class LastBookByAuthorSerializer(serializers.ModelSerializer):
+    """
+    Queryset должен быть подготовлен через LastBookByAuthor.objects.continue_reading()
+    """
+    author = AuthorForCategorySerializer(read_only=True)
+    book = BookForCategorySerializer(read_only=True)
+
+    class Meta:
+        model = LastBookByAuthor
+        fields = ('author', 'book', 'percent', 'date_update')
+
+
 class ListBookStateSerializer(serializers.ModelSerializer):
     class Meta:
         model = BookState
@@ -196,14 +275,14 @@ class ListBookStateSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         """
-        Дополнение жанрами
+        Дополнение названием книги и авторами.
+        Queryset должен быть подготовлен через BookState.objects.reading_list()
         :param instance:
         :return:
         """
         data = super().to_representation(instance)
-        artworks = get_object_or_404(Artworks, id=data.get('book'))
-        data['name'] = artworks.name
-        data['author'] = artworks.author.all().values_list('name', flat=True)
+        data['name'] = instance.book.name
+        data['author'] = [author.name for author in instance.book.author.all()]
         return data
 
 
@@ -308,24 +387,16 @@ class SearchSerializer(serializers.Serializer):
     artworks = ForSearchSerializer()
 
 
-class AuthorForCategorySerializer(serializers.Serializer):
-    name = serializers.CharField(max_length=150)
-    id = serializers.IntegerField(read_only=True)
-
-
-class GenreForCategorySerializer(serializers.Serializer):
-    name = serializers.CharField(max_length=150)
-    id = serializers.IntegerField(read_only=True)
-
-
 class YearArtworksSerializer(serializers.ModelSerializer):
     read = serializers.IntegerField(allow_null=True, help_text='Возвращает проценты или null')
     author = AuthorForCategorySerializer(many=True)
     genres = GenreForCategorySerializer(many=True)
+    file = DownloadUrlField()
+    thumbnails = ThumbnailsField()
 
     class Meta:
         model = Artworks
-        fields = '__all__'
+        exclude = ('search_vector',)
 
 
 class FeedBackSerializer(serializers.ModelSerializer):
@@ -345,10 +416,70 @@ class BookSerializer(serializers.Serializer):
     author = NameSerializer(many=True)
 
 
+class BookPageSerializer(serializers.Serializer):
+    """
+    Страница списка для чтения (CursorPaginationApiView)
+    """
+    limit = serializers.IntegerField(help_text='Лимит страницы')
+    next = serializers.CharField(allow_null=True, help_text='Курсор следующей страницы, null - страница последняя')
+    items = BookSerializer(many=True)
+
+
+class ContinueReadingPageSerializer(serializers.Serializer):
+    """
+    Страница "продолжить чтение" (CursorPaginationApiView)
+    """
+    limit = serializers.IntegerField(help_text='Лимит страницы')
+    next = serializers.CharField(allow_null=True, help_text='Курсор следующей страницы, null - страница последняя')
+    items = LastBookByAuthorSerializer(many=True)
+
+
 class BookGetSerializer(serializers.Serializer):
-    file = serializers.FileField()
+    file = serializers.URLField(help_text='Адрес скачивания книги')
+    epubcfi = serializers.CharField(max_length=150)
+    percent = serializers.IntegerField(max_value=100, min_value=0)
+
+
+class ProgressSerializer(serializers.Serializer):
     epubcfi = serializers.CharField(max_length=150)
     percent = serializers.IntegerField(max_value=100, min_value=0)
 
+
 class CreateSerializer(serializers.Serializer):
-    file = serializers.FileField()
\ No newline at end of file
+    file = serializers.FileField()
+
+    def validate_file(self, value):
+        """
+        Лист и столбцы проверяются сразу, а не в задаче загрузки
+        """
+        try:
+            ParseXML.check_file(value)
+        except ImportFileError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ImportJob
+        fields = (
+            'id', 'status', 'total_rows', 'created_rows', 'skipped_rows', 'error', 'date_create', 'date_update',
+        )
+
+    def to_representation(self, instance):
+        """
+        Дополнение прогрессом по пачкам
+        :param instance:
+        :return:
+        """
+        data = super().to_representation(instance)
+        chunks = instance.chunks.aggregate(
+            total=Count('id'),
+            done=Count('id', filter=Q(status=ImportStatus.DONE)),
+            failed=Count('id', filter=Q(status=ImportStatus.FAILED)),
+            processed_rows=Sum('row_count', filter=Q(status=ImportStatus.DONE)),
+        )
+        chunks['processed_rows'] = chunks['processed_rows'] or 0
+        data['chunks'] = chunks
+        data['percent'] = int(chunks['processed_rows'] * 100 / instance.total_rows) if instance.total_rows else 0
+        return data
@@ -0,0 +1,235 @@
+from django.db import connection
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+from django.dispatch import receiver
+
+from api.authentication import invalidate_user
+from api.cache import bump_catalog_version
+from api.models import (Artworks, Author, AuthorStats, CustomUser, Facet,
+                        FacetCounter, Genre, LastBookByAuthor,
+                        SearchQuerySet)
+
+# Модель -> (фасет, поле, получение значения фасета из поля)
+FACETS = {
+    Author: (Facet.AUTHOR_LETTER, 'name', lambda name: name[:1]),
+    Artworks: (Facet.YEAR, 'date', lambda date: date),
+    Genre: (Facet.GENRE, 'name', lambda name: name),
+}
+
+
+def create_extensions(**kwargs):
+    """
+    Подключение расширений PostgreSQL до применения миграций,
+    индексы gin_trgm_ops требуют pg_trgm
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Artworks)
+def update_search_vector(sender, instance, update_fields=None, **kwargs):
+    """
+    Пересчет поискового вектора после сохранения автора или произведения
+    """
+    if update_fields is not None and not set(update_fields) & set(SearchQuerySet.SEARCH_FIELDS):
+        return
+    sender.objects.filter(pk=instance.pk).update_search_vector()
+
+
+def increment_facet(facet: str, value: str | None, delta: int):
+    if value and delta:
+        FacetCounter.objects.increment(facet=facet, value=value, delta=delta)
+
+
+@receiver(pre_save, sender=Author)
+@receiver(pre_save, sender=Artworks)
+@receiver(pre_save, sender=Genre)
+def remember_facet_value(sender, instance, **kwargs):
+    """
+    Запоминает сохраненное в базе значение, чтобы после изменения перенести счетчик
+    """
+    _, field, to_value = FACETS[sender]
+    instance._facet_old = None
+    if not instance._state.adding:
+        old = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+        instance._facet_old = to_value(old) if old is not None else None
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Artworks)
+def update_facet(sender, instance, created, **kwargs):
+    facet, field, to_value = FACETS[sender]
+    old_value = getattr(instance, '_facet_old', None)
+    new_value = to_value(getattr(instance, field))
+    if created or old_value != new_value:
+        increment_facet(facet=facet, value=old_value, delta=-1)
+        increment_facet(facet=facet, value=new_value, delta=1)
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Artworks)
+def delete_facet(sender, instance, **kwargs):
+    facet, field, to_value = FACETS[sender]
+    increment_facet(facet=facet, value=to_value(getattr(instance, field)), delta=-1)
+
+
+@receiver(post_save, sender=Genre)
+def update_genre_facet(sender, instance, created, **kwargs):
+    """
+    Жанр выводится в списке и без произведений, поэтому строка счетчика создается сразу
+    """
+    old_value = getattr(instance, '_facet_old', None)
+    if created:
+        FacetCounter.objects.get_or_create(facet=Facet.GENRE, value=instance.name)
+    elif old_value is not None and old_value != instance.name:
+        FacetCounter.objects.filter(facet=Facet.GENRE, value=old_value).update(value=instance.name)
+
+
+@receiver(post_delete, sender=Genre)
+def delete_genre_facet(sender, instance, **kwargs):
+    FacetCounter.objects.filter(facet=Facet.GENRE, value=instance.name).delete()
+
+
+@receiver(pre_delete, sender=Artworks)
+def delete_artwork_genres_facet(sender, instance, **kwargs):
+    """
+    Связи с жанрами удаляются каскадом без m2m_changed
+    """
+    for name in instance.genres.values_list('name', flat=True):
+        increment_facet(facet=Facet.GENRE, value=name, delta=-1)
+
+
+@receiver(m2m_changed, sender=Artworks.genres.through)
+def update_artwork_genres_facet(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Счетчик жанров при изменении связей, с обеих сторон (artwork.genres и genre.artworks_set)
+    """
+    if action == 'pre_clear':
+        if reverse:
+            increment_facet(facet=Facet.GENRE, value=instance.name, delta=-instance.artworks_set.count())
+        else:
+            for name in instance.genres.values_list('name', flat=True):
+                increment_facet(facet=Facet.GENRE, value=name, delta=-1)
+    elif action in ('post_add', 'post_remove') and pk_set:
+        delta = 1 if action == 'post_add' else -1
+        if reverse:
+            increment_facet(facet=Facet.GENRE, value=instance.name, delta=delta * len(pk_set))
+        else:
+            for name in model.objects.filter(pk__in=pk_set).values_list('name', flat=True):
+                increment_facet(facet=Facet.GENRE, value=name, delta=delta)
+
+
+@receiver(post_save, sender=Author)
+def create_author_stats(sender, instance, created, **kwargs):
+    if created:
+        AuthorStats.objects.refresh(authors=[instance.pk])
+
+
+@receiver(pre_delete, sender=Artworks)
+@receiver(pre_delete, sender=Genre)
+def remember_stats_authors(sender, instance, **kwargs):
+    """
+    Связи удаляются каскадом без m2m_changed, авторы запоминаются до удаления
+    """
+    if sender is Artworks:
+        queryset = instance.author.all()
+    else:
+        queryset = Author.objects.filter(artworks__genres=instance)
+    instance._stats_authors = set(queryset.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Artworks)
+@receiver(post_delete, sender=Genre)
+def delete_author_stats(sender, instance, **kwargs):
+    authors = getattr(instance, '_stats_authors', ())
+    AuthorStats.objects.refresh(authors=authors)
+    if sender is Artworks:
+        # Последняя книга удаляется каскадом, на ее место встает предыдущая книга автора
+        LastBookByAuthor.objects.refresh(authors=authors)
+
+
+@receiver(post_save, sender=Genre)
+def rename_author_stats(sender, instance, created, **kwargs):
+    """
+    Название жанра хранится в статистике
+    """
+    old_value = getattr(instance, '_facet_old', None)
+    if not created and old_value is not None and old_value != instance.name:
+        authors = Author.objects.filter(artworks__genres=instance).values_list('id', flat=True)
+        AuthorStats.objects.refresh(authors=authors)
+
+
+@receiver(m2m_changed, sender=Artworks.author.through)
+@receiver(m2m_changed, sender=Artworks.genres.through)
+def update_author_stats(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Статистика авторов при изменении связей произведений с авторами и жанрами, с обеих сторон
+    """
+    if action == 'pre_clear':
+        instance._stats_authors = get_stats_authors(sender=sender, instance=instance, reverse=reverse)
+    elif action == 'post_clear':
+        AuthorStats.objects.refresh(authors=getattr(instance, '_stats_authors', ()))
+    elif action in ('post_add', 'post_remove') and pk_set:
+        AuthorStats.objects.refresh(
+            authors=get_stats_authors(sender=sender, instance=instance, reverse=reverse, pk_set=pk_set),
+        )
+
+
+@receiver(m2m_changed, sender=Artworks.author.through)
+def update_last_books(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    Последние книги по авторам при изменении авторов произведения.
+    Авторы для clear запоминаются в update_author_stats
+    """
+    if action == 'post_clear':
+        LastBookByAuthor.objects.refresh(authors=getattr(instance, '_stats_authors', ()))
+    elif action in ('post_add', 'post_remove') and pk_set:
+        LastBookByAuthor.objects.refresh(
+            authors=get_stats_authors(sender=sender, instance=instance, reverse=reverse, pk_set=pk_set),
+        )
+
+
+def get_stats_authors(sender, instance, reverse: bool, pk_set=None) -> set:
+    """
+    Авторы, статистику которых затрагивает изменение связей
+    :param sender: Промежуточная модель Artworks.author или Artworks.genres
+    :param instance: Сторона, через которую меняются связи
+    :param reverse: Изменение со стороны автора или жанра
+    :param pk_set: id другой стороны, None - все текущие связи
+    """
+    if sender is Artworks.author.through:
+        if reverse:
+            return {instance.pk}
+        if pk_set is not None:
+            return set(pk_set)
+        return set(instance.author.values_list('id', flat=True))
+    if reverse:
+        artworks = instance.artworks_set.all() if pk_set is None else pk_set
+        return set(Author.objects.filter(artworks__in=artworks).values_list('id', flat=True))
+    return set(instance.author.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_auth_user(sender, instance, **kwargs):
+    """
+    Смена пароля, активация и блокировка сразу видны при аутентификации
+    """
+    invalidate_user(instance.pk)
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Artworks)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Artworks)
+@receiver(post_delete, sender=Genre)
+@receiver(m2m_changed, sender=Artworks.author.through)
+@receiver(m2m_changed, sender=Artworks.genres.through)
+def invalidate_catalog_cache(sender, **kwargs):
+    """
+    Любое изменение каталога сбрасывает кэш каталога
+    """
+    if kwargs.get('action', 'post_').startswith('post_'):
+        bump_catalog_version()
@@ -0,0 +1,311 @@
+import os
+import tempfile
+from itertools import islice
+from smtplib import SMTPException
+
+from celery import chord, group
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Sum
+
+from Book_backend import celery_app as app
+from api.cache import bump_catalog_version
+from api.custom_class.parce import ParseXML
+from api.custom_class.epub import Epub, EpubError
+from api.custom_class.thumbnails import delete_thumbnails, make_thumbnails
+from api.mail import send_queued
+from api.models import (Artworks, Author, AuthorStats, EpubIndex,
+                        EpubOptimization, FacetCounter, ImportChunk,
+                        ImportJob, ImportStatus)
+from api.progress import flush_progress, is_buffered
+
+
+@app.task(ignore_result=True)
+def start_import_job(job_id: int):
+    """
+    Разбивка файла на пачки и запуск их параллельной обработки.
+    Повторный запуск обрабатывает только незавершенные пачки
+    """
+    job = ImportJob.objects.get(id=job_id)
+    if job.status == ImportStatus.DONE:
+        return
+    job.status = ImportStatus.PROCESSING
+    job.error = ''
+    job.save(update_fields=['status', 'error', 'date_update'])
+
+    if not job.chunks.exists():
+        try:
+            split_import_job(job=job)
+        except Exception as e:
+            job.status = ImportStatus.FAILED
+            job.error = str(e)
+            job.save(update_fields=['status', 'error', 'date_update'])
+            return
+
+    chunks = list(job.chunks.exclude(status=ImportStatus.DONE).values_list('id', flat=True))
+    if not chunks:
+        finish_import_job.delay(job_id)
+        return
+    chord(import_chunk.si(chunk_id) for chunk_id in chunks)(finish_import_job.si(job_id))
+
+
+def split_import_job(job: ImportJob):
+    """
+    Потоковое чтение файла и сохранение строк пачками, все пачки создаются в одной транзакции
+    """
+    parser = ParseXML(file_path=job.file.path)
+    rows = parser.iter_rows()
+    total = 0
+    with transaction.atomic():
+        index = 0
+        while chunk := list(islice(rows, job.chunk_size)):
+            # Уникальность (job, index) защищает от дублей при одновременном запуске
+            ImportChunk.objects.bulk_create(
+                [
+                    ImportChunk(
+                        job=job,
+                        index=index,
+                        rows=[parser.clean_row(row) for row in chunk],
+                        row_count=len(chunk),
+                    )
+                ],
+                ignore_conflicts=True,
+            )
+            total += len(chunk)
+            index += 1
+        job.total_rows = total
+        job.save(update_fields=['total_rows', 'date_update'])
+
+
+@app.task
+def import_chunk(chunk_id: int):
+    """
+    Импорт одной пачки. Статус пачки меняется в той же транзакции, что и данные,
+    поэтому завершенная пачка не импортируется повторно
+    """
+    try:
+        with transaction.atomic():
+            chunk = ImportChunk.objects.select_for_update(skip_locked=True).filter(
+                id=chunk_id,
+            ).exclude(status=ImportStatus.DONE).first()
+            if chunk is None:
+                return
+            created = ParseXML.import_rows(rows=chunk.rows)
+            chunk.status = ImportStatus.DONE
+            chunk.created_rows = len(created)
+            chunk.created_books = created
+            chunk.skipped_rows = chunk.row_count - len(created)
+            chunk.error = ''
+            chunk.rows = []
+            chunk.save()
+    except Exception as e:
+        ImportChunk.objects.filter(id=chunk_id).update(status=ImportStatus.FAILED, error=str(e))
+
+
+@app.task(ignore_result=True)
+def finish_import_job(job_id: int):
+    """
+    Подсчет итогов загрузки, пересчет счетчиков и сброс кэша каталога.
+    Оптимизация и обложки созданных загрузкой книг - отдельные задачи на каждую книгу,
+    обложки читаются из исходного файла и не ждут оптимизации
+    """
+    job = ImportJob.objects.get(id=job_id)
+    totals = job.chunks.aggregate(created=Sum('created_rows'), skipped=Sum('skipped_rows'))
+    job.created_rows = totals['created'] or 0
+    job.skipped_rows = totals['skipped'] or 0
+    if job.chunks.exclude(status=ImportStatus.DONE).exists():
+        job.status = ImportStatus.FAILED
+        job.error = 'Не все пачки обработаны, загрузку можно продолжить'
+    else:
+        job.status = ImportStatus.DONE
+    job.save()
+    FacetCounter.objects.rebuild()
+    AuthorStats.objects.refresh()
+    bump_catalog_version()
+    book_ids = [book_id for books in job.chunks.values_list('created_books', flat=True) for book_id in books]
+    # При продолжении загрузки уже обработанные книги пропускаются
+    books = Artworks.objects.filter(id__in=book_ids).exclude(file='')
+    optimize = list(books.filter(epub_optimization__isnull=True).values_list('id', flat=True))
+    covers = list(books.filter(cover='').values_list('id', flat=True))
+    if optimize:
+        group(optimize_epub.si(book_id) for book_id in optimize).delay()
+    if covers:
+        group(make_cover.si(book_id) for book_id in covers).delay()
+
+
+@app.task(ignore_result=True)
+def index_epubs(book_ids: list | None = None) -> int:
+    """
+    Построение индексов EPUB для книг без индекса или для переданных книг.
+    Книги без файла или с поврежденным файлом пропускаются
+    :return: Кол-во построенных индексов
+    """
+    books = Artworks.objects.exclude(file='')
+    if book_ids is None:
+        books = books.filter(epub_index__isnull=True)
+    else:
+        books = books.filter(id__in=book_ids)
+    built = 0
+    for book in books.only('id', 'file').iterator():
+        try:
+            EpubIndex.objects.build(book)
+        except (EpubError, OSError):
+            continue
+        built += 1
+    return built
+
+
+@app.task(ignore_result=True)
+def optimize_epub(book_id: int) -> bool:
+    """
+    Оптимизированная копия EPUB книги, после нее индекс строится по копии.
+    Ошибка разбора EPUB сохраняется в EpubOptimization.error, такая книга больше не выбирается
+    для оптимизации (кроме optimize_epubs --all) и читается из исходного файла
+    :return: Создана ли копия без ошибок
+    """
+    book = Artworks.objects.only('id', 'file').get(id=book_id)
+    name = book.get_file_name()
+    optimization = EpubOptimization.objects.filter(book=book).first() or EpubOptimization(book=book)
+    optimization.original_size = default_storage.size(name)
+    with tempfile.TemporaryFile() as target:
+        try:
+            with default_storage.open(name, 'rb') as source:
+                stats = Epub(source).optimize(
+                    target,
+                    max_image_size=settings.EPUB_IMAGE_MAX_SIZE,
+                    jpeg_quality=settings.EPUB_JPEG_QUALITY,
+                )
+        except EpubError as e:
+            # Копия не сохраняется, книга читается из исходного файла
+            stats = {'removed': [], 'images': 0}
+            optimization.error = str(e)
+            optimization.optimized_size = optimization.original_size
+        else:
+            optimization.error = ''
+            optimization.optimized_size = target.seek(0, os.SEEK_END)
+        optimization.removed_items = stats['removed']
+        optimization.images = stats['images']
+        if optimization.file:
+            optimization.file.delete(save=False)
+        if optimization.optimized_size < optimization.original_size:
+            target.seek(0)
+            optimization.file.save(os.path.basename(name), File(target), save=False)
+    optimization.save()
+    if optimization.error:
+        return False
+    book.epub_optimization = optimization
+    EpubIndex.objects.build(book)
+    return True
+
+
+@app.task(ignore_result=True)
+def optimize_epubs(book_ids: list | None = None) -> int:
+    """
+    Оптимизация EPUB книг без оптимизированной копии или переданных книг.
+    Книги без файла или с поврежденным файлом пропускаются
+    :return: Кол-во оптимизированных книг
+    """
+    books = Artworks.objects.exclude(file='')
+    if book_ids is None:
+        books = books.filter(epub_optimization__isnull=True)
+    else:
+        books = books.filter(id__in=book_ids)
+    optimized = 0
+    for book_id in books.values_list('id', flat=True).iterator():
+        try:
+            optimized += optimize_epub(book_id)
+        except (EpubError, OSError):
+            continue
+    return optimized
+
+
+@app.task(ignore_result=True)
+def make_author_thumbnails(author_id: int):
+    """
+    Миниатюры фотографии автора, старые файлы удаляются
+    """
+    author = Author.objects.get(id=author_id)
+    old = author.thumbnails
+    author.thumbnails = {}
+    if author.photo:
+        with author.photo.open('rb') as photo:
+            author.thumbnails = make_thumbnails(
+                photo.read(),
+                prefix=f'thumbs/author/{author.id}',
+                sizes=settings.THUMBNAIL_SIZES['author'],
+            )
+    author.save(update_fields=['thumbnails'])
+    delete_thumbnails(old, keep=author.thumbnails)
+
+
+@app.task(ignore_result=True)
+def make_cover(book_id: int):
+    """
+    Обложка из метаданных EPUB (исходного файла, не оптимизированной копии) и ее миниатюры
+    """
+    book = Artworks.objects.get(id=book_id)
+    with default_storage.open(book.get_file_name(), 'rb') as file:
+        cover = Epub(file).get_cover()
+    old_cover, old_thumbnails = book.cover.name, book.thumbnails
+    book.cover, book.thumbnails = '', {}
+    if cover is not None:
+        data, media_type = cover
+        extension = media_type.split('/')[-1].replace('jpeg', 'jpg')
+        book.cover.save(f'{book.id}.{extension}', ContentFile(data), save=False)
+        book.thumbnails = make_thumbnails(
+            data,
+            prefix=f'thumbs/cover/{book.id}',
+            sizes=settings.THUMBNAIL_SIZES['cover'],
+        )
+    book.save(update_fields=['cover', 'thumbnails'])
+    if old_cover and old_cover != book.cover.name:
+        default_storage.delete(old_cover)
+    delete_thumbnails(old_thumbnails, keep=book.thumbnails)
+
+
+@app.task(ignore_result=True)
+def make_covers(book_ids: list | None = None) -> int:
+    """
+    Обложки книг без обложки или переданных книг.
+    Книги без файла или с поврежденным файлом пропускаются
+    :return: Кол-во обработанных книг
+    """
+    books = Artworks.objects.exclude(file='')
+    if book_ids is None:
+        books = books.filter(cover='')
+    else:
+        books = books.filter(id__in=book_ids)
+    made = 0
+    for book_id in books.values_list('id', flat=True).iterator():
+        try:
+            make_cover(book_id)
+        except (EpubError, OSError):
+            continue
+        made += 1
+    return made
+
+
+@app.task(bind=True, ignore_result=True, max_retries=5)
+def send_queued_emails(self):
+    """
+    Отправка очереди писем пачками по EMAIL_BATCH_SIZE, при ошибке SMTP - повтор с нарастающей задержкой.
+    Письма, оставшиеся после всех повторов, отправляет запуск из Celery beat
+    """
+    try:
+        _, left = send_queued(batch_size=settings.EMAIL_BATCH_SIZE)
+    except (SMTPException, OSError) as e:
+        raise self.retry(exc=e, countdown=2 ** self.request.retries * 10)
+    if left:
+        send_queued_emails.delay()
+
+
+@app.task(ignore_result=True)
+def flush_reading_progress():
+    """
+    Перенос прогресса чтения из буфера в базу, запускается Celery beat
+    """
+    if is_buffered():
+        flush_progress()
@@ -1,3 +1,1720 @@
-from django.test import TestCase
+import io
+import json
+import tempfile
+import zipfile
+from base64 import urlsafe_b64encode
+from datetime import timedelta
+from smtplib import SMTPRecipientsRefused, SMTPServerDisconnected
+from unittest import mock
 
-# Create your tests here.
+import openpyxl
+from django.conf import settings
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMessage
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_redis import get_redis_connection
+from PIL import Image
+from redis.exceptions import ConnectionError as RedisConnectionError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from api import benchmark
+from api.authentication import get_user_key as get_auth_user_key
+from api.authentication import invalidate_user, local_cache
+from api.benchmark import BenchmarkContext, run_benchmark
+from api.custom_class.epub import Epub, EpubError
+from api.custom_class.parce import ParseXML
+from api.models import (Artworks, Author, AuthorStats, BookState,
+                        CustomUser, EpubIndex, EpubOptimization, Facet,
+                        FacetCounter, Genre, ImportChunk, ImportJob,
+                        ImportStatus, LastBookByAuthor)
+from api.mail import QUEUE_KEY, close_connection, queue_messages, send_queued
+from api.progress import DIRTY_KEY, flush_progress, get_user_key
+from api.tasks import (finish_import_job, import_chunk, optimize_epub,
+                       optimize_epubs, send_queued_emails, split_import_job,
+                       start_import_job)
+
+
+def use_temporary_media(test: TestCase):
+    """
+    MEDIA_ROOT во временном каталоге до конца теста
+    """
+    media = tempfile.TemporaryDirectory()
+    test.addCleanup(media.cleanup)
+    settings_override = override_settings(MEDIA_ROOT=media.name)
+    settings_override.enable()
+    test.addCleanup(settings_override.disable)
+
+
+class IndexUsageTests(TestCase):
+    """
+    Горячие запросы из api/views.py должны использовать индексы, а не последовательное чтение.
+    На маленьких таблицах планировщик предпочитает Seq Scan, поэтому он отключается
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        genre = Genre.objects.create(name='Роман')
+        author = Author.objects.create(name='Толстой Лев Николаевич')
+        cls.artwork = Artworks.objects.create(name='Война и мир', date='1869', file='book/war.epub')
+        cls.artwork.author.add(author)
+        cls.artwork.genres.add(genre)
+        BookState.objects.create(user=cls.user, book=cls.artwork, epubcfi='epubcfi(/6/2)', percent=10)
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute('RESET enable_seqscan')
+
+    def assertUsesIndex(self, queryset, index: str = 'Index'):
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test_author_name_prefix(self):
+        self.assertUsesIndex(Author.objects.filter(name__startswith='Т'), 'author_name_prefix_idx')
+
+    def test_artworks_name_prefix(self):
+        self.assertUsesIndex(Artworks.objects.filter(name__startswith='В'), 'artworks_name_prefix_idx')
+
+    def test_artworks_year(self):
+        self.assertUsesIndex(Artworks.objects.filter(date='1869'), 'artworks_date_idx')
+
+    def test_reading_list(self):
+        self.assertUsesIndex(
+            BookState.objects.filter(user=self.user, show=True).order_by('-date_update', '-id'),
+            'book_state_user_show_date_idx',
+        )
+
+    def test_book_state_by_user_and_book(self):
+        # У читателя много книг, у книги много читателей: индексы внешних ключей
+        # user и book менее избирательны, чем (user, book)
+        books = Artworks.objects.bulk_create([
+            Artworks(name=f'Книга {i}', date='1900', file=f'book/{i}.epub') for i in range(500)
+        ])
+        users = CustomUser.objects.bulk_create([CustomUser(email=f'reader{i}@example.com') for i in range(500)])
+        BookState.objects.bulk_create([
+            BookState(user=self.user, book=book, epubcfi='epubcfi(/6/2)', percent=0) for book in books
+        ] + [
+            BookState(user=user, book=self.artwork, epubcfi='epubcfi(/6/2)', percent=0) for user in users
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {BookState._meta.db_table}')
+        self.assertUsesIndex(BookState.objects.filter(user=self.user, book=self.artwork), 'book_state_user_book_uniq')
+
+    def test_artworks_search(self):
+        # Все ветви OR (вектор, подстрока, похожесть) покрываются GIN индексами: BitmapOr без Seq Scan
+        plan = Artworks.objects.search('Карени').explain()
+        for index in ('artworks_search_vector_idx', 'artworks_name_trgm_idx', 'artworks_name_en_trgm_idx'):
+            self.assertIn(index, plan)
+        self.assertNotIn('Seq Scan', plan)
+
+    def test_artworks_by_genre_name(self):
+        # уникальный индекс Genre.name и индекс genre_id промежуточной таблицы
+        self.assertUsesIndex(Artworks.objects.filter(genres__name='Роман'), 'api_artworks_genres_genre_id')
+
+
+@override_settings(THROTTLE_BUCKETS={'search': {'capacity': 10, 'rate': 0.01}})
+class ThrottleTests(TestCase):
+    """
+    Token bucket поиска: пустой общий поиск списывает FULL_SEARCH_COST, поиск по значению - 1
+    """
+
+    def setUp(self):
+        redis = get_redis_connection(settings.THROTTLE_CACHE_ALIAS)
+        keys = redis.keys('throttle:*')
+        if keys:
+            redis.delete(*keys)
+
+    def test_full_search_cost(self):
+        self.assertEqual(self.client.get('/api/search/').status_code, 200)
+        response = self.client.get('/api/search/')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+
+    def test_value_search_cost(self):
+        for _ in range(10):
+            self.assertEqual(self.client.get('/api/search/', {'value': 'мир'}).status_code, 200)
+        self.assertEqual(self.client.get('/api/search/', {'value': 'мир'}).status_code, 429)
+
+    def test_bucket_per_user(self):
+        self.assertEqual(self.client.get('/api/search/').status_code, 200)
+        user = CustomUser.objects.create_user('reader@example.com', 'password')
+        client = APIClient()
+        client.force_authenticate(user)
+        self.assertEqual(client.get('/api/search/').status_code, 200)
+        self.assertEqual(self.client.get('/api/search/').status_code, 429)
+
+    def test_spoofed_forwarded_for(self):
+        # nginx дописывает адрес клиента в конец X-Forwarded-For, присланные клиентом адреса не учитываются
+        self.assertEqual(self.client.get('/api/search/', HTTP_X_FORWARDED_FOR='10.0.0.1, 203.0.113.7').status_code, 200)
+        for spoofed in ('10.0.0.2', '10.0.0.3, 10.0.0.4'):
+            response = self.client.get('/api/search/', HTTP_X_FORWARDED_FOR=f'{spoofed}, 203.0.113.7')
+            self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.client.get('/api/search/', HTTP_X_FORWARDED_FOR='203.0.113.8').status_code, 200)
+
+    def test_redis_unavailable(self):
+        with mock.patch('api.throttling.get_script', side_effect=RedisConnectionError('down')):
+            with self.assertLogs('api.throttling', 'WARNING'):
+                self.assertEqual(self.client.get('/api/search/').status_code, 200)
+            with override_settings(THROTTLE_FAIL_OPEN=False), self.assertRaises(RedisConnectionError):
+                self.client.get('/api/search/')
+
+
+class MetricsTests(TestCase):
+    """
+    /metrics отдает гистограммы по шаблону url, если у него нет имени
+    """
+
+    def test_request_metrics(self):
+        self.client.get('/api/search/', {'author': 'true'})
+        content = self.client.get('/metrics').content.decode()
+        self.assertIn('http_request_db_queries_count{method="GET",view="api/search/"}', content)
+        self.assertIn('http_request_serializer_duration_seconds_count{method="GET",view="api/search/"}', content)
+
+    def test_internal_host(self):
+        response = self.client.get('/metrics', HTTP_HOST='web:8000')
+        self.assertEqual(response.status_code, 200)
+
+
+class BookStateTests(TestCase):
+    """
+    Список для чтения: добавление книги (api/book-state/)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        cls.victim = CustomUser.objects.create_user('victim@example.com', 'password')
+        cls.artwork = Artworks.objects.create(name='Война и мир', date='1869', file='book/war.epub')
+        BookState.objects.create(user=cls.victim, book=cls.artwork, epubcfi='epubcfi(/6/20)', percent=70)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_create_ignores_foreign_user(self):
+        response = self.client.post('/api/book-state/', {
+            'user': self.victim.id, 'book': self.artwork.id, 'epubcfi': 'epubcfi(/6/2)', 'percent': 0,
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['user'], self.user.id)
+        victim_state = BookState.objects.get(user=self.victim, book=self.artwork)
+        self.assertEqual((victim_state.epubcfi, victim_state.percent), ('epubcfi(/6/20)', 70))
+        self.assertTrue(BookState.objects.filter(user=self.user, book=self.artwork).exists())
+
+    def test_upsert_insert(self):
+        author = Author.objects.create(name='Толстой Лев Николаевич')
+        self.artwork.author.add(author)
+        state = BookState.objects.upsert(user=self.user.id, book=self.artwork.id, epubcfi='epubcfi(/6/4)', percent=10)
+        saved = BookState.objects.get(user=self.user, book=self.artwork)
+        self.assertEqual(state.id, saved.id)
+        self.assertEqual((saved.epubcfi, saved.percent, saved.show), ('epubcfi(/6/4)', 10, True))
+        last_book = LastBookByAuthor.objects.get(user=self.user, author=author)
+        self.assertEqual((last_book.book_id, last_book.percent), (self.artwork.id, 10))
+
+    def test_upsert_update(self):
+        state = BookState.objects.get(user=self.victim, book=self.artwork)
+        updated = BookState.objects.upsert(
+            user=self.victim.id, book=self.artwork.id, epubcfi='epubcfi(/6/30)', percent=100, show=False,
+        )
+        self.assertEqual(updated.id, state.id)
+        self.assertEqual(BookState.objects.filter(user=self.victim).count(), 1)
+        state.refresh_from_db()
+        self.assertEqual((state.epubcfi, state.percent, state.show), ('epubcfi(/6/30)', 100, False))
+
+    def test_upsert_missing_book(self):
+        self.assertIsNone(BookState.objects.upsert(user=self.user.id, book=0, epubcfi='epubcfi(/6/2)', percent=0))
+        self.assertFalse(BookState.objects.filter(user=self.user).exists())
+
+    def test_remove_duplicates(self):
+        state = BookState.objects.get(user=self.victim, book=self.artwork)
+        # Повторы остались в базах, созданных до ограничения уникальности
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            cursor.execute(
+                f'ALTER TABLE {connection.ops.quote_name(BookState._meta.db_table)} '
+                f'DROP CONSTRAINT book_state_user_book_uniq'
+            )
+        newer = BookState.objects.create(user=self.victim, book=self.artwork, epubcfi='epubcfi(/6/40)', percent=90)
+        BookState.objects.create(user=self.user, book=self.artwork, epubcfi='epubcfi(/6/2)', percent=0)
+        call_command('remove_duplicate_book_states', stdout=io.StringIO())
+        self.assertFalse(BookState.objects.filter(id=state.id).exists())
+        self.assertEqual(BookState.objects.get(user=self.victim, book=self.artwork).id, newer.id)
+        self.assertTrue(BookState.objects.filter(user=self.user, book=self.artwork).exists())
+
+
+class ReadingListTests(TestCase):
+    """
+    Список для чтения страницами курсора (api/books/)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        artworks = Artworks.objects.bulk_create([
+            Artworks(name=f'Книга {i}', date='1900', file=f'book/{i}.epub') for i in range(25)
+        ])
+        BookState.objects.bulk_create([
+            BookState(user=cls.user, book=artwork, epubcfi='epubcfi(/6/2)', percent=i, show=i % 5 != 0)
+            for i, artwork in enumerate(artworks)
+        ])
+        # Одинаковое время обновления у части книг: порядок внутри решает id
+        states = list(BookState.objects.filter(user=cls.user).order_by('id'))
+        now = timezone.now()
+        for i, state in enumerate(states):
+            state.date_update = now - timedelta(minutes=i // 4)
+        BookState.objects.bulk_update(states, ['date_update'])
+        cls.expected = list(
+            BookState.objects.filter(user=cls.user, show=True).order_by('-date_update', '-id')
+            .values_list('book', flat=True)
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_cursor_round_trip(self):
+        books, cursor, pages = [], None, 0
+        while True:
+            params = {'limit': 7} | ({'cursor': cursor} if cursor else {})
+            response = self.client.get('/api/books/', params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['limit'], 7)
+            books += [el['book'] for el in response.data['items']]
+            pages += 1
+            cursor = response.data['next']
+            if cursor is None:
+                break
+        self.assertEqual(books, self.expected)
+        self.assertEqual(pages, 3)
+
+    def test_default_limit(self):
+        response = self.client.get('/api/books/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([el['book'] for el in response.data['items']], self.expected[:10])
+        self.assertIsNotNone(response.data['next'])
+
+    def test_bad_limit(self):
+        response = self.client.get('/api/books/', {'limit': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('errors', response.data)
+
+    def test_bad_cursor(self):
+        naive = urlsafe_b64encode(b'2024-01-01T00:00:00|1').decode()
+        overflow = urlsafe_b64encode(f'{timezone.now().isoformat()}|{2 ** 70}'.encode()).decode()
+        for cursor in ('abc', 'не курсор', urlsafe_b64encode(b'2024|x').decode(), naive, overflow):
+            with self.subTest(cursor=cursor):
+                response = self.client.get('/api/books/', {'cursor': cursor})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('errors', response.data)
+
+
+class ArtworksQueryTests(TestCase):
+    """
+    Авторы и жанры произведений подгружаются prefetch, кол-во запросов не зависит от кол-ва строк
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.genres = [Genre.objects.create(name=name) for name in ('Роман', 'Повесть', 'Рассказ')]
+        cls.authors = [
+            Author.objects.create(name=name) for name in ('Толстой Лев', 'Толстая Софья', 'Чехов Антон')
+        ]
+        for i in range(6):
+            artwork = Artworks.objects.create(name=f'Книга {i}', date='1900', file='book/1.epub')
+            artwork.genres.add(*cls.genres[:i % 3 + 1])
+            artwork.author.add(*cls.authors[:i % 3 + 1])
+
+    def setUp(self):
+        cache.clear()
+
+    def test_genre_list(self):
+        # Произведения, авторы и жанры
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/filter-genre-artworks/', {'genre': 'Роман'})
+        self.assertEqual(len(response.json()), 6)
+        artwork = Artworks.objects.get(name='Книга 2')
+        item = next(el for el in response.json() if el['id'] == artwork.id)
+        self.assertEqual(
+            sorted(item['genres'], key=lambda el: el['id']),
+            [{'id': genre.id, 'name': genre.name} for genre in self.genres],
+        )
+        self.assertEqual(
+            sorted(item['author'], key=lambda el: el['id']),
+            [{'id': author.id, 'name': author.name} for author in self.authors],
+        )
+
+    def test_search(self):
+        # Кол-во и страница, у произведений еще авторы и жанры
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/search/', {'author': 'true', 'value': 'Толст'})
+        self.assertEqual(response.json()['authors']['count'], 2)
+        with self.assertNumQueries(4):
+            response = self.client.get('/api/search/', {'artworks': 'true', 'value': 'Книга'})
+        self.assertEqual(response.json()['artworks']['count'], 6)
+
+
+class FillReadingListTests(TestCase):
+    """
+    Процент прочтения в списках произведений добавляется одним запросом, кол-во запросов не растет с кол-вом книг
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        cls.author = Author.objects.create(name='Толстой Лев Николаевич')
+        cls.genre = Genre.objects.create(name='Роман')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_books(self, count: int):
+        for i in range(count):
+            artwork = Artworks.objects.create(name=f'Книга {Artworks.objects.count()}', date='1900', file='book/1.epub')
+            artwork.author.add(self.author)
+            artwork.genres.add(self.genre)
+            BookState.objects.create(user=self.user, book=artwork, epubcfi='epubcfi(/6/2)', percent=i)
+
+    def get_urls(self) -> dict:
+        """
+        Адрес -> кол-во запросов при данных из кэша каталога: проценты прочтения, у автора еще последняя книга
+        """
+        return {
+            '/api/search/?artworks=true&value=Книга': 1,
+            '/api/search/?value=Книга': 1,
+            '/api/filter-artworks-first/?value=Книга': 1,
+            '/api/filter-year-artworks/?year=1900': 1,
+            '/api/filter-genre-artworks/?genre=Роман': 1,
+            f'/api/books-genre-author/?author={self.author.id}&genre={self.genre.id}': 1,
+            f'/api/author-bundle/{self.author.id}/': 2,
+        }
+
+    def count_queries(self) -> dict:
+        """
+        Кол-во запросов по адресам: без кэша каталога и с кэшем
+        """
+        counts = {}
+        for url in self.get_urls():
+            cache.clear()
+            with CaptureQueriesContext(connection) as built:
+                self.assertEqual(self.client.get(url).status_code, 200)
+            with CaptureQueriesContext(connection) as cached:
+                self.client.get(url)
+            counts[url] = (len(built), len(cached))
+        return counts
+
+    def test_queries_do_not_grow(self):
+        self.add_books(1)
+        one = self.count_queries()
+        self.add_books(19)
+        self.assertEqual(self.count_queries(), one)
+        for url, queries in self.get_urls().items():
+            with self.subTest(url=url):
+                self.assertEqual(one[url][1], queries)
+
+    def test_read_percent(self):
+        self.add_books(3)
+        percents = dict(BookState.objects.values_list('book', 'percent'))
+        data = self.client.get('/api/filter-year-artworks/', {'year': '1900'}).json()
+        self.assertEqual({el['id']: el['read'] for el in data}, percents)
+
+
+class AuthorBundleTests(TestCase):
+    """
+    Страница автора одним запросом (api/author-bundle/<pk>/)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        cls.author = Author.objects.create(name='Толстой Лев Николаевич')
+        cls.novel = Genre.objects.create(name='Роман')
+        cls.story = Genre.objects.create(name='Повесть')
+        cls.war = Artworks.objects.create(name='Война и мир', date='1869', file='book/war.epub')
+        cls.war.genres.add(cls.novel, cls.story)
+        cls.sketch = Artworks.objects.create(name='Севастопольские рассказы', date='1855', file='book/sketch.epub')
+        for artwork in (cls.war, cls.sketch):
+            artwork.author.add(cls.author)
+        BookState.objects.upsert(user=cls.user.id, book=cls.war.id, epubcfi='epubcfi(/6/2)', percent=10)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_item(self, artwork: Artworks, read: int | None) -> dict:
+        return {
+            'id': artwork.id, 'name': artwork.name, 'date': artwork.date,
+            'file': f'/api/book/{artwork.id}/download/', 'info': '', 'read': read,
+        }
+
+    def test_shape(self):
+        data = self.client.get(f'/api/author-bundle/{self.author.id}/').json()
+        self.assertEqual((data['id'], data['name']), (self.author.id, self.author.name))
+        self.assertEqual(data['genres'], [
+            {'id': self.story.id, 'name': 'Повесть', 'count': 1},
+            {'id': self.novel.id, 'name': 'Роман', 'count': 1},
+            {'id': None, 'name': None, 'count': 1},
+        ])
+        war, sketch = self.get_item(self.war, read=10), self.get_item(self.sketch, read=None)
+        self.assertEqual(data['artworks'], [
+            {'id': self.story.id, 'name': 'Повесть', 'items': [war]},
+            {'id': self.novel.id, 'name': 'Роман', 'items': [war]},
+            {'id': None, 'name': None, 'items': [sketch]},
+        ])
+        self.assertEqual(data['last'], {'id': self.war.id, 'name': self.war.name, 'percent': 10})
+
+        anonymous = APIClient().get(f'/api/author-bundle/{self.author.id}/').json()
+        self.assertIsNone(anonymous['last'])
+        self.assertEqual(anonymous['artworks'][0]['items'][0]['read'], None)
+        self.assertEqual(self.client.get(f'/api/author-bundle/{self.author.id + 100}/').status_code, 404)
+
+    def test_queries(self):
+        # Автор со статистикой, произведения, их жанры, проценты прочтения, последняя книга
+        url = f'/api/author-bundle/{self.author.id}/'
+        with self.assertNumQueries(5):
+            self.client.get(url)
+        for i in range(10):
+            artwork = Artworks.objects.create(name=f'Книга {i}', date='1900', file='book/1.epub')
+            artwork.author.add(self.author)
+            artwork.genres.add(Genre.objects.create(name=f'Жанр {i}'), self.novel)
+            BookState.objects.create(user=self.user, book=artwork, epubcfi='epubcfi(/6/2)', percent=i)
+        with self.assertNumQueries(5):
+            data = self.client.get(url).json()
+        self.assertEqual(len(data['artworks']), 13)
+        self.assertEqual(sum(len(group['items']) for group in data['artworks']), 23)
+
+
+class ContinueReadingTests(TestCase):
+    """
+    Последняя книга по автору (api/continue-reading/)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        cls.author = Author.objects.create(name='Толстой Лев Николаевич')
+        cls.first = Artworks.objects.create(name='Детство', date='1852', file='book/childhood.epub')
+        cls.second = Artworks.objects.create(name='Отрочество', date='1854', file='book/boyhood.epub')
+        cls.first.author.add(cls.author)
+        cls.second.author.add(cls.author)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def read(self, book: Artworks, percent: int):
+        BookState.objects.upsert(user=self.user.id, book=book.id, epubcfi='epubcfi(/6/2)', percent=percent)
+
+    def get_books(self) -> list:
+        response = self.client.get('/api/continue-reading/')
+        self.assertEqual(response.status_code, 200)
+        return [(el['author']['id'], el['book']['id'], el['percent']) for el in response.data['items']]
+
+    def test_upsert(self):
+        self.read(self.first, 30)
+        self.assertEqual(self.get_books(), [(self.author.id, self.first.id, 30)])
+        self.read(self.second, 5)
+        self.assertEqual(self.get_books(), [(self.author.id, self.second.id, 5)])
+        self.read(self.first, 40)
+        self.assertEqual(self.get_books(), [(self.author.id, self.first.id, 40)])
+
+    def test_delete_book(self):
+        self.read(self.first, 30)
+        self.read(self.second, 5)
+        self.second.delete()
+        self.assertEqual(self.get_books(), [(self.author.id, self.first.id, 30)])
+        self.first.delete()
+        self.assertEqual(self.get_books(), [])
+
+    def test_remove_author(self):
+        self.read(self.first, 30)
+        self.read(self.second, 5)
+        self.second.author.remove(self.author)
+        self.assertEqual(self.get_books(), [(self.author.id, self.first.id, 30)])
+
+    def test_refresh_same_date(self):
+        self.read(self.first, 30)
+        self.read(self.second, 5)
+        BookState.objects.update(date_update=timezone.now())
+        # База, заполненная до появления таблицы
+        LastBookByAuthor.objects.all().delete()
+        call_command('rebuild_last_books', stdout=io.StringIO())
+        second_state = BookState.objects.get(book=self.second)
+        self.assertEqual(self.get_books(), [(self.author.id, self.second.id, 5)])
+        self.assertEqual(LastBookByAuthor.objects.get().date_update, second_state.date_update)
+
+
+@override_settings(READING_PROGRESS_BUFFER=True)
+class ProgressBufferTests(TestCase):
+    """
+    Отложенная запись прогресса чтения (api/update-state-book/<pk>/)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        cls.author = Author.objects.create(name='Толстой Лев Николаевич')
+        cls.read = Artworks.objects.create(name='Детство', date='1852', file='book/childhood.epub')
+        cls.new = Artworks.objects.create(name='Отрочество', date='1854', file='book/boyhood.epub')
+        cls.new.author.add(cls.author)
+        BookState.objects.create(user=cls.user, book=cls.read, epubcfi='epubcfi(/6/2)', percent=10)
+
+    def setUp(self):
+        self.redis = get_redis_connection(settings.READING_PROGRESS_CACHE_ALIAS)
+        keys = self.redis.keys('progress:*')
+        if keys:
+            self.redis.delete(*keys)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def patch(self, book: int, percent: int):
+        return self.client.patch(
+            f'/api/update-state-book/{book}/', {'epubcfi': 'epubcfi(/6/4)', 'percent': percent}, format='json',
+        )
+
+    def get_books(self) -> list:
+        return [(el['book'], el['percent']) for el in self.client.get('/api/books/').data['items']]
+
+    def test_missing_book(self):
+        self.assertEqual(self.patch(0, 10).status_code, 404)
+        self.assertFalse(self.redis.exists(get_user_key(self.user.id)))
+        self.assertFalse(self.redis.exists(DIRTY_KEY))
+
+    def test_response_fields(self):
+        with self.settings(READING_PROGRESS_BUFFER=False):
+            direct = self.patch(self.read.id, 15).data
+        with self.assertNumQueries(1):
+            buffered = self.patch(self.read.id, 20).data
+        self.assertEqual(set(buffered), set(direct))
+        self.assertEqual(buffered['id'], direct['id'])
+        self.assertEqual((buffered['percent'], buffered['user'], buffered['book']), (20, self.user.id, self.read.id))
+        self.assertGreaterEqual(buffered['date_update'], direct['date_update'])
+        self.assertIsNone(self.patch(self.new.id, 20).data['id'])
+
+    def test_buffered_only_book(self):
+        self.assertEqual(self.patch(self.new.id, 20).status_code, 200)
+        self.assertFalse(BookState.objects.filter(user=self.user, book=self.new).exists())
+        response = self.client.get('/api/books/')
+        self.assertEqual(response.data['items'][0]['author'], [self.author.name])
+        self.assertEqual(self.get_books(), [(self.new.id, 20), (self.read.id, 10)])
+
+        self.assertEqual(flush_progress(), 1)
+        self.assertEqual(BookState.objects.get(user=self.user, book=self.new).percent, 20)
+        self.assertEqual(self.get_books(), [(self.new.id, 20), (self.read.id, 10)])
+
+    def test_buffered_finished_book(self):
+        self.patch(self.new.id, 100)
+        self.assertEqual(self.get_books(), [(self.read.id, 10)])
+
+    def test_expire_after_flush(self):
+        key = get_user_key(self.user.id)
+        self.patch(self.read.id, 30)
+        self.patch(self.new.id, 40)
+        self.assertEqual(self.redis.ttl(key), -1)
+        with mock.patch('api.progress.save_progress', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                flush_progress()
+        self.assertEqual(self.redis.ttl(key), -1)
+        self.assertEqual(self.redis.scard(DIRTY_KEY), 2)
+
+        self.assertEqual(flush_progress(batch_size=1), 2)
+        self.assertGreater(self.redis.ttl(key), 0)
+        self.patch(self.read.id, 50)
+        self.assertEqual(self.redis.ttl(key), -1)
+
+    def test_keep_dirty_key(self):
+        key = get_user_key(self.user.id)
+        self.patch(self.read.id, 30)
+        self.patch(self.new.id, 40)
+        # Первая пачка записана, вторая еще ждет переноса: срок ключу не ставится
+        batches = [self.redis.spop(DIRTY_KEY, 1), []]
+        with mock.patch.object(self.redis, 'spop', side_effect=batches):
+            with mock.patch('api.progress.get_redis', return_value=self.redis):
+                self.assertEqual(flush_progress(batch_size=1), 1)
+        self.assertEqual(self.redis.ttl(key), -1)
+        self.assertEqual(self.redis.scard(DIRTY_KEY), 1)
+
+    def test_cache_alias(self):
+        caches = settings.CACHES | {'progress': settings.CACHES[settings.READING_PROGRESS_CACHE_ALIAS]}
+        with override_settings(CACHES=caches, READING_PROGRESS_CACHE_ALIAS='progress'):
+            with mock.patch('api.progress.get_redis_connection', wraps=get_redis_connection) as connection:
+                self.patch(self.new.id, 20)
+        connection.assert_called_with('progress')
+
+
+@override_settings(EMAIL_DELIVERY_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class MailQueueTests(TestCase):
+    """
+    Очередь писем в Redis и отправка пачками (api.mail)
+    """
+
+    def setUp(self):
+        self.redis = get_redis_connection(settings.EMAIL_QUEUE_CACHE_ALIAS)
+        self.redis.delete(QUEUE_KEY)
+        close_connection()
+        self.addCleanup(close_connection)
+
+    def queue(self, count: int):
+        messages = [
+            EmailMessage(subject=f'Письмо {i}', body='Текст', to=[f'reader{i}@example.com']) for i in range(count)
+        ]
+        self.assertEqual(queue_messages(messages), count)
+
+    def get_queued(self) -> list:
+        return [json.loads(value)['recipients'][0] for value in self.redis.lrange(QUEUE_KEY, 0, -1)]
+
+    @staticmethod
+    def get_sent() -> list:
+        return [message.recipients()[0] for message in mail.outbox]
+
+    def test_batches(self):
+        self.queue(5)
+        self.assertEqual(send_queued(batch_size=2), (2, 3))
+        self.assertEqual(self.get_sent(), ['reader0@example.com', 'reader1@example.com'])
+        self.assertEqual(send_queued(batch_size=2), (2, 1))
+        self.assertEqual(send_queued(batch_size=2), (1, 0))
+        self.assertEqual(send_queued(batch_size=2), (0, 0))
+        self.assertEqual(self.get_sent(), [f'reader{i}@example.com' for i in range(5)])
+        self.assertEqual(mail.outbox[0].message()['Subject'], '=?utf-8?b?0J/QuNGB0YzQvNC+IDA=?=')
+
+    @override_settings(EMAIL_BATCH_SIZE=2)
+    def test_task_continues(self):
+        self.queue(3)
+        with mock.patch('api.tasks.send_queued_emails.delay') as delay:
+            send_queued_emails()
+        delay.assert_called_once_with()
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_requeue_on_disconnect(self):
+        self.queue(4)
+        connection = mock.Mock(spec=('open', 'close', 'send_messages'))
+        connection.send_messages.side_effect = [1, SMTPServerDisconnected('closed')]
+        with mock.patch('api.mail.get_connection', return_value=connection):
+            with self.assertRaises(SMTPServerDisconnected):
+                send_queued(batch_size=3)
+        # Отправленное письмо не повторяется, остальные возвращаются в начало очереди по порядку
+        recipients = [f'reader{i}@example.com' for i in range(1, 4)]
+        self.assertEqual(self.get_queued(), recipients)
+        connection.close.assert_called_once_with()
+        self.assertEqual(send_queued(batch_size=3), (3, 0))
+        self.assertEqual(self.get_sent(), recipients)
+
+    def test_drop_refused_recipients(self):
+        self.queue(2)
+        connection = mock.Mock(spec=('open', 'close', 'send_messages'))
+        connection.send_messages.side_effect = [
+            SMTPRecipientsRefused({'reader0@example.com': (550, b'No such user')}), 1,
+        ]
+        with mock.patch('api.mail.get_connection', return_value=connection):
+            self.assertEqual(send_queued(batch_size=10), (1, 0))
+        self.assertEqual(self.redis.llen(QUEUE_KEY), 0)
+
+    def test_beat_schedule(self):
+        tasks = [entry['task'] for entry in settings.CELERY_BEAT_SCHEDULE.values()]
+        self.assertIn('api.tasks.send_queued_emails', tasks)
+
+
+class AuthenticationTests(TestCase):
+    """
+    JWT с кэшем пользователя и состоянием в access-токене (api.authentication)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+
+    def setUp(self):
+        invalidate_user(self.user.id)
+        self.key = get_auth_user_key(self.user.id)
+
+    def login(self) -> dict:
+        response = self.client.post('/auth/jwt/create/', {'email': 'reader@example.com', 'password': 'password'})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def get(self, access: str):
+        return self.client.get('/api/continue-reading/', HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    @staticmethod
+    def count_user_queries(queries) -> int:
+        return sum(f'FROM "{CustomUser._meta.db_table}"' in query['sql'] for query in queries)
+
+    def test_cache_miss_and_hit(self):
+        access = self.login()['access']
+        invalidate_user(self.user.id)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get(access).status_code, 200)
+        self.assertEqual(self.count_user_queries(queries), 1)
+        self.assertIsNotNone(cache.get(self.key))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get(access).status_code, 200)
+        self.assertEqual(self.count_user_queries(queries), 0)
+
+        # Другой процесс: LRU пуст, пользователь берется из общего кэша
+        local_cache.delete(self.key)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get(access).status_code, 200)
+        self.assertEqual(self.count_user_queries(queries), 0)
+
+    def test_invalidation(self):
+        access = self.login()['access']
+        for change in (lambda user: user.change_password('new-password'), lambda user: user.change_active()):
+            self.assertEqual(self.get(access).status_code, 200)
+            self.assertIsNotNone(cache.get(self.key))
+            change(CustomUser.objects.get(id=self.user.id))
+            self.assertIsNone(cache.get(self.key))
+            self.assertIsNone(local_cache.get(self.key))
+
+    def test_suspended(self):
+        tokens = self.login()
+        self.assertEqual(self.get(tokens['access']).status_code, 200)
+        CustomUser.objects.filter(id=self.user.id).update(is_suspended=True)
+        # update() не отправляет сигналы: до сброса кэша действует закэшированное состояние
+        invalidate_user(self.user.id)
+        response = self.get(tokens['access'])
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['code'], 'user_suspended')
+
+    def test_refresh_after_unsuspend(self):
+        user = CustomUser.objects.get(id=self.user.id)
+        user.is_suspended = True
+        user.save()
+        tokens = self.login()
+        self.assertTrue(AccessToken(tokens['access'])['is_suspended'])
+        self.assertNotIn('is_suspended', RefreshToken(tokens['refresh']))
+        self.assertEqual(self.get(tokens['access']).status_code, 401)
+
+        user.is_suspended = False
+        user.save()
+        response = self.client.post('/auth/jwt/refresh/', {'refresh': tokens['refresh']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get(response.json()['access']).status_code, 200)
+
+
+class CatalogCacheTests(TestCase):
+    """
+    Кэш каталога: повторный запрос без обращений к базе, сброс при любом изменении каталога,
+    отдельные ключи для разных параметров запроса
+    """
+    URLS = (
+        '/api/filter-artworks-first/?value=В',
+        '/api/filter-author-first/?value=Т',
+        '/api/genre-names/',
+        '/api/artworks-year/',
+        '/api/first-letter-author/',
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = Author.objects.create(name='Толстой Лев Николаевич')
+        cls.genre = Genre.objects.create(name='Роман')
+        cls.artwork = Artworks.objects.create(name='Война и мир', date='1869', file='book/war.epub')
+        cls.artwork.author.add(cls.author)
+        cls.artwork.genres.add(cls.genre)
+
+    def setUp(self):
+        # Версия каталога не откатывается вместе с транзакцией теста
+        cache.clear()
+
+    def test_second_request_without_queries(self):
+        for url in self.URLS:
+            with self.subTest(url=url):
+                first = self.client.get(url)
+                with self.assertNumQueries(0):
+                    second = self.client.get(url)
+                self.assertEqual(second.json(), first.json())
+
+    def test_invalidation(self):
+        def get_artwork() -> dict:
+            return self.client.get('/api/filter-artworks-first/', {'value': 'В'}).json()[0]
+
+        get_artwork()
+        self.author.name = 'Толстой Л. Н.'
+        self.author.save()
+        self.assertEqual(get_artwork()['author'], [{'id': self.author.id, 'name': 'Толстой Л. Н.'}])
+        authors = self.client.get('/api/filter-author-first/', {'value': 'Т'}).json()
+        self.assertEqual(authors[0]['name'], 'Толстой Л. Н.')
+
+        self.artwork.date = '1867'
+        self.artwork.save()
+        self.assertEqual(get_artwork()['date'], '1867')
+
+        self.genre.name = 'Эпопея'
+        self.genre.save()
+        self.assertEqual(get_artwork()['genres'], [{'id': self.genre.id, 'name': 'Эпопея'}])
+        self.assertEqual(self.client.get('/api/genre-names/').json(), [{'name': 'Эпопея', 'count': 1}])
+
+        history = Genre.objects.create(name='История')
+        self.artwork.genres.add(history)
+        self.assertEqual(len(get_artwork()['genres']), 2)
+        self.artwork.author.clear()
+        self.assertEqual(get_artwork()['author'], [])
+
+    def test_query_string_keys(self):
+        Artworks.objects.create(name='Анна Каренина', date='1877', file='book/anna.epub')
+        names = {
+            value: [el['name'] for el in self.client.get('/api/filter-artworks-first/', {'value': value}).json()]
+            for value in ('В', 'А')
+        }
+        self.assertEqual(names, {'В': ['Война и мир'], 'А': ['Анна Каренина']})
+        # Порядок параметров на ключ не влияет
+        self.client.get('/api/filter-artworks-first/?value=В&page=1')
+        with self.assertNumQueries(0):
+            self.client.get('/api/filter-artworks-first/?page=1&value=В')
+
+
+class ETagTests(TestCase):
+    """
+    Условные запросы: 304 по If-None-Match без построения ответа, новый ETag после изменения каталога или прогресса
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        cls.author = Author.objects.create(name='Толстой Лев Николаевич')
+        cls.artwork = Artworks.objects.create(name='Война и мир', date='1869', file='book/war.epub')
+        cls.artwork.author.add(cls.author)
+        cls.artwork.genres.add(Genre.objects.create(name='Роман'))
+        BookState.objects.create(user=cls.user, book=cls.artwork, epubcfi='epubcfi(/6/2)', percent=10)
+
+    def setUp(self):
+        cache.clear()
+        redis = get_redis_connection(settings.READING_PROGRESS_CACHE_ALIAS)
+        keys = redis.keys('progress:*')
+        if keys:
+            redis.delete(*keys)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def patch(self, percent: int):
+        return self.client.patch(
+            f'/api/update-state-book/{self.artwork.id}/',
+            {'epubcfi': 'epubcfi(/6/4)', 'percent': percent},
+            format='json',
+        )
+
+    def assertNotModified(self, url: str, etag: str, queries: int):
+        with self.assertNumQueries(queries):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def assertModified(self, url: str, etag: str) -> str:
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_catalog(self):
+        for url in ('/api/first-letter-author/', '/api/artworks-year/', '/api/genre-names/'):
+            with self.subTest(url=url):
+                etag = self.client.get(url)['ETag']
+                self.assertNotModified(url, etag, queries=0)
+                Author.objects.create(name='Чехов Антон Павлович')
+                etag = self.assertModified(url, etag)
+                self.assertNotModified(url, etag, queries=0)
+
+    def test_reading_list(self):
+        url = '/api/books/'
+        etag = self.client.get(url)['ETag']
+        # Только запрос ETag (последнее обновление и кол-во книг), список не строится
+        self.assertNotModified(url, etag, queries=1)
+
+        self.artwork.name = 'Война и мир. Том 1'
+        self.artwork.save()
+        etag = self.assertModified(url, etag)
+
+        self.assertEqual(self.patch(percent=20).status_code, 200)
+        etag = self.assertModified(url, etag)
+        self.assertNotModified(url, etag, queries=1)
+
+        with self.settings(READING_PROGRESS_BUFFER=True):
+            self.assertEqual(self.patch(percent=30).status_code, 200)
+            self.assertEqual(BookState.objects.get(user=self.user, book=self.artwork).percent, 20)
+            etag = self.assertModified(url, etag)
+            self.assertNotModified(url, etag, queries=1)
+            self.assertEqual(self.client.get(url).data['items'][0]['percent'], 30)
+
+
+class FacetCounterTests(TestCase):
+    """
+    Счетчики букв авторов, годов и жанров обновляются сигналами так же, как полный пересчет
+    """
+
+    @staticmethod
+    def get_counts() -> dict:
+        return {
+            (facet, value): count
+            for facet, value, count in FacetCounter.objects.filter(count__gt=0).values_list('facet', 'value', 'count')
+        }
+
+    def assertCountersRebuilt(self):
+        counts = self.get_counts()
+        with transaction.atomic():
+            FacetCounter.objects.rebuild()
+            expected = self.get_counts()
+            transaction.set_rollback(True)
+        self.assertEqual(counts, expected)
+
+    def test_signals(self):
+        tolstoy = Author.objects.create(name='Толстой Лев Николаевич')
+        chekhov = Author.objects.create(name='Чехов Антон Павлович')
+        novel = Genre.objects.create(name='Роман')
+        play = Genre.objects.create(name='Пьеса')
+        war = Artworks.objects.create(name='Война и мир', date='1869', file='book/war.epub')
+        anna = Artworks.objects.create(name='Анна Каренина', date='1877', file='book/anna.epub')
+        gull = Artworks.objects.create(name='Чайка', date='1896', file='book/gull.epub')
+        war.author.add(tolstoy)
+        war.genres.add(novel)
+        novel.artworks_set.add(anna)
+        gull.genres.add(play, novel)
+        self.assertCountersRebuilt()
+        self.assertEqual(self.get_counts()[(Facet.GENRE, 'Роман')], 3)
+        self.assertEqual(self.get_counts()[(Facet.AUTHOR_LETTER, 'Т')], 1)
+
+        chekhov.name = 'Антон Павлович Чехов'
+        chekhov.save()
+        gull.date = '1895'
+        gull.save()
+        play.name = 'Драма'
+        play.save()
+        self.assertCountersRebuilt()
+        self.assertNotIn((Facet.YEAR, '1896'), self.get_counts())
+
+        gull.genres.remove(novel)
+        self.assertCountersRebuilt()
+        anna.genres.clear()
+        self.assertCountersRebuilt()
+        novel.artworks_set.clear()
+        self.assertCountersRebuilt()
+
+        gull.delete()
+        self.assertCountersRebuilt()
+        war.genres.add(novel)
+        novel.delete()
+        tolstoy.delete()
+        self.assertCountersRebuilt()
+
+        response = self.client.get('/api/genre-names/')
+        self.assertEqual(response.json(), [{'name': 'Драма', 'count': 0}])
+        response = self.client.get('/api/artworks-year/')
+        self.assertEqual(response.json(), [{'name': '1869', 'count': 1}, {'name': '1877', 'count': 1}])
+
+
+    def test_rebuild_command(self):
+        chekhov = Author.objects.create(name='Чехов Антон Павлович')
+        play = Genre.objects.create(name='Пьеса')
+        gull = Artworks.objects.create(name='Чайка', date='1896', file='book/gull.epub')
+        gull.author.add(chekhov)
+        gull.genres.add(play)
+        # База, заполненная до появления счетчиков
+        FacetCounter.objects.all().delete()
+        self.assertEqual(self.client.get('/api/genre-names/').json(), [])
+
+        call_command('rebuild_facets', stdout=io.StringIO())
+        self.assertEqual(self.client.get('/api/genre-names/').json(), [{'name': 'Пьеса', 'count': 1}])
+        self.assertEqual(self.client.get('/api/artworks-year/').json(), [{'name': '1896', 'count': 1}])
+        self.assertEqual(self.client.get('/api/first-letter-author/').json(), [{'name': 'Ч', 'count': 1}])
+
+
+class AuthorStatsTests(TestCase):
+    """
+    Статистика авторов обновляется сигналами так же, как полный пересчет
+    """
+
+    @staticmethod
+    def get_stats() -> dict:
+        return {author: (total, genres) for author, total, genres in AuthorStats.objects.values_list(
+            'author', 'total', 'genres',
+        )}
+
+    def assertStatsRefreshed(self):
+        stats = self.get_stats()
+        with transaction.atomic():
+            AuthorStats.objects.refresh()
+            expected = self.get_stats()
+            transaction.set_rollback(True)
+        self.assertEqual(stats, expected)
+
+    def test_signals(self):
+        tolstoy = Author.objects.create(name='Толстой Лев Николаевич')
+        chekhov = Author.objects.create(name='Чехов Антон Павлович')
+        self.assertEqual(self.get_stats(), {tolstoy.id: (0, []), chekhov.id: (0, [])})
+        novel = Genre.objects.create(name='Роман')
+        play = Genre.objects.create(name='Пьеса')
+        war = Artworks.objects.create(name='Война и мир', date='1869', file='book/war.epub')
+        anna = Artworks.objects.create(name='Анна Каренина', date='1877', file='book/anna.epub')
+        gull = Artworks.objects.create(name='Чайка', date='1896', file='book/gull.epub')
+        war.author.add(tolstoy)
+        tolstoy.artworks_set.add(anna)
+        gull.author.add(chekhov)
+        novel.artworks_set.add(war, anna)
+        gull.genres.add(play)
+        self.assertStatsRefreshed()
+        self.assertEqual(self.get_stats()[tolstoy.id], (2, [{'id': novel.id, 'name': 'Роман', 'count': 2}]))
+
+        novel.name = 'Эпопея'
+        novel.save()
+        self.assertStatsRefreshed()
+        anna.genres.remove(novel)
+        self.assertStatsRefreshed()
+        gull.author.add(tolstoy)
+        self.assertStatsRefreshed()
+        gull.genres.clear()
+        self.assertStatsRefreshed()
+        chekhov.artworks_set.clear()
+        self.assertStatsRefreshed()
+        tolstoy.artworks_set.remove(gull)
+        self.assertStatsRefreshed()
+
+        novel.delete()
+        self.assertStatsRefreshed()
+        anna.delete()
+        self.assertStatsRefreshed()
+        self.assertEqual(self.get_stats()[tolstoy.id], (1, [{'id': None, 'name': None, 'count': 1}]))
+
+
+class ImportJobPermissionTests(TestCase):
+    """
+    Загрузка каталога и задачи загрузки доступны только сотрудникам
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        cls.job = ImportJob.objects.create(file='imports/library.xlsx')
+
+    def assertDenied(self, client, status_code: int):
+        self.assertEqual(client.post('/api/create-book/').status_code, status_code)
+        self.assertEqual(client.get(f'/api/import-job/{self.job.id}/').status_code, status_code)
+        self.assertEqual(client.post(f'/api/import-job/{self.job.id}/resume/').status_code, status_code)
+
+    def test_anonymous(self):
+        self.assertDenied(APIClient(), 401)
+
+    def test_not_staff(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertDenied(client, 403)
+
+    def test_staff(self):
+        client = APIClient()
+        client.force_authenticate(CustomUser.objects.create_superuser('admin@example.com', 'password'))
+        self.assertEqual(client.get(f'/api/import-job/{self.job.id}/').status_code, 200)
+
+
+def make_workbook(rows: list, columns: dict = ParseXML.COLUMNS) -> bytes:
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.title = ParseXML.SHEET_NAME
+    sheet.append(list(columns.values()))
+    for row in rows:
+        sheet.append([row.get(key) for key in columns])
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+class ImportJobTests(TestCase):
+    """
+    Загрузка каталога пачками: разбивка, обработка, продолжение после ошибки и итоги
+    """
+    ROWS = [
+        {'fio': 'Толстой Лев Николаевич', 'name': 'Война и мир', 'file': 'war', 'year': 1869, 'genre': 'Роман'},
+        {'fio': 'Толстой Лев Николаевич', 'name': 'Анна Каренина', 'file': 'anna', 'year': 1877, 'genre': 'Роман'},
+        {'fio': 'Чехов Антон Павлович', 'name': 'Чайка', 'file': 'gull', 'year': 1896, 'genre': 'Пьеса, Комедия'},
+        {'fio': 'Чехов Антон Павлович', 'name': 'Чайка', 'file': 'gull', 'year': 1896, 'genre': 'Пьеса'},
+        {'fio': 'Гоголь Николай Васильевич', 'name': 'Нос', 'file': 'nose', 'year': 1836, 'genre': None},
+    ]
+
+    def setUp(self):
+        self.job = ImportJob.objects.create(
+            file=ContentFile(make_workbook(self.ROWS), name='library.xlsx'),
+            chunk_size=2,
+        )
+
+    def tearDown(self):
+        self.job.file.delete(save=False)
+
+    def test_split(self):
+        split_import_job(job=self.job)
+        self.assertEqual(self.job.total_rows, 5)
+        self.assertEqual(list(self.job.chunks.order_by('index').values_list('row_count', flat=True)), [2, 2, 1])
+        self.assertEqual(self.job.chunks.get(index=1).rows[0]['genres'], ['Пьеса', 'Комедия'])
+
+    def test_import_and_finish(self):
+        split_import_job(job=self.job)
+        for chunk in self.job.chunks.all():
+            import_chunk(chunk.id)
+        # Завершенная пачка повторно не импортируется
+        import_chunk(self.job.chunks.get(index=0).id)
+        with mock.patch('api.tasks.group') as group:
+            finish_import_job(self.job.id)
+        created = set(Artworks.objects.values_list('id', flat=True))
+        # Оптимизация и обложки - независимые группы задач по одной на книгу
+        optimize, covers = [{(task.task, task.args[0]) for task in call.args[0]} for call in group.call_args_list]
+        self.assertEqual(optimize, {('api.tasks.optimize_epub', book_id) for book_id in created})
+        self.assertEqual(covers, {('api.tasks.make_cover', book_id) for book_id in created})
+
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, ImportStatus.DONE)
+        self.assertEqual((self.job.created_rows, self.job.skipped_rows), (4, 1))
+        self.assertEqual(Artworks.objects.filter(name='Чайка').count(), 1)
+        self.assertEqual(Author.objects.filter(name='Толстой Лев Николаевич').count(), 1)
+        self.assertEqual(
+            set(Artworks.objects.get(name='Чайка').genres.values_list('name', flat=True)), {'Пьеса', 'Комедия'},
+        )
+        self.assertFalse(self.job.chunks.exclude(rows=[]).exists())
+
+    def test_resume_failed_chunks(self):
+        split_import_job(job=self.job)
+        first, second, third = self.job.chunks.order_by('index')
+        import_chunk(first.id)
+        ImportChunk.objects.filter(id=second.id).update(status=ImportStatus.FAILED, error='worker lost')
+
+        with mock.patch('api.tasks.group'):
+            finish_import_job(self.job.id)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, ImportStatus.FAILED)
+        self.assertTrue(self.job.error)
+
+        with mock.patch('api.tasks.chord') as chord:
+            start_import_job(self.job.id)
+        self.assertEqual([task.args[0] for task in chord.call_args.args[0]], [second.id, third.id])
+        self.assertEqual(self.job.chunks.count(), 3)
+
+        import_chunk(second.id)
+        import_chunk(third.id)
+        with mock.patch('api.tasks.group'):
+            finish_import_job(self.job.id)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, ImportStatus.DONE)
+        self.assertEqual(self.job.created_rows, 4)
+        self.assertEqual(sum(len(books) for books in self.job.chunks.values_list('created_books', flat=True)), 4)
+
+    def test_missing_column(self):
+        columns = {key: title for key, title in ParseXML.COLUMNS.items() if key != 'year'}
+        job = ImportJob.objects.create(file=ContentFile(make_workbook(self.ROWS, columns), name='library.xlsx'))
+        self.addCleanup(job.file.delete, save=False)
+        start_import_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportStatus.FAILED)
+        self.assertIn('Год', job.error)
+        self.assertFalse(job.chunks.exists())
+
+    def test_upload_checks_file(self):
+        client = APIClient()
+        client.force_authenticate(CustomUser.objects.create_superuser('admin@example.com', 'password'))
+        columns = {key: title for key, title in ParseXML.COLUMNS.items() if key != 'genre'}
+        workbook = openpyxl.Workbook()
+        workbook.active.title = 'Лист1'
+        other_sheet = io.BytesIO()
+        workbook.save(other_sheet)
+        files = {
+            'Жанр': make_workbook(self.ROWS, columns),
+            ParseXML.SHEET_NAME: other_sheet.getvalue(),
+            'xlsx': 'ФИО Автора;Год'.encode(),
+        }
+        with mock.patch('api.views.start_import_job.delay') as delay:
+            for message, data in files.items():
+                with self.subTest(message=message):
+                    response = client.post('/api/create-book/', {'file': ContentFile(data, name='library.xlsx')})
+                    self.assertEqual(response.status_code, 400)
+                    self.assertIn(message, response.data['file'][0])
+            delay.assert_not_called()
+            response = client.post('/api/create-book/', {'file': ContentFile(make_workbook(self.ROWS), name='a.xlsx')})
+        self.assertEqual(response.status_code, 200)
+        delay.assert_called_once_with(response.data['id'])
+        job = ImportJob.objects.get(id=response.data['id'])
+        self.addCleanup(job.file.delete, save=False)
+        self.assertEqual(next(ParseXML(job.file.path).iter_rows())['fio'], self.ROWS[0]['fio'])
+
+
+class SearchTests(TestCase):
+    """
+    Поиск по авторам и произведениям: морфология, подстрока, опечатки и ранжирование
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in ('Война и мир', 'Анна Каренина', 'Мир приключений', 'Мирная жизнь', 'Воскресение'):
+            Artworks.objects.create(name=name, date='1900', file='book/book.epub')
+        Author.objects.create(name='Толстой Лев Николаевич')
+        Author.objects.create(name='Толстая Татьяна Никитична')
+
+    def search(self, value: str) -> list:
+        return list(Artworks.objects.search(value).order_by('-rank', 'id').values_list('name', flat=True))
+
+    def test_backfill_command(self):
+        # Записи, созданные до появления поискового вектора
+        Artworks.objects.update(search_vector=None)
+        Author.objects.update(search_vector=None)
+        self.assertEqual(self.search('миры'), [])
+        out = io.StringIO()
+        call_command('update_search_vectors', '--missing', stdout=out)
+        self.assertIn('авторов: 2, произведений: 5', out.getvalue())
+        self.assertIn('Мир приключений', self.search('миры'))
+        self.assertFalse(Author.objects.filter(search_vector__isnull=True).exists())
+        out = io.StringIO()
+        call_command('update_search_vectors', '--missing', stdout=out)
+        self.assertIn('авторов: 0, произведений: 0', out.getvalue())
+
+    def test_word_forms(self):
+        self.assertIn('Мир приключений', self.search('миры'))
+
+    def test_substring(self):
+        self.assertEqual(self.search('каренин'), ['Анна Каренина'])
+
+    def test_typo(self):
+        self.assertIn('Воскресение', self.search('Воскресенье'))
+
+    def test_exact_title_first(self):
+        self.assertEqual(self.search('Война и мир')[0], 'Война и мир')
+
+    def test_case_insensitive_substring(self):
+        self.assertEqual(self.search('АННА КАР'), ['Анна Каренина'])
+
+    def test_special_characters(self):
+        # Подстрока экранируется: незакрытая скобка не ломает регулярное выражение
+        self.assertIn('Война и мир', self.search('(мир'))
+        self.assertEqual(self.search('.*'), [])
+
+    def test_author(self):
+        self.assertEqual(
+            list(Author.objects.search('Толстой').order_by('-rank', 'id').values_list('name', flat=True))[0],
+            'Толстой Лев Николаевич',
+        )
+
+    @override_settings(THROTTLE_BUCKETS={})
+    def test_search_all_pages(self):
+        Author.objects.create(name='Мирный Панас')
+        cache.clear()
+        for value in ('', 'мир'):
+            expected = [
+                ('author', author_id)
+                for author_id in Author.objects.search(value).order_by('-rank', 'id').values_list('id', flat=True)
+            ] + [
+                ('artworks', artwork_id)
+                for artwork_id in Artworks.objects.search(value).order_by('-rank', 'id').values_list('id', flat=True)
+            ]
+            self.assertEqual({type_ for type_, _ in expected}, {'author', 'artworks'})
+            # Граница авторов и произведений внутри страницы и на границе страниц
+            for limit in (2, 3, len(expected)):
+                with self.subTest(value=value, limit=limit):
+                    items, page, total = [], 1, 1
+                    while page <= total:
+                        data = self.client.get('/api/search/', {'value': value, 'page': page, 'limit': limit}).json()
+                        self.assertEqual((data['count'], data['page'], data['limit']), (len(expected), page, limit))
+                        self.assertLessEqual(len(data['items']), limit)
+                        items += [(el['type'], el['id']) for el in data['items']]
+                        total = data['total']
+                        page += 1
+                    self.assertEqual(total, -(-len(expected) // limit))
+                    self.assertEqual(items, expected)
+
+
+@override_settings(THROTTLE_BUCKETS={})
+class BenchmarkTests(TestCase):
+    """
+    Замер адресов: адреса файлов книг без файла в хранилище пропускаются, все причины пропуска сохраняются
+    """
+    ROUTES = ['api/book/<int:pk>/download/', 'api/book/<int:pk>/toc/', 'api/books/', 'api/import-job/<int:pk>/']
+
+    @classmethod
+    def setUpTestData(cls):
+        user = CustomUser.objects.create_user('reader@example.com', 'password')
+        author = Author.objects.create(name='Толстой Лев Николаевич')
+        cls.artwork = Artworks.objects.create(name='Война и мир', date='1869', file='/media/book/war.epub')
+        cls.artwork.author.add(author)
+        BookState.objects.create(user=user, book=cls.artwork, epubcfi='epubcfi(/6/2)', percent=10)
+
+    def setUp(self):
+        use_temporary_media(self)
+
+    def run_benchmark(self, routes: list) -> dict:
+        with mock.patch('api.benchmark.get_routes', return_value=routes):
+            return run_benchmark(BenchmarkContext(), repeat=1, warmup=0)
+
+    def test_missing_files_skipped(self):
+        report = self.run_benchmark(self.ROUTES)
+        self.assertEqual(list(report['results']), ['GET api/books/', 'GET api/books/?limit=50'])
+        self.assertEqual(report['skipped'], {
+            'api/book/<int:pk>/download/': ['GET нет данных: epub_book'],
+            'api/book/<int:pk>/toc/': ['GET нет данных: indexed_book'],
+            'api/import-job/<int:pk>/': ['GET нет данных: import_job'],
+        })
+
+    def test_reasons_per_case(self):
+        cases = [
+            benchmark.Case(skip='первый'), benchmark.Case(params={'value': 'letter'}), benchmark.Case(skip='второй'),
+        ]
+        with mock.patch.dict(benchmark.ROUTES, {'api/search/': cases}):
+            report = self.run_benchmark(['api/search/'])
+        self.assertEqual(report['skipped'], {'api/search/': ['GET первый', 'GET второй']})
+        self.assertEqual(list(report['results']), ['GET api/search/?value=letter'])
+
+    def test_epub_routes(self):
+        chapters = [('ch1', 'ch1.xhtml', 'application/xhtml+xml', xhtml('<p>Текст</p>'), '')]
+        default_storage.save('book/war.epub', ContentFile(make_epub(chapters, spine=['ch1'])))
+        report = self.run_benchmark(self.ROUTES[:2])
+        self.assertEqual(report['skipped'], {})
+        for result in report['results'].values():
+            self.assertEqual(result['status'], [200])
+
+
+def make_image(color: str = 'red', size: tuple = (40, 60), image_format: str = 'PNG') -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', size, color).save(output, image_format)
+    return output.getvalue()
+
+
+def make_epub(
+    items: list, spine: list, metadata: str = '', spine_toc: str = '', compression: int = zipfile.ZIP_DEFLATED,
+) -> bytes:
+    """
+    EPUB для тестов
+    :param items: [(id, href от OEBPS/, media-type, данные, properties)]
+    :param spine: id элементов в порядке чтения
+    :param compression: Сжатие элементов manifest
+    """
+    manifest = ''.join(
+        f'<item id="{item_id}" href="{href}" media-type="{media_type}"'
+        + (f' properties="{properties}"' if properties else '') + '/>'
+        for item_id, href, media_type, _, properties in items
+    )
+    itemrefs = ''.join(f'<itemref idref="{item_id}"/>' for item_id in spine)
+    toc = f' toc="{spine_toc}"' if spine_toc else ''
+    opf = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Тест</dc:title>'
+        f'{metadata}</metadata><manifest>{manifest}</manifest><spine{toc}>{itemrefs}</spine></package>'
+    )
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        archive.writestr(
+            'META-INF/container.xml',
+            '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+            '</rootfiles></container>',
+        )
+        archive.writestr('OEBPS/content.opf', opf)
+        for _, href, _, data, _ in items:
+            archive.writestr(f'OEBPS/{href}', data, compress_type=compression)
+    return output.getvalue()
+
+
+def xhtml(body: str) -> str:
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+        f'<head><title>Глава</title></head><body>{body}</body></html>'
+    )
+
+
+class EpubIndexTests(TestCase):
+    """
+    Индекс EPUB: manifest со смещениями, spine, оглавление EPUB 3 и EPUB 2, чтение по смещению
+    """
+    CHAPTERS = [
+        ('ch1', 'text/ch1.xhtml', 'application/xhtml+xml', xhtml('<h1 id="part">Глава 1</h1>' + 'Текст ' * 500), ''),
+        ('ch2', 'text/ch2.xhtml', 'application/xhtml+xml', xhtml('<h1>Глава 2</h1>'), ''),
+        ('image', 'img/picture.png', 'image/png', make_image(), ''),
+    ]
+    TOC = [
+        {'title': 'Глава 1', 'href': 'OEBPS/text/ch1.xhtml', 'level': 1},
+        {'title': 'Часть', 'href': 'OEBPS/text/ch1.xhtml', 'level': 2},
+        {'title': 'Глава 2', 'href': 'OEBPS/text/ch2.xhtml', 'level': 1},
+    ]
+
+    def test_nav(self):
+        nav = xhtml(
+            '<nav epub:type="landmarks"><ol><li><a href="../text/ch2.xhtml">Начало</a></li></ol></nav>'
+            '<nav epub:type="toc"><ol>'
+            '<li><a href="../text/ch1.xhtml"> Глава <b>1</b></a>'
+            '<ol><li><a href="../text/ch1.xhtml#part">Часть</a></li></ol></li>'
+            '<li><span>Без ссылки</span></li>'
+            '<li><a href="../text/ch2.xhtml">Глава 2</a></li>'
+            '</ol></nav>'
+        )
+        items = self.CHAPTERS + [('nav', 'nav/nav.xhtml', 'application/xhtml+xml', nav, 'nav')]
+        data = make_epub(items, spine=['ch1', 'missing', 'ch2'])
+        index = Epub(io.BytesIO(data)).build_index()
+
+        self.assertEqual(index['opf'], 'OEBPS/content.opf')
+        self.assertEqual(index['spine'], [
+            {'idref': 'ch1', 'href': 'OEBPS/text/ch1.xhtml'},
+            {'idref': 'ch2', 'href': 'OEBPS/text/ch2.xhtml'},
+        ])
+        self.assertEqual(index['toc'], self.TOC)
+        self.assertEqual(index['items']['OEBPS/nav/nav.xhtml']['properties'], 'nav')
+        self.assertEqual(index['items']['OEBPS/img/picture.png']['media_type'], 'image/png')
+        self.assertReadItems(data, index)
+
+    def test_ncx(self):
+        ncx = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1"><navMap>'
+            '<navPoint id="p1"><navLabel><text>Глава 1</text></navLabel><content src="text/ch1.xhtml"/>'
+            '<navPoint id="p2"><navLabel><text> Часть </text></navLabel><content src="text/ch1.xhtml#part"/>'
+            '</navPoint></navPoint>'
+            '<navPoint id="p3"><navLabel><text>Глава 2</text></navLabel><content src="text/ch2.xhtml"/></navPoint>'
+            '</navMap></ncx>'
+        )
+        items = self.CHAPTERS + [('ncx', 'toc.ncx', 'application/x-dtbncx+xml', ncx, '')]
+        for compression in (zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED):
+            with self.subTest(compression=compression):
+                data = make_epub(items, spine=['ch1', 'ch2'], spine_toc='ncx', compression=compression)
+                index = Epub(io.BytesIO(data)).build_index()
+                self.assertEqual(index['toc'], self.TOC)
+                self.assertEqual(
+                    {item['compress_type'] for item in index['items'].values()}, {compression},
+                )
+                self.assertReadItems(data, index)
+
+    def test_without_toc(self):
+        index = Epub(io.BytesIO(make_epub(self.CHAPTERS, spine=['ch1']))).build_index()
+        self.assertEqual(index['toc'], [])
+        self.assertEqual(len(index['spine']), 1)
+
+    def test_broken(self):
+        without_container = io.BytesIO()
+        with zipfile.ZipFile(without_container, 'w') as archive:
+            archive.writestr('mimetype', 'application/epub+zip')
+        files = {
+            'zip': b'not a zip',
+            'container': without_container.getvalue(),
+            'opf': make_epub(self.CHAPTERS, spine=['ch1'], metadata='<meta'),
+        }
+        for name, data in files.items():
+            with self.subTest(name=name):
+                with self.assertRaises(EpubError):
+                    Epub(io.BytesIO(data)).build_index()
+
+    def test_spine_index(self):
+        spine = [{'idref': 'cover', 'href': ''}, {'idref': 'ch1', 'href': ''}, {'idref': 'ch2', 'href': ''}]
+        self.assertEqual(Epub.get_spine_index('epubcfi(/6/4!/4/2/1:0)', spine), 1)
+        self.assertEqual(Epub.get_spine_index('epubcfi(/6/2[ch2]!/4/2)', spine), 2)
+        self.assertEqual(Epub.get_spine_index('epubcfi(/6/6[unknown]!/4)', spine), 2)
+        self.assertIsNone(Epub.get_spine_index('epubcfi(/6/8!/4)', spine))
+        self.assertIsNone(Epub.get_spine_index('', spine))
+
+    def assertReadItems(self, data: bytes, index: dict):
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            file = io.BytesIO(data)
+            for href, item in index['items'].items():
+                self.assertEqual(Epub.read_item(file, item), archive.read(href))
+
+
+class DownloadBookTests(TestCase):
+    """
+    Скачивание книги (api/book/<pk>/download/): доступ проверяет Django, файл отдает nginx
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        cls.artwork = Artworks.objects.create(name='Война и мир', date='1869', file='/media/book/war.epub')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_x_accel_redirect(self):
+        response = self.client.get(f'/api/book/{self.artwork.id}/download/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/book/war.epub')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="war.epub"')
+        self.assertEqual(response.content, b'')
+
+        EpubOptimization.objects.create(
+            book=self.artwork, file='book/optimized/war.epub', original_size=100, optimized_size=50,
+        )
+        response = self.client.get(f'/api/book/{self.artwork.id}/download/')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/book/optimized/war.epub')
+
+    def test_anonymous(self):
+        response = APIClient().get(f'/api/book/{self.artwork.id}/download/')
+        self.assertEqual(response.status_code, 401)
+        self.assertNotIn('X-Accel-Redirect', response)
+
+    def test_missing_book(self):
+        response = self.client.get(f'/api/book/{self.artwork.id + 1}/download/')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('X-Accel-Redirect', response)
+
+    def test_without_nginx(self):
+        use_temporary_media(self)
+        with self.settings(USE_X_ACCEL_REDIRECT=False):
+            self.assertEqual(self.client.get(f'/api/book/{self.artwork.id}/download/').status_code, 404)
+            default_storage.save('book/war.epub', ContentFile(b'epub'))
+            response = self.client.get(f'/api/book/{self.artwork.id}/download/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), b'epub')
+
+    def test_catalog_links_to_download(self):
+        response = self.client.get('/api/filter-year-artworks/', {'year': '1869'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]['file'], f'/api/book/{self.artwork.id}/download/')
+
+
+class EpubChapterViewTests(TestCase):
+    """
+    Глава книги по индексу: испорченный файл или индекс дает 404, а не 500
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('reader@example.com', 'password')
+        cls.artwork = Artworks.objects.create(name='Война и мир', date='1869', file='book/war.epub')
+
+    def setUp(self):
+        use_temporary_media(self)
+        default_storage.save('book/war.epub', ContentFile(make_epub(EpubIndexTests.CHAPTERS, spine=['ch1', 'ch2'])))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_chapter(self):
+        response = self.client.get(f'/api/book/{self.artwork.id}/chapter/', {'index': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Spine-Index'], '1')
+        self.assertEqual(response.content.decode(), EpubIndexTests.CHAPTERS[1][3])
+        response = self.client.get(f'/api/book/{self.artwork.id}/chapter/', {'index': 2})
+        self.assertEqual(response.status_code, 400)
+
+    def test_broken_item(self):
+        self.assertEqual(self.client.get(f'/api/book/{self.artwork.id}/toc/').status_code, 200)
+        index = EpubIndex.objects.get(book=self.artwork)
+        broken = {'offset': 0}, {'compress_type': 99}
+        for change in broken:
+            with self.subTest(change=change):
+                index.items['OEBPS/text/ch1.xhtml'].update(change)
+                index.save(update_fields=['items'])
+                response = self.client.get(f'/api/book/{self.artwork.id}/chapter/')
+                self.assertEqual(response.status_code, 404)
+
+
+class EpubCoverTests(TestCase):
+    """
+    Обложка из метаданных EPUB 3 и EPUB 2, иначе по слову cover в id или пути картинки
+    """
+
+    def get_cover(self, images: list, metadata: str = '') -> bytes | None:
+        items = [('chapter', 'chapter.xhtml', 'application/xhtml+xml', xhtml('<p>Текст</p>'), '')] + images
+        cover = Epub(io.BytesIO(make_epub(items, spine=['chapter'], metadata=metadata))).get_cover()
+        return cover[0] if cover else None
+
+    def test_cover_image_property(self):
+        cover = make_image('blue')
+        images = [
+            ('cover', 'img/cover.png', 'image/png', make_image('red'), ''),
+            ('front', 'img/front.png', 'image/png', cover, 'cover-image'),
+        ]
+        self.assertEqual(self.get_cover(images), cover)
+
+    def test_meta_cover(self):
+        cover = make_image('blue', image_format='JPEG')
+        images = [
+            ('cover', 'img/cover.png', 'image/png', make_image('red'), ''),
+            ('front', 'img/front.jpg', 'image/jpeg', cover, ''),
+        ]
+        self.assertEqual(self.get_cover(images, metadata='<meta name="cover" content="front"/>'), cover)
+
+    def test_name_fallback(self):
+        cover = make_image('blue')
+        for item_id, href in (('image1', 'img/cover.png'), ('book-cover', 'img/1.png'), ('i', 'Covers/1.png')):
+            with self.subTest(href=href):
+                images = [
+                    ('discover', 'img/discover.png', 'image/png', make_image('red'), ''),
+                    (item_id, href, 'image/png', cover, ''),
+                ]
+                self.assertEqual(self.get_cover(images), cover)
+
+    def test_not_cover(self):
+        images = [
+            ('discover', 'img/discover.png', 'image/png', make_image('red'), ''),
+            ('recovered', 'img/uncovered-map.png', 'image/png', make_image('green'), ''),
+            ('cover-svg', 'img/cover.svg', 'image/svg+xml', '<svg xmlns="http://www.w3.org/2000/svg"/>', ''),
+        ]
+        self.assertIsNone(self.get_cover(images))
+
+
+class EpubOptimizeTests(TestCase):
+    """
+    Оптимизация удаляет только ресурсы, на которые действительно нет ссылок
+    """
+
+    def test_references(self):
+        chapter = xhtml(
+            '<img src="img/plain.png" srcset="img/small.png 1x, img/large.png 2x" alt=""/>'
+            '<picture><source srcset="img/source.png"/><img src="img/plain.png" alt=""/></picture>'
+            '<object data="media/widget.svg" type="image/svg+xml"></object>'
+            '<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink">'
+            '<image xlink:href="img/xlink.png"/></svg>'
+            '<video poster="img/poster.png"/>'
+            '<link rel="stylesheet" href="style.css"/>'
+        )
+        widget = '<svg xmlns="http://www.w3.org/2000/svg"><image href="../img/in-svg.png"/></svg>'
+        style = '@import "extra.css"; body { background: url(img/background.png); }'
+        extra = 'h1 { background-image: url("img/import.png"); }'
+        images = (
+            'plain', 'small', 'large', 'source', 'xlink', 'poster', 'in-svg', 'background', 'import', 'unused',
+        )
+        items = [
+            ('chapter', 'chapter.xhtml', 'application/xhtml+xml', chapter, ''),
+            ('widget', 'media/widget.svg', 'image/svg+xml', widget, ''),
+            ('style', 'style.css', 'text/css', style, ''),
+            ('extra', 'extra.css', 'text/css', extra, ''),
+        ] + [(name, f'img/{name}.png', 'image/png', make_image(), '') for name in images]
+
+        target = io.BytesIO()
+        stats = Epub(io.BytesIO(make_epub(items, spine=['chapter']))).optimize(target)
+        self.assertEqual(stats['removed'], ['OEBPS/img/unused.png'])
+        with zipfile.ZipFile(target) as archive:
+            names = set(archive.namelist())
+            opf = archive.read('OEBPS/content.opf').decode()
+        for name in images[:-1]:
+            self.assertIn(f'OEBPS/img/{name}.png', names)
+        self.assertNotIn('OEBPS/img/unused.png', names)
+        self.assertNotIn('id="unused"', opf)
+
+    def test_task(self):
+        use_temporary_media(self)
+        chapter = xhtml('<p>Текст</p>')
+        items = [
+            ('chapter', 'chapter.xhtml', 'application/xhtml+xml', chapter, ''),
+            ('unused', 'img/unused.png', 'image/png', make_image(size=(400, 400)), ''),
+        ]
+        default_storage.save('book/good.epub', ContentFile(make_epub(items, spine=['chapter'])))
+        default_storage.save('book/broken.epub', ContentFile(b'not a zip'))
+        good = Artworks.objects.create(name='Война и мир', date='1869', file='/media/book/good.epub')
+        broken = Artworks.objects.create(name='Анна Каренина', date='1877', file='/media/book/broken.epub')
+
+        self.assertTrue(optimize_epub(good.id))
+        self.assertFalse(optimize_epub(broken.id))
+        optimization = EpubOptimization.objects.get(book=good)
+        self.assertEqual((optimization.error, optimization.removed_items), ('', ['OEBPS/img/unused.png']))
+        self.assertTrue(EpubIndex.objects.get(book=good).file.startswith('book/optimized/'))
+        failed = EpubOptimization.objects.get(book=broken)
+        self.assertTrue(failed.error)
+        self.assertFalse(failed.file)
+        self.assertEqual(Artworks.objects.get(id=broken.id).get_read_file_name(), 'book/broken.epub')
+        # Ошибка сохранена, повторно книга не обрабатывается
+        with mock.patch('api.tasks.optimize_epub') as task:
+            self.assertEqual(optimize_epubs(), 0)
+        task.assert_not_called()
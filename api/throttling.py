@@ -0,0 +1,100 @@
+import logging
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+# Token bucket за один вызов: пополнение по времени сервера Redis, списание стоимости запроса.
+# Возвращает {1 - разрешено / 0 - нет, сколько секунд ждать}
+TOKEN_BUCKET_SCRIPT = """
+redis.replicate_commands()
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(bucket[1]) or capacity
+local last = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'time', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+_script = None
+
+
+def get_script():
+    """
+    Скрипт token bucket, загружается в Redis один раз (EVALSHA, при NOSCRIPT - повторная загрузка)
+    """
+    global _script
+    if _script is None:
+        _script = get_redis_connection(settings.THROTTLE_CACHE_ALIAS).register_script(TOKEN_BUCKET_SCRIPT)
+    return _script
+
+
+def get_bucket_key(scope: str, ident) -> str:
+    return f'throttle:{scope}:{ident}'
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Ограничение запросов token bucket в Redis, отдельно для пользователя или IP.
+    Корзина выбирается по throttle_scope представления из THROTTLE_BUCKETS,
+    стоимость запроса - view.get_throttle_cost(request), по умолчанию 1.
+    IP берется с учетом NUM_PROXIES, при недоступном Redis решает THROTTLE_FAIL_OPEN
+    """
+
+    def __init__(self):
+        self.retry_after = None
+
+    def get_ident(self, request):
+        if request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        return f'ip:{super().get_ident(request)}'
+
+    @staticmethod
+    def get_cost(request, view) -> float:
+        get_throttle_cost = getattr(view, 'get_throttle_cost', None)
+        if get_throttle_cost is None:
+            return 1
+        return get_throttle_cost(request)
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        bucket = settings.THROTTLE_BUCKETS.get(scope)
+        if bucket is None:
+            return True
+        capacity, rate = bucket['capacity'], bucket['rate']
+        # Запрос дороже емкости корзины не прошел бы никогда
+        cost = min(self.get_cost(request, view), capacity)
+        try:
+            allowed, wait = get_script()(
+                keys=[get_bucket_key(scope, self.get_ident(request))],
+                args=[capacity, rate, cost],
+            )
+        except RedisError as e:
+            if not settings.THROTTLE_FAIL_OPEN:
+                raise
+            logger.warning('Throttle %s skipped, Redis unavailable: %s', scope, e)
+            return True
+        if allowed:
+            return True
+        self.retry_after = float(wait)
+        return False
+
+    def wait(self):
+        return self.retry_after
@@ -3,12 +3,16 @@ from drf_yasg import openapi
 from drf_yasg.views import get_schema_view
 from rest_framework import permissions
 
+from api.metrics import metrics_view
 from api.views import (CreateBookState, CreateFeedBack, FilterArtworks,
                        FilterAuthor, FilterGenreArtworks, FilterYearArtworks,
                        FirstLetterAuthor, GenreListCategory, GetAuthor,
                        GetBook, GetGenreAuthorBooks, GetSettings,
                        ListBookState, Search, UpdateStateBook,
-                       YearCategoryArtworks, BookCreate)
+                       YearCategoryArtworks, BookCreate, GetImportJob,
+                       ResumeImportJob, ContinueReadingByAuthor,
+                       GetAuthorBundle, DownloadBook, GetBookToc,
+                       GetBookChapter, UserStateTokenObtainPairView)
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -21,10 +25,15 @@ schema_view = get_schema_view(
 )
 urlpatterns = [
     # User
+    # Токены с is_active/is_suspended, раньше djoser.urls.jwt
+    path('auth/jwt/create/', UserStateTokenObtainPairView.as_view(), name='jwt-create'),
     path('auth/', include('djoser.urls')),
     path('auth/', include('djoser.urls.jwt')),
     path('api/settings/', GetSettings.as_view()),
 
+    # Метрики Prometheus
+    path('metrics', metrics_view, name='metrics'),
+
     # Docs
     path('docs/swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='swagger'),
     path('docs/redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
@@ -50,12 +59,19 @@ urlpatterns = [
 
     # Получение автора
     path('api/detail-author/<int:pk>/', GetAuthor.as_view()),
+    # Страница автора: автор, жанры и произведения по жанрам
+    path('api/author-bundle/<int:pk>/', GetAuthorBundle.as_view()),
 
     # Получение книг по жанру и автору
     path('api/books-genre-author/', GetGenreAuthorBooks.as_view()),
 
     # Получение книги
     path('api/book/<int:pk>/', GetBook.as_view()),
+    # Скачивание книги через nginx (X-Accel-Redirect)
+    path('api/book/<int:pk>/download/', DownloadBook.as_view(), name='book-download'),
+    # Оглавление и главы книги без скачивания всего файла
+    path('api/book/<int:pk>/toc/', GetBookToc.as_view()),
+    path('api/book/<int:pk>/chapter/', GetBookChapter.as_view()),
 
     # Форма обратной связи
     path('api/feedback/', CreateFeedBack.as_view()),
@@ -66,6 +82,9 @@ urlpatterns = [
     # Список книг у пользователя
     path('api/books/', ListBookState.as_view()),
 
+    # Продолжить чтение по авторам
+    path('api/continue-reading/', ContinueReadingByAuthor.as_view()),
+
     # Удаление книги из списка чтения
     # path('api/delete-book-state/<int:pk>/', DeleteBookState.as_view()),
 
@@ -73,5 +92,8 @@ urlpatterns = [
     path('api/update-state-book/<int:pk>/', UpdateStateBook.as_view()),
 
     path('api/create-book/', BookCreate.as_view()),
+    # Состояние и продолжение загрузки каталога
+    path('api/import-job/<int:pk>/', GetImportJob.as_view()),
+    path('api/import-job/<int:pk>/resume/', ResumeImportJob.as_view()),
 
 ]
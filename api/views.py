@@ -1,29 +1,55 @@
+import os
+import zlib
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import defaultdict
+from datetime import datetime, timezone
+from urllib.parse import quote
 
-from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.files.storage import default_storage
 from django.core.paginator import Paginator
+from django.http import FileResponse, Http404, HttpResponse
+from django.db.models import CharField, OuterRef, Prefetch, Q, Subquery, Value
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import status
+from rest_framework.exceptions import ValidationError
 from rest_framework.generics import CreateAPIView, GenericAPIView, ListAPIView
 from rest_framework.mixins import ListModelMixin, RetrieveModelMixin
 from rest_framework.parsers import JSONParser
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework_simplejwt.views import TokenObtainPairView
 
-from Book_backend import celery_app as app
-from api.custom_class.parce import ParseXML
-from api.models import Artworks, Author, BookState, Feedback, Genre, Settings
+from api.cache import catalog_etag, get_catalog_data, reading_list_etag
+from api.custom_class.epub import Epub, EpubError
+from api.models import (Artworks, Author, BookState, EpubIndex, Facet,
+                        FacetCounter, Feedback, Genre, ImportJob,
+                        ImportStatus, LastBookByAuthor, Settings)
 from api.serializer import (ArtworksSerializer,
                             ArtworksWithoutAuthorSerializer,
                             AuthorDetailSerializer, AuthorSerializer,
-                            BookGetSerializer, BookSerializer,
-                            BookStateSerializer, FeedbackSerializer,
+                            BookGetSerializer, BookPageSerializer,
+                            BookStateSerializer, ContinueReadingPageSerializer,
+                            FeedbackSerializer,
                             FeedBackSerializer, FirstLitterSerializer,
+                            ImportJobSerializer, LastBookByAuthorSerializer,
+                            ProgressSerializer,
                             ListBookStateSerializer, SearchSerializer,
                             SettingsSerializer, UpdateBookStateSerializer,
+                            UserStateTokenObtainPairSerializer,
                             YearArtworksSerializer, CreateSerializer)
+from api.progress import buffer_progress, get_buffered_progress, is_buffered
+from api.tasks import start_import_job
+
+
+class UserStateTokenObtainPairView(TokenObtainPairView):
+    """Получение JWT с is_active/is_suspended в данных access-токена"""
+    serializer_class = UserStateTokenObtainPairSerializer
 
 
 class PaginationApiView:
@@ -31,11 +57,12 @@ class PaginationApiView:
     Пагинация
     """
 
-    def __init__(self, request, data):
+    def __init__(self, request, data, serializer=None):
         """
         Создание класса для пагинации
         :param request: В зарпосе передаются значения page, limit
-        :param data: Данные, которые нужно разбить
+        :param data: Данные, которые нужно разбить, список или упорядоченный queryset
+        :param serializer: Класс сериализатора, если передан, сериализуется только текущая страница
         """
         page = int(request.GET.get('page', 1))
         limit = int(request.GET.get('limit', 10))
@@ -53,6 +80,8 @@ class PaginationApiView:
         self.page = page
         self.total = p.num_pages
         self.items = page_data.object_list
+        if serializer is not None:
+            self.items = serializer(self.items, many=True).data
 
     def get_str(self) -> dict:
         return {
@@ -64,34 +93,100 @@ class PaginationApiView:
         }
 
 
+class CursorPaginationApiView:
+    """
+    Пагинация курсором по (date_update, id), стоимость страницы не зависит от ее номера
+    """
+
+    def __init__(self, request, queryset, serializer):
+        """
+        :param request: В запросе передаются значения cursor, limit
+        :param queryset: Queryset, упорядоченный по (-date_update, -id)
+        :param serializer: Класс сериализатора для текущей страницы
+        """
+        try:
+            limit = int(request.GET.get('limit', 10))
+        except ValueError:
+            raise ValidationError({'errors': ['Лимит должен быть целым числом']})
+        if limit <= 0:
+            limit = 10
+        limit = min(limit, 100)
+        cursor = request.GET.get('cursor')
+        if cursor:
+            date_update, pk = self.decode(cursor)
+            queryset = queryset.filter(
+                Q(date_update__lt=date_update) | Q(date_update=date_update, id__lt=pk)
+            )
+        items = list(queryset[:limit + 1])
+        self.next = None
+        if len(items) > limit:
+            items = items[:limit]
+            self.next = self.encode(items[-1])
+        self.limit = limit
+        self.items = serializer(items, many=True).data
+
+    @staticmethod
+    def encode(instance) -> str:
+        value = f'{instance.date_update.isoformat()}|{instance.id}'
+        return urlsafe_b64encode(value.encode()).decode()
+
+    @staticmethod
+    def decode(cursor: str) -> tuple:
+        try:
+            date_update, pk = urlsafe_b64decode(cursor.encode()).decode().split('|')
+            date_update, pk = datetime.fromisoformat(date_update), int(pk)
+        except ValueError:
+            raise ValidationError({'errors': ['Неверный курсор']})
+        # Курсор вне диапазона id и без часового пояса мог быть только подделан
+        if date_update.tzinfo is None or not 0 < pk < 2 ** 63:
+            raise ValidationError({'errors': ['Неверный курсор']})
+        return date_update, pk
+
+    def get_str(self) -> dict:
+        return {
+            "limit": self.limit,
+            "next": self.next,
+            "items": self.items,
+        }
+
+
 RESPONSE = ''
 
 
-def get_first_litters(model) -> list:
+def get_facet_counts(facet: str, with_empty: bool = False) -> list:
     """
-    Получение всех первым букв в названии у модели
-    :param:
-    model - Модель для поиска, обязательно имеет поле name
-    :return: Словарь, ключ = буква, значение = кол-во
+    Получение значений фасета и кол-ва из счетчиков FacetCounter
+    :param facet: Фасет из Facet
+    :param with_empty: Выводить значения с нулевым кол-вом
+    :return: Список словарей, name = значение, count = кол-во
     """
-    letters = defaultdict(int)
-    for name in model.objects.values_list('name', flat=True):
-        first_letter = name[0]
-        letters[first_letter] += 1
-    return [{'name': result, 'count': value} for result, value in letters.items()]
+    queryset = FacetCounter.objects.filter(facet=facet)
+    if not with_empty:
+        queryset = queryset.filter(count__gt=0)
+    return [
+        {'name': value, 'count': count}
+        for value, count in queryset.order_by('value').values_list('value', 'count')
+    ]
 
 
-def check_in_reading_list(user: User | None, book: Artworks) -> int | None:
+def fill_reading_list(user: int | None, artworks: list) -> list:
     """
-    Проверяет есть ли книга в списке для чтения
-    :param book: Книга для проверки
-    :param user: Пользователь
-    :return: Если книга есть в списке для чтения выводит словарь с процентами для чтения, если нет пустой список
+    Дополняет сериализованные произведения процентом прочтения одним запросом
+    :param user: Пользователь, id или None
+    :param artworks: Список сериализованных произведений, у каждого есть id
+    :return: Тот же список, у каждого произведения заполнено поле read (проценты или None)
     """
-    if BookState.objects.filter(user=user).filter(book=book).exists():
-        return BookState.objects.filter(user=user).get(book=book).percent
-    else:
-        return None
+    percents = {}
+    if user is not None and artworks:
+        percents = dict(
+            BookState.objects.filter(
+                user=user,
+                book__in=[el.get('id') for el in artworks],
+            ).values_list('book', 'percent')
+        )
+    for el in artworks:
+        el['read'] = percents.get(el.get('id'))
+    return artworks
 
 
 class Library(ListModelMixin, GenericAPIView):
@@ -114,6 +209,11 @@ class Search(GenericAPIView):
     Поиск производиться среди авторов и произведений, принимает value - str, null=True
     Если value = null, выдает полный список авторов и произведений
     """
+    AUTHOR = 'author'
+    ARTWORKS = 'artworks'
+    throttle_scope = 'search'
+    # Пустой общий поиск отдает весь каталог и стоит дороже поиска по значению или одному типу
+    FULL_SEARCH_COST = 10
 
     def get_filters(self, request) -> tuple:
         """Получить все фильтры"""
@@ -122,6 +222,12 @@ class Search(GenericAPIView):
         artwork = request.GET.get('artworks', False)
         return value, author, artwork
 
+    def get_throttle_cost(self, request) -> int:
+        value, author, artwork = self.get_filters(request=request)
+        if not value and not author and not artwork:
+            return self.FULL_SEARCH_COST
+        return 1
+
     @swagger_auto_schema(
         manual_parameters=[
             openapi.Parameter(
@@ -147,55 +253,97 @@ class Search(GenericAPIView):
             200: openapi.Response('Successful Response', schema=SearchSerializer),
         })
     def get(self, request):
-        data = {}
         value, author, artwork = self.get_filters(request=request)
+        data = get_catalog_data(
+            request=request,
+            name='search',
+            builder=lambda: self.search(request=request, value=value, author=author, artwork=artwork),
+        )
+        if not author:
+            if artwork:
+                artworks = data['artworks']['items']
+            else:
+                artworks = [el for el in data['items'] if el['type'] == self.ARTWORKS]
+            fill_reading_list(user=request.user.id, artworks=artworks)
+        return Response(status=status.HTTP_200_OK, data=data)
 
+    def search(self, request, value: str, author, artwork) -> dict:
+        """Поиск без персональных данных пользователя"""
+        data = {}
         if author:
-            authors = Author.objects.filter(name__icontains=value)
+            authors = Author.objects.search(value).order_by('-rank', 'id')
             data['authors'] = PaginationApiView(
                 request=request,
-                data=AuthorSerializer(authors, many=True).data
+                data=authors,
+                serializer=AuthorSerializer,
             ).get_str()
         elif artwork:
-            artworks = Artworks.objects.filter(name__icontains=value)
-            data['artworks'] = ArtworksSerializer(artworks, many=True).data
-            for el in data.get('artworks', []):
-                el['read'] = check_in_reading_list(user=request.user.id, book=el.get('id'))
-            data['artworks'] = PaginationApiView(data=data['artworks'], request=request).get_str()
+            artworks = Artworks.objects.with_authors_genres().search(value).order_by('-rank', 'id')
+            data['artworks'] = PaginationApiView(
+                request=request,
+                data=artworks,
+                serializer=ArtworksSerializer,
+            ).get_str()
         else:
-            authors = Author.objects.filter(name__icontains=value)
-            artworks = Artworks.objects.filter(name__icontains=value)
-            data['authors'] = AuthorSerializer(authors, many=True).data
-            data['artworks'] = ArtworksSerializer(artworks, many=True).data
-
-            for el in data.get('artworks', []):
-                el['read'] = check_in_reading_list(user=request.user.id, book=el.get('id'))
-
-            new_data = []
-            AUTHOR = 'author'
-            ARTWORKS = 'artworks'
-            for author_t in data['authors']:
-                author_t['type'] = AUTHOR
-                new_data.append(author_t)
-            for artw_t in data['artworks']:
-                artw_t['type'] = ARTWORKS
-                new_data.append(artw_t)
-            data = PaginationApiView(data=new_data, request=request).get_str()
-        return Response(status=status.HTTP_200_OK, data=data)
+            data = self.search_all(request=request, value=value)
+        return data
+
+    def search_all(self, request, value: str) -> dict:
+        """
+        Общий поиск: сначала авторы, затем произведения, каждые по релевантности.
+        Пагинация выполняется в базе через UNION ALL, сериализуется только текущая страница
+        """
+        AUTHOR = self.AUTHOR
+        ARTWORKS = self.ARTWORKS
+        authors = Author.objects.search(value).annotate(
+            group=Value(0),
+            type=Value(AUTHOR, output_field=CharField()),
+        ).values('id', 'group', 'type', 'rank')
+        artworks = Artworks.objects.search(value).annotate(
+            group=Value(1),
+            type=Value(ARTWORKS, output_field=CharField()),
+        ).values('id', 'group', 'type', 'rank')
+        pagination = PaginationApiView(
+            request=request,
+            data=authors.union(artworks, all=True).order_by('group', '-rank', 'id'),
+        )
+
+        ids = defaultdict(list)
+        for el in pagination.items:
+            ids[el['type']].append(el['id'])
+        serialized = {
+            AUTHOR: AuthorSerializer(Author.objects.filter(id__in=ids[AUTHOR]), many=True).data,
+            ARTWORKS: ArtworksSerializer(
+                Artworks.objects.with_authors_genres().filter(id__in=ids[ARTWORKS]),
+                many=True,
+            ).data,
+        }
+        by_id = {(type_, el['id']): el for type_, items in serialized.items() for el in items}
+
+        items = []
+        for el in pagination.items:
+            item = by_id[(el['type'], el['id'])]
+            item['type'] = el['type']
+            items.append(item)
+        pagination.items = items
+        return pagination.get_str()
 
 
 class FilterArtworks(ListModelMixin, GenericAPIView):
     """Результат поиска по первой букве произведения"""
-    queryset = Artworks.objects.all()
+    queryset = Artworks.objects.with_authors_genres()
     serializer_class = ArtworksSerializer
     permission_classes = ()
 
     def list(self, request, *args, **kwargs):
-        data = self.serializer_class(
-            self.queryset.filter(name__startswith=request.GET.get('value', '')),
-            many=True).data
-        for el in data:
-            el['read'] = check_in_reading_list(user=request.user.id, book=el.get('id'))
+        data = get_catalog_data(
+            request=request,
+            name='filter-artworks-first',
+            builder=lambda: self.serializer_class(
+                self.queryset.filter(name__startswith=request.GET.get('value', '')),
+                many=True).data,
+        )
+        fill_reading_list(user=request.user.id, artworks=data)
         return Response(
             data=data,
             status=200
@@ -213,12 +361,16 @@ class FilterAuthor(ListModelMixin, GenericAPIView):
 
     def list(self, request, *args, **kwargs):
         return Response(
-            data=self.serializer_class(
-                self.queryset.filter(
-                    name__startswith=request.GET.get('value', '')
-                ),
-                many=True
-            ).data,
+            data=get_catalog_data(
+                request=request,
+                name='filter-author-first',
+                builder=lambda: self.serializer_class(
+                    self.queryset.filter(
+                        name__startswith=request.GET.get('value', '')
+                    ),
+                    many=True
+                ).data,
+            ),
             status=200
         )
 
@@ -236,50 +388,53 @@ class FirstLetterAuthor(GenericAPIView):
     """Получение списка букв для поиска авторов по первой букве"""
     serializer_class = FirstLitterSerializer(many=True)
 
+    @method_decorator(condition(etag_func=catalog_etag))
     @swagger_auto_schema(
         responses={
             200: openapi.Response('Successful Response', schema=FirstLitterSerializer(many=True)),
         })
     def get(self, request):
-        letters = get_first_litters(model=Author)
+        letters = get_catalog_data(
+            request=request,
+            name='first-letter-author',
+            builder=lambda: get_facet_counts(facet=Facet.AUTHOR_LETTER),
+        )
         return Response(status=200, data=letters)
 
 
 class YearCategoryArtworks(GenericAPIView):
     """Вывод всех дат и кол-во произведений"""
-    queryset = Artworks.objects.all().values_list('date', flat=True)
+    queryset = FacetCounter.objects.filter(facet=Facet.YEAR)
 
+    @method_decorator(condition(etag_func=catalog_etag))
     @swagger_auto_schema(
         responses={
             200: openapi.Response('Successful Response', schema=FirstLitterSerializer(many=True)),
         })
     def get(self, request, *args, **kwargs):
-        years = {}
-        for artwork in self.get_queryset():
-            years[artwork] = years.get(artwork, 0) + 1
-        result = [{'name': year, 'count': value} for year, value in years.items()]
+        result = get_catalog_data(
+            request=request,
+            name='artworks-year',
+            builder=lambda: get_facet_counts(facet=Facet.YEAR),
+        )
         return Response(status=status.HTTP_200_OK, data=result)
 
 
 class GenreListCategory(ListModelMixin, GenericAPIView):
     """Получение списка жанров и кол-во"""
-    queryset = Genre.objects.all().values_list('name', flat=True)
+    queryset = FacetCounter.objects.filter(facet=Facet.GENRE)
 
     def list(self, request, *args, **kwargs):
-        return [
-            {
-                'name': name,
-                'count': Artworks.objects.filter(genres__name=name).count(),
-            }
-            for name in self.get_queryset()
-        ]
+        return get_facet_counts(facet=Facet.GENRE, with_empty=True)
 
+    @method_decorator(condition(etag_func=catalog_etag))
     @swagger_auto_schema(
         responses={
             200: openapi.Response('Successful Response', schema=FirstLitterSerializer(many=True)),
         })
     def get(self, request):
-        return Response(status=status.HTTP_200_OK, data=self.list(request))
+        data = get_catalog_data(request=request, name='genre-names', builder=lambda: self.list(request))
+        return Response(status=status.HTTP_200_OK, data=data)
 
 
 def last_book_by_author(user: int, author: Author) -> dict | None:
@@ -289,26 +444,31 @@ def last_book_by_author(user: int, author: Author) -> dict | None:
     :param author: Автор для поиска
     :return: Возвращаем название и процент книги, если не нашли, None
     """
-    if BookState.objects.filter(book__author=author).filter(user=user).exists():
-        book = BookState.objects.filter(book__author=author).filter(user=user).order_by('-date_update').first()
-        return {
-            'id': book.book.id,
-            'name': book.book.name,
-            'percent': book.percent,
-        }
-    else:
+    if user is None:
+        return None
+    book = LastBookByAuthor.objects.filter(user=user, author=author).select_related('book').only(
+        'percent', 'book__name',
+    ).first()
+    if book is None:
         return None
+    return {
+        'id': book.book_id,
+        'name': book.book.name,
+        'percent': book.percent,
+    }
 
 
 class GetAuthor(RetrieveModelMixin, GenericAPIView):
     """ Получение автора """
-    queryset = Author.objects.all()
+    queryset = Author.objects.select_related('stats')
     serializer_class = AuthorDetailSerializer
 
     def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        serializer = self.get_serializer(instance)
-        data = serializer.data
+        data = get_catalog_data(
+            request=request,
+            name='detail-author',
+            builder=lambda: self.get_serializer(self.get_object()).data,
+        )
         data['last'] = last_book_by_author(user=request.user.id, author=data['id'])
         return Response(data)
 
@@ -316,6 +476,40 @@ class GetAuthor(RetrieveModelMixin, GenericAPIView):
         return self.retrieve(request, pk=pk)
 
 
+class GetAuthorBundle(GetAuthor):
+    """
+    Страница автора одним запросом: автор, статистика по жанрам, произведения по жанрам с процентом прочтения
+    """
+
+    def build(self) -> dict:
+        """
+        Общие для всех пользователей данные: автор со статистикой и произведения, сгруппированные как в статистике.
+        Произведение с несколькими жанрами попадает в каждую группу, без жанра - в группу с id = None
+        """
+        data = self.get_serializer(self.get_object()).data
+        groups = {genre['id']: {'id': genre['id'], 'name': genre['name'], 'items': []} for genre in data['genres']}
+        artworks = Artworks.objects.filter(author=data['id']).prefetch_related(
+            Prefetch('genres', queryset=Genre.objects.only('id', 'name')),
+        ).order_by('name', 'id')
+        for artwork in artworks:
+            item = ArtworksWithoutAuthorSerializer(artwork).data
+            for genre in artwork.genres.all() or (None,):
+                group = groups.setdefault(
+                    getattr(genre, 'id', None),
+                    {'id': getattr(genre, 'id', None), 'name': getattr(genre, 'name', None), 'items': []},
+                )
+                group['items'].append(dict(item))
+        data['artworks'] = list(groups.values())
+        return data
+
+    def retrieve(self, request, *args, **kwargs):
+        data = get_catalog_data(request=request, name='author-bundle', builder=self.build)
+        items = [item for group in data['artworks'] for item in group['items']]
+        fill_reading_list(user=request.user.id, artworks=items)
+        data['last'] = last_book_by_author(user=request.user.id, author=data['id'])
+        return Response(data)
+
+
 class GetBook(GenericAPIView):
     """Получение книги, файл, точка остановки и проценты"""
     queryset = BookState.objects.all()
@@ -340,16 +534,164 @@ class GetBook(GenericAPIView):
     )
     def get(self, request, pk):
         book = get_object_or_404(Artworks, id=pk)
-        book_state = get_object_or_404(self.get_queryset().filter(user=request.user.id), book_id=pk)
+        progress = get_buffered_progress(user=request.user.id).get(book.id)
+        if progress is None:
+            book_state = get_object_or_404(self.get_queryset().filter(user=request.user.id), book_id=pk)
+            progress = {'epubcfi': book_state.epubcfi, 'percent': book_state.percent}
         data = {
-            'file': book.file,
-            'epubcfi': book_state.epubcfi,
-            'percent': book_state.percent,
+            'file': request.build_absolute_uri(reverse('book-download', kwargs={'pk': book.id})),
+            'epubcfi': progress['epubcfi'],
+            'percent': progress['percent'],
         }
         serializer = self.get_serializer(data)
         return Response(status=status.HTTP_200_OK, data=serializer.data)
 
 
+class DownloadBook(GenericAPIView):
+    """
+    Скачивание файла книги. Доступ проверяется здесь, файл отдает nginx (X-Accel-Redirect):
+    Range, sendfile и без занятого воркера на время передачи
+    """
+    queryset = Artworks.objects.select_related('epub_optimization').only('id', 'file', 'epub_optimization')
+    permission_classes = (IsAuthenticated,)
+
+    @swagger_auto_schema(
+        responses={
+            200: openapi.Response('Файл книги (application/epub+zip)'),
+            401: openapi.Response('Authentication credentials were not provided.'),
+            404: openapi.Response('Not found.'),
+        },
+    )
+    def get(self, request, pk):
+        book = get_object_or_404(self.get_queryset(), id=pk)
+        name = book.get_read_file_name()
+        if not name:
+            raise Http404
+        filename = os.path.basename(name)
+        if not settings.USE_X_ACCEL_REDIRECT:
+            if not default_storage.exists(name):
+                raise Http404
+            return FileResponse(default_storage.open(name, 'rb'), as_attachment=True, filename=filename)
+        response = HttpResponse(content_type='application/epub+zip')
+        try:
+            filename.encode('ascii')
+            response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        except UnicodeEncodeError:
+            response['Content-Disposition'] = f"attachment; filename*=utf-8''{quote(filename)}"
+        response['X-Accel-Redirect'] = quote(f'{settings.PROTECTED_MEDIA_URL}{name}')
+        return response
+
+
+def get_epub_index(pk: int) -> EpubIndex:
+    """
+    Индекс EPUB книги, при отсутствии строится сразу
+    :param pk: id книги
+    :return: EpubIndex, 404 если книги или файла нет или файл не EPUB
+    """
+    book = get_object_or_404(
+        Artworks.objects.select_related('epub_index', 'epub_optimization').only(
+            'id', 'file', 'epub_index', 'epub_optimization',
+        ),
+        id=pk,
+    )
+    try:
+        return EpubIndex.objects.get_actual(book)
+    except (EpubError, OSError):
+        raise Http404
+
+
+class GetBookToc(GenericAPIView):
+    """Порядок чтения (spine) и оглавление книги"""
+    queryset = EpubIndex.objects.all()
+    permission_classes = (IsAuthenticated,)
+
+    @swagger_auto_schema(
+        responses={
+            200: openapi.Response('Successful Response', schema=openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    'spine': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_STRING)),
+                    'toc': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(
+                        type=openapi.TYPE_OBJECT,
+                        properties={
+                            'title': openapi.Schema(type=openapi.TYPE_STRING),
+                            'href': openapi.Schema(type=openapi.TYPE_STRING),
+                            'level': openapi.Schema(type=openapi.TYPE_INTEGER),
+                        },
+                    )),
+                },
+            )),
+            401: openapi.Response('Authentication credentials were not provided.'),
+            404: openapi.Response('Not found.'),
+        },
+    )
+    def get(self, request, pk):
+        index = get_epub_index(pk=pk)
+        data = {
+            'spine': [itemref['href'] for itemref in index.spine],
+            'toc': index.toc,
+        }
+        return Response(status=status.HTTP_200_OK, data=data)
+
+
+class GetBookChapter(GenericAPIView):
+    """
+    Одна глава (ресурс) книги, читается по смещению из индекса без распаковки всего EPUB.
+    Глава задается href, epubcfi или номером в spine (index), по умолчанию первая
+    """
+    queryset = EpubIndex.objects.all()
+    permission_classes = (IsAuthenticated,)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'index', in_=openapi.IN_QUERY, description='Номер главы в spine', type=openapi.TYPE_INTEGER, default=0
+            ),
+            openapi.Parameter(
+                'epubcfi', in_=openapi.IN_QUERY, description='Глава, содержащая место остановки',
+                type=openapi.TYPE_STRING,
+            ),
+            openapi.Parameter(
+                'href', in_=openapi.IN_QUERY, description='Ресурс по пути внутри EPUB (картинки, стили)',
+                type=openapi.TYPE_STRING,
+            ),
+        ],
+        responses={
+            200: openapi.Response('Ресурс, заголовок X-Spine-Index - номер главы в spine'),
+            400: openapi.Response('Неверный epubcfi или index'),
+            401: openapi.Response('Authentication credentials were not provided.'),
+            404: openapi.Response('Not found.'),
+        },
+    )
+    def get(self, request, pk):
+        index = get_epub_index(pk=pk)
+        spine = [itemref['href'] for itemref in index.spine]
+        href = request.GET.get('href')
+        if href is None:
+            if 'epubcfi' in request.GET:
+                position = Epub.get_spine_index(request.GET['epubcfi'], index.spine)
+            else:
+                try:
+                    position = int(request.GET.get('index', 0))
+                except ValueError:
+                    position = None
+            if position is None or not 0 <= position < len(spine):
+                return Response(status=status.HTTP_400_BAD_REQUEST, data={'errors': 'Глава не найдена'})
+            href = spine[position]
+        item = index.items.get(href)
+        if item is None:
+            raise Http404
+        try:
+            with default_storage.open(index.file, 'rb') as file:
+                content = Epub.read_item(file, item)
+        except (EpubError, OSError, zlib.error):
+            raise Http404
+        response = HttpResponse(content, content_type=item['media_type'])
+        if href in spine:
+            response['X-Spine-Index'] = spine.index(href)
+        return response
+
+
 class GetSettings(GenericAPIView):
     """Получение настроек"""
     serializer_class = SettingsSerializer
@@ -422,15 +764,22 @@ class CreateBookState(CreateAPIView):
     permission_classes = (IsAuthenticated,)
 
     def create(self, request, *args, **kwargs):
-        data = {'user': request.user.id}
-        data |= request.data
-        serializer = self.get_serializer(data=data)
+        serializer = self.get_serializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         self.perform_create(serializer)
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
+    def perform_create(self, serializer):
+        """Книга, уже добавленная в список, обновляется и снова показывается"""
+        serializer.instance = BookState.objects.upsert(
+            user=self.request.user.id,
+            book=serializer.validated_data['book'].id,
+            epubcfi=serializer.validated_data['epubcfi'],
+            percent=serializer.validated_data['percent'],
+        )
+
     @swagger_auto_schema(
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
@@ -462,19 +811,66 @@ class CreateBookState(CreateAPIView):
 
 
 class ListBookState(ListModelMixin, GenericAPIView):
-    """Список книг для чтения"""
+    """
+    Список книг для чтения, новые обновления первыми.
+    Отдается страницами {limit, next, items}, а не полным списком: следующая страница - ?cursor=next,
+    next = null на последней странице
+    """
     queryset = BookState.objects.filter(show=True)
     serializer_class = ListBookStateSerializer
     permission_classes = (IsAuthenticated,)
 
     def list(self, request, *args, **kwargs):
-        queryset = self.queryset.filter(user=request.user).order_by('-date_update')
-        serializer = self.get_serializer_class()(queryset, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        page = CursorPaginationApiView(
+            request=request,
+            queryset=BookState.objects.reading_list(user=request.user.id),
+            serializer=self.get_serializer_class(),
+        )
+        buffered = get_buffered_progress(user=request.user.id)
+        for el in page.items:
+            if el['book'] in buffered:
+                el['percent'] = buffered[el['book']]['percent']
+        if buffered and not request.GET.get('cursor'):
+            page.items = self.get_buffered_books(user=request.user.id, buffered=buffered) + page.items
+        return Response(page.get_str(), status=status.HTTP_200_OK)
+
+    def get_buffered_books(self, user: int, buffered: dict) -> list:
+        """
+        Книги, которые появятся в списке после переноса прогресса из буфера в базу:
+        без состояния в базе или скрытые. До переноса они выводятся в начале первой страницы
+        :param user: id пользователя
+        :param buffered: Прогресс из буфера, id книги -> {'epubcfi', 'percent', 'time'}
+        """
+        books = {book for book, value in buffered.items() if value['percent'] != 100}
+        books -= set(BookState.objects.filter(user=user, book__in=books, show=True).values_list('book', flat=True))
+        if not books:
+            return []
+        artworks = Artworks.objects.filter(id__in=books).only('id', 'name').prefetch_related(
+            Prefetch('author', queryset=Author.objects.only('id', 'name')),
+        )
+        states = sorted(
+            (BookState(book=artwork, percent=buffered[artwork.id]['percent']) for artwork in artworks),
+            key=lambda state: buffered[state.book_id]['time'],
+            reverse=True,
+        )
+        return self.get_serializer(states, many=True).data
 
+    @method_decorator(condition(etag_func=reading_list_etag))
     @swagger_auto_schema(
+        operation_description=(
+            'Список книг для чтения страницами курсора {limit, next, items}. '
+            'Следующая страница - ?cursor=next, next = null на последней странице'
+        ),
+        manual_parameters=[
+            openapi.Parameter(
+                'cursor', in_=openapi.IN_QUERY, description='Курсор следующей страницы (next)', type=openapi.TYPE_STRING
+            ),
+            openapi.Parameter(
+                'limit', in_=openapi.IN_QUERY, description='Лимит страницы', type=openapi.TYPE_INTEGER, default=10
+            ),
+        ],
         responses={
-            200: openapi.Response('Successful Response', schema=BookSerializer()),
+            200: openapi.Response('Successful Response', schema=BookPageSerializer),
             400: openapi.Response('Bad Request', schema=openapi.Schema(
                 type=openapi.TYPE_OBJECT,
                 properties={
@@ -493,6 +889,34 @@ class ListBookState(ListModelMixin, GenericAPIView):
         return self.list(request)
 
 
+class ContinueReadingByAuthor(GenericAPIView):
+    """Продолжить чтение: последняя книга по каждому автору"""
+    serializer_class = LastBookByAuthorSerializer
+    permission_classes = (IsAuthenticated,)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                'cursor', in_=openapi.IN_QUERY, description='Курсор следующей страницы (next)', type=openapi.TYPE_STRING
+            ),
+            openapi.Parameter(
+                'limit', in_=openapi.IN_QUERY, description='Лимит страницы', type=openapi.TYPE_INTEGER, default=10
+            ),
+        ],
+        responses={
+            200: openapi.Response('Successful Response', schema=ContinueReadingPageSerializer),
+            401: openapi.Response('Authentication credentials were not provided.')
+        },
+    )
+    def get(self, request):
+        page = CursorPaginationApiView(
+            request=request,
+            queryset=LastBookByAuthor.objects.continue_reading(user=request.user.id),
+            serializer=self.get_serializer_class(),
+        )
+        return Response(page.get_str(), status=status.HTTP_200_OK)
+
+
 class DeleteBookState(GenericAPIView):
     queryset = BookState.objects.all()
     permission_classes = (IsAuthenticated,)
@@ -512,6 +936,7 @@ class UpdateStateBook(GenericAPIView):
     queryset = BookState.objects.all()
     serializer_class = UpdateBookStateSerializer
     permission_classes = (IsAuthenticated,)
+    throttle_scope = 'reading-progress'
 
     @swagger_auto_schema(
         request_body=openapi.Schema(
@@ -539,26 +964,51 @@ class UpdateStateBook(GenericAPIView):
         },
     )
     def patch(self, request, pk, *args, **kwargs):
-        data = request.data
-        data['user'] = request.user.id
-        data['book'] = get_object_or_404(Artworks, id=pk).id
-        if BookState.objects.filter(user=request.user.id, book=data['book']).exists():
-            book_state = get_object_or_404(BookState.objects.filter(user=request.user.id), book=data['book'])
-            serializer = UpdateBookStateSerializer(book_state, data=data)
-        else:
-            serializer = UpdateBookStateSerializer(data=data)
+        if is_buffered():
+            return self.buffer(request, pk)
+        serializer = ProgressSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(status=status.HTTP_400_BAD_REQUEST, data=serializer.errors)
+        book_state = BookState.objects.upsert(
+            user=request.user.id,
+            book=pk,
+            show=serializer.validated_data['percent'] != 100,
+            **serializer.validated_data,
+        )
+        if book_state is None:
+            raise Http404
+        return Response(status=status.HTTP_200_OK, data=UpdateBookStateSerializer(book_state).data)
 
-        if serializer.is_valid():
-            serializer.save()
-            return Response(status=status.HTTP_200_OK, data=serializer.data)
-        else:
+    @staticmethod
+    def buffer(request, pk):
+        """
+        Отложенная запись: прогресс сохраняется в Redis, из базы одним запросом проверка книги и id состояния.
+        Ответ в том же формате, что и при записи в базу: id null, пока состояния нет, date_update - время записи в буфер
+        """
+        serializer = ProgressSerializer(data=request.data)
+        if not serializer.is_valid():
             return Response(status=status.HTTP_400_BAD_REQUEST, data=serializer.errors)
+        states = Artworks.objects.filter(id=pk).annotate(
+            state=Subquery(BookState.objects.filter(user=request.user.id, book=OuterRef('id')).values('id')),
+        ).values_list('state', flat=True)
+        if not states:
+            raise Http404
+        updated = buffer_progress(user=request.user.id, book=pk, **serializer.validated_data)
+        book_state = BookState(
+            id=states[0],
+            user_id=request.user.id,
+            book_id=pk,
+            show=serializer.validated_data['percent'] != 100,
+            date_update=datetime.fromtimestamp(updated, tz=timezone.utc),
+            **serializer.validated_data,
+        )
+        return Response(status=status.HTTP_200_OK, data=UpdateBookStateSerializer(book_state).data)
 
 
 class FilterYearArtworks(GenericAPIView):
     """Поиск по году"""
     serializer_class = ArtworksSerializer
-    queryset = Artworks.objects.all()
+    queryset = Artworks.objects.with_authors_genres()
 
     @swagger_auto_schema(
         manual_parameters=[
@@ -573,16 +1023,19 @@ class FilterYearArtworks(GenericAPIView):
     )
     def get(self, request):
         year = request.GET.get('year', '')
-        objs = self.get_serializer(self.get_queryset().filter(date=year), many=True).data
-        for artwork in objs:
-            artwork['read'] = check_in_reading_list(user=request.user.id, book=artwork.get('id'))
+        objs = get_catalog_data(
+            request=request,
+            name='filter-year-artworks',
+            builder=lambda: self.get_serializer(self.get_queryset().filter(date=year), many=True).data,
+        )
+        fill_reading_list(user=request.user.id, artworks=objs)
         return Response(status=status.HTTP_200_OK, data=objs)
 
 
 class FilterGenreArtworks(GenericAPIView):
     """Получение произведений по жанру"""
     serializer_class = ArtworksSerializer
-    queryset = Artworks.objects.all()
+    queryset = Artworks.objects.with_authors_genres()
 
     @swagger_auto_schema(
         manual_parameters=[
@@ -597,9 +1050,12 @@ class FilterGenreArtworks(GenericAPIView):
     )
     def get(self, request):
         genre = request.GET.get('genre', '')
-        objs = self.get_serializer(self.get_queryset().filter(genres__name=genre), many=True).data
-        for artwork in objs:
-            artwork['read'] = check_in_reading_list(user=request.user.id, book=artwork.get('id'))
+        objs = get_catalog_data(
+            request=request,
+            name='filter-genre-artworks',
+            builder=lambda: self.get_serializer(self.get_queryset().filter(genres__name=genre), many=True).data,
+        )
+        fill_reading_list(user=request.user.id, artworks=objs)
         return Response(status=status.HTTP_200_OK, data=objs)
 
 
@@ -634,28 +1090,55 @@ class GetGenreAuthorBooks(GenericAPIView):
         if author is None or genre is None:
             return Response(status=status.HTTP_400_BAD_REQUEST, data={'errors': 'Все поля должны быть заполнены'})
 
-        objs = self.get_serializer(
-            self.get_queryset().filter(author__id=int(author)).filter(genres__id=int(genre)),
-            many=True
-        ).data
-        for artwork in objs:
-            artwork['read'] = check_in_reading_list(user=request.user.id, book=artwork.get('id'))
+        objs = get_catalog_data(
+            request=request,
+            name='books-genre-author',
+            builder=lambda: self.get_serializer(
+                self.get_queryset().filter(author__id=int(author)).filter(genres__id=int(genre)),
+                many=True
+            ).data,
+        )
+        fill_reading_list(user=request.user.id, artworks=objs)
         return Response(status=status.HTTP_200_OK, data=objs)
 
 
 class BookCreate(GenericAPIView):
+    """Загрузка каталога из Excel, возвращает задачу загрузки"""
     queryset = Artworks.objects.all()
     serializer_class = CreateSerializer
+    # Файл сразу попадает в каталог
+    permission_classes = (IsAdminUser,)
 
+    @swagger_auto_schema(
+        responses={
+            200: openapi.Response('Successful Response', schema=ImportJobSerializer()),
+        })
     def post(self, request, *args, **kwargs):
         serializer: CreateSerializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        file = serializer.validated_data['file']
-        parce_file.apply_async()
-        return Response(status=200)
+        job = ImportJob.objects.create(file=serializer.validated_data['file'])
+        start_import_job.delay(job.id)
+        return Response(status=status.HTTP_200_OK, data=ImportJobSerializer(job).data)
+
+
+class GetImportJob(RetrieveModelMixin, GenericAPIView):
+    """Состояние загрузки каталога"""
+    queryset = ImportJob.objects.all()
+    serializer_class = ImportJobSerializer
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, pk):
+        return self.retrieve(request, pk=pk)
+
 
+class ResumeImportJob(GenericAPIView):
+    """Продолжение загрузки каталога, обрабатываются только незавершенные пачки"""
+    queryset = ImportJob.objects.all()
+    serializer_class = ImportJobSerializer
+    permission_classes = (IsAdminUser,)
 
-@app.task(ignore_result=True)
-def parce_file():
-    ParseXML(file_path='Library.xlsx').parse_excel_file()
-# ParseXML(file_path='Library.xlsx').parse_excel_file()
+    def post(self, request, pk):
+        job = self.get_object()
+        if job.status != ImportStatus.DONE:
+            start_import_job.delay(job.id)
+        return Response(status=status.HTTP_200_OK, data=self.get_serializer(job).data)
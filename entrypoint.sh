@@ -1,4 +1,6 @@
 #!/bin/sh
+# Без миграций приложение не запускается
+set -e
 
 if [ "$DATABASE" = "postgres" ]
 then
@@ -11,8 +13,21 @@ then
     echo "PostgreSQL started"
 fi
 
+# Файлы метрик прошлого запуска gunicorn
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]
+then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
 #python manage.py flush --no-input
 python manage.py makemigrations
+# Уникальность (user, book) в миграции не создастся, пока в базе есть повторы
+python manage.py remove_duplicate_book_states
 python manage.py migrate
+# Счетчики, последние книги по авторам и поисковые векторы для записей, созданных до их появления
+python manage.py rebuild_facets
+python manage.py rebuild_last_books
+python manage.py update_search_vectors --missing
 python manage.py collectstatic --noinput
 exec "$@"
\ No newline at end of file